@@ -1,39 +1,484 @@
+import atexit
 import base64
+import csv
 import datetime as dt
+import gzip
+import hashlib
+import html
+import importlib.util
+import io
+import json
 import logging
+import logging.handlers
+import math
+import multiprocessing
 import os
+import queue
+import random
 import re
+import secrets
+import shutil
 import sqlite3
+import sys
+import threading
+import time
 import uuid
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
-from flask import Flask, jsonify, make_response, render_template_string, request
-from openai import OpenAI
-import stripe
+STARTUP_STARTED = time.perf_counter()
+
+from flask import Flask, Response, jsonify, make_response, render_template_string, request  # noqa: E402
+
+from db import (  # noqa: E402
+    ABANDONED_USER_FILTER,
+    apply_migrations,
+    create_users_sweep_index,
+    shard_index,
+    sqlite_shard_paths,
+)
+
+try:
+    import brotli
+except ImportError:  # optional; responses fall back to gzip without it
+    brotli = None
+
+# Filled in as the module loads and as lazy clients are first built; see /_admin/startup.
+STARTUP_TIMINGS = {"flask_import_ms": round((time.perf_counter() - STARTUP_STARTED) * 1000, 1)}
 
 APP_NAME = "Message Intent Lab"
 TAGLINE = "Trying to figure out if he is ghosting or just bad at texting? I will decode it."
 MAX_UPLOAD_BYTES = 8 * 1024 * 1024
-DB_PATH = os.path.join(os.path.dirname(__file__), "mil.db")
+DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.dirname(__file__), "mil.db"))
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+USER_SHARDS = int(os.getenv("USER_SHARDS", "1"))
 COOKIE_NAME = "mil_uid"
 COOKIE_MAX_AGE = 31536000
+FREE_DECODES_PER_DAY = 2
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 STRIPE_PRICE_DECODE_10 = os.getenv("STRIPE_PRICE_DECODE_10")
 STRIPE_PRICE_DECODE_25 = os.getenv("STRIPE_PRICE_DECODE_25")
 STRIPE_PRICE_DECODE_50 = os.getenv("STRIPE_PRICE_DECODE_50")
+STRIPE_PRICES = {"10": STRIPE_PRICE_DECODE_10, "25": STRIPE_PRICE_DECODE_25, "50": STRIPE_PRICE_DECODE_50}
+# Open Checkout Sessions are reused per (user, pack) until shortly before Stripe
+# expires them, so repeat clicks on the limit panel skip the Stripe round trip.
+CHECKOUT_REUSE_MARGIN_SECONDS = 600
+
+# Only the markup the result card in HTML_TEMPLATE actually styles survives sanitizing.
+SANITIZER_ALLOWED_TAGS = frozenset({"div", "span", "h3", "ul", "li", "p", "strong", "em", "b", "i", "br"})
+SANITIZER_VOID_TAGS = frozenset({"br"})
+SANITIZER_ALLOWED_CLASSES = frozenset({"quick-take", "badges", "badge", "section"})
+SANITIZER_RAWTEXT_TAGS = frozenset(
+    {"script", "style", "textarea", "title", "xmp", "iframe", "noembed", "noframes", "noscript"}
+)
+SANITIZER_DROP_CONTENT_TAGS = SANITIZER_RAWTEXT_TAGS | {"object", "template", "svg", "math", "select", "head"}
+SANITIZER_MAX_DEPTH = 32
+SANITIZER_MAX_NAME_LEN = 32
+SANITIZER_MAX_CLASS_LEN = 512
+SANITIZER_ENTITY_HOLDBACK = 32
+SANITIZER_TAG_NAME_RE = re.compile(r"[^\s/>]*")
+SANITIZER_ATTR_NAME_RE = re.compile(r"[^\s/>=]*")
+SANITIZER_UNQUOTED_VALUE_RE = re.compile(r"[^\s>]*")
+SANITIZER_BEFORE_ATTR_RE = re.compile(r"[\s/]*")
+SANITIZER_SPACE_RE = re.compile(r"\s*")
+SANITIZER_RAWTEXT_END_RES = {
+    tag: re.compile(r"</" + tag + r"[\s/>]", re.IGNORECASE) for tag in SANITIZER_RAWTEXT_TAGS
+}
+
+# Per-stage model routing. Routes are matched in order on input size (image bytes
+# for OCR, prompt characters for analysis). The first healthy model of a route is
+# the primary; if it has not answered after hedge_after seconds, or fails, the
+# next model is raced against it and the first successful response wins.
+# Short analyses and follow-ups start on the cheaper nano model and hedge to mini;
+# OCR always starts on mini, where a misread line spoils the whole decode, so its
+# size classes only differ in how long the primary gets before the hedge.
+MODEL_ROUTES = {
+    "ocr": [
+        {"max_input": 1_500_000, "models": ["gpt-4.1-mini", "gpt-4.1-nano"], "hedge_after": 6.0},
+        {"max_input": None, "models": ["gpt-4.1-mini", "gpt-4.1-nano"], "hedge_after": 10.0},
+    ],
+    "analysis": [
+        {"max_input": 4000, "models": ["gpt-4.1-nano", "gpt-4.1-mini"], "hedge_after": 6.0},
+        {"max_input": None, "models": ["gpt-4.1-mini", "gpt-4.1-nano"], "hedge_after": 14.0},
+    ],
+    "followup": [
+        {"max_input": 4000, "models": ["gpt-4.1-nano", "gpt-4.1-mini"], "hedge_after": 4.0},
+        {"max_input": None, "models": ["gpt-4.1-mini", "gpt-4.1-nano"], "hedge_after": 6.0},
+    ],
+}
+# USD per million tokens: input, cached input, output. Model ids returned by the
+# API carry a date suffix and are matched to the longest key they start with.
+MODEL_PRICES = {
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+}
+MODEL_STATS_WINDOW = 50
+MODEL_MIN_SAMPLES = 5
+MODEL_MAX_ERROR_RATE = 0.5
+MODEL_ROUTER_THREADS = int(os.getenv("MODEL_ROUTER_THREADS", "16"))
+
+# Each decode keeps its transcript and verdict around so a few short follow-up
+# questions can be answered without re-running OCR or the full analysis.
+FOLLOWUPS_PER_DECODE = 3
+FOLLOWUP_RETENTION_HOURS = 48
+FOLLOWUP_DECODES_PER_USER = 5
+FOLLOWUP_MAX_QUESTION_CHARS = 500
+FOLLOWUP_MAX_TOKENS = 250
+# Upstream only caches prompt prefixes of at least PROMPT_CACHE_MIN_TOKENS tokens.
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CHARS_PER_TOKEN = 4
+
+# Screenshots are uploaded and OCR'd as soon as they are picked, while the user is
+# still typing context. The final submit references them by upload id.
+MAX_UPLOADS_PER_DECODE = 6
+UPLOAD_OCR_THREADS = int(os.getenv("UPLOAD_OCR_THREADS", "4"))
+UPLOAD_WAIT_SECONDS = 30
+UPLOAD_POLL_SECONDS = 0.25
+UPLOAD_RETENTION_MINUTES = 30
+# Uploads are OCR'd upstream before any decode is charged. A user may only hold as
+# many unused screenshots as their remaining decodes (at most UPLOAD_DECODES_AHEAD
+# of them) can take, and may upload at most UPLOADS_PER_WINDOW per retention window.
+UPLOAD_DECODES_AHEAD = 2
+UPLOADS_PER_WINDOW = 30
+
+# Decode admission control. Each process runs at most DECODE_SLOTS decodes at
+# once; free and batch requests never hold more than DECODE_SLOTS -
+# PAID_RESERVED_SLOTS each, and waiting requests are admitted by weighted round
+# robin across the classes. Batch items are paid for but nobody is watching them,
+# so they get the lowest weight and can wait longest.
+DECODE_SLOTS = int(os.getenv("DECODE_SLOTS", "6"))
+PAID_RESERVED_SLOTS = int(os.getenv("PAID_RESERVED_SLOTS", "2"))
+DECODE_CLASS_WEIGHTS = {"paid": 6, "free": 2, "batch": 1}
+DECODE_QUEUE_TIMEOUTS = {"paid": 60.0, "free": 20.0, "batch": 120.0}
+
+# OCR engines. "remote" (the default) uses the vision model only. Tesseract is
+# opt-in: it reads the words but not which bubble, and so which person, each line
+# came from, which the analysis depends on. "auto" runs Tesseract first and
+# escalates to the remote model when its mean word confidence (0-100) is below
+# OCR_LOCAL_MIN_CONFIDENCE, it finds too few words, or its queue is full;
+# "tesseract" uses it alone. "auto" behaves like "remote" when Tesseract is missing.
+OCR_ENGINE = os.getenv("OCR_ENGINE", "remote")
+OCR_LOCAL_WORKERS = int(os.getenv("OCR_LOCAL_WORKERS", "2"))
+OCR_LOCAL_MIN_CONFIDENCE = float(os.getenv("OCR_LOCAL_MIN_CONFIDENCE", "85"))
+OCR_LOCAL_MIN_WORDS = 3
+# Screenshots waiting for or running on a Tesseract worker, including ones whose
+# caller gave up; past this, new screenshots go straight to the remote engine.
+OCR_LOCAL_MAX_PENDING = int(os.getenv("OCR_LOCAL_MAX_PENDING", str(OCR_LOCAL_WORKERS * 2)))
+# Queue wait and run time have separate budgets, so a backlog fails over to the
+# remote engine quickly instead of using up the run timeout.
+OCR_LOCAL_QUEUE_SECONDS = 1.0
+OCR_LOCAL_TIMEOUT_SECONDS = 5.0
+OCR_LOCAL_POLL_SECONDS = 0.02
+
+# Repeat screenshots from the same user reuse that user's earlier transcript
+# instead of being OCR'd again; transcripts are never shared between users.
+# Identical bytes match on SHA-256. Re-encoded copies first match a 256-bit
+# difference hash within PHASH_MAX_DISTANCE bits and about the same aspect ratio,
+# which cannot tell two screenshots of one chat apart, then a finer
+# PHASH_FINE_SIZE grid of block means in which no cell may differ by more than
+# PHASH_FINE_MAX_DELTA, so changed text is OCR'd again. Each stored row keeps an
+# 8 KB fine grid. Needs Pillow; without it every image is OCR'd.
+PHASH_INDEX_SIZE = int(os.getenv("PHASH_INDEX_SIZE", "20000"))
+PHASH_GRID = 16
+PHASH_CHUNK_BITS = 16
+PHASH_MAX_DISTANCE = 12
+PHASH_MAX_ASPECT_DELTA = 0.03
+PHASH_SYNC_SECONDS = 5
+PHASH_FINE_SIZE = (64, 128)
+PHASH_FINE_MAX_DELTA = 18
+PHASH_VERIFY_CANDIDATES = 3
+
+# Decode ledger. One row per decode and stage (tokens, cost, latency, cache hits)
+# is buffered in memory and written in batches by a background thread, which also
+# folds the rows into daily totals, per-user totals and log-scale histograms so
+# the admin endpoints never scan decode_ledger itself.
+LEDGER_FLUSH_SECONDS = 5
+LEDGER_BATCH_SIZE = 200
+LEDGER_MAX_BUFFER = 10000
+LEDGER_BUCKET_GROWTH = 1.1
+LEDGER_HISTOGRAM_METRICS = ("latency_ms", "prompt_tokens", "completion_tokens", "cost_micros")
+LEDGER_PERCENTILES = {"p50": 0.5, "p90": 0.9, "p99": 0.99}
+LEDGER_TOP_USERS_MAX = 200
+
+# Overall budget for an interactive decode, kept under gunicorn's 30s worker
+# timeout. Each stage only gets what is left; when it runs out the page shows what
+# was finished and the decode is not charged.
+DECODE_DEADLINE_SECONDS = float(os.getenv("DECODE_DEADLINE_SECONDS", "25"))
+DEADLINE_MIN_CALL_SECONDS = 1.0
+
+# In-process cache of users rows. Writes go through it; Stripe credit changes made
+# by another worker are picked up from user_invalidations every few seconds.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = 60
+USER_CACHE_SYNC_SECONDS = 2
+USER_INVALIDATIONS_KEPT = 1000
+
+# Retention sweep of abandoned users rows: cookieless visitors and bots that never
+# decoded or bought anything and have not submitted for USER_RETENTION_DAYS
+# (free_uses_date moves to the current day on every visit that submits). One
+# worker per SWEEP_INTERVAL_SECONDS claims the run in sweep_runs. Rows are deleted
+# in small batches so decode writes never wait behind one long delete, and freed
+# pages are handed back to the filesystem with incremental vacuum.
+USER_RETENTION_DAYS = int(os.getenv("USER_RETENTION_DAYS", "30"))
+SWEEP_INTERVAL_SECONDS = int(os.getenv("SWEEP_INTERVAL_SECONDS", "3600"))
+SWEEP_BATCH_SIZE = 500
+SWEEP_BATCH_PAUSE_SECONDS = 0.05
+SWEEP_VACUUM_PAGES = 2000
+SWEEP_RUNS_KEPT = 500
+
+# Response compression. Pages that are the same for every visitor are rendered
+# and compressed once per process at the highest levels; everything else is
+# compressed on the way out at cheaper levels.
+COMPRESS_MIN_BYTES = 1024
+COMPRESSIBLE_MIMETYPES = frozenset({"text/html", "text/plain", "text/csv", "application/json"})
+GZIP_LEVELS = {"static": 9, "dynamic": 6}
+BROTLI_QUALITIES = {"static": 11, "dynamic": 5}
+
+# Logging runs through a bounded queue drained by a background thread, so request
+# threads never wait on stderr. Lines whose tag has a rate below 1 are sampled;
+# override with LOG_SAMPLE_RATES="[SUBMISSION]=0.5,[ROUTER]=0.1".
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_QUEUE_SIZE = 10000
+LOG_SAMPLE_RATES = {"[SUBMISSION]": 1.0, "[DECODE]": 1.0, "[ROUTER]": 0.25}
+LOG_SAMPLE_RATES.update(
+    (tag.strip(), float(rate))
+    for tag, _, rate in (entry.partition("=") for entry in os.getenv("LOG_SAMPLE_RATES", "").split(",") if entry)
+)
+
+# Request tracing. Every request collects spans into a thread-local list; a sample
+# of them, plus every request slower than TRACE_SLOW_MS, is kept for /_admin/traces,
+# which exports Chrome trace-event JSON (open it in Perfetto or chrome://tracing).
+# PROFILE_SAMPLE_RATE of requests also run a stack sampler on their thread.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "5000"))
+TRACES_KEPT = 200
+TRACE_MAX_SPANS = 2000
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_SECONDS = 0.005
+PROFILE_MAX_SECONDS = 30
+
+# Admin export of the users table. Pages are read with keyset cursors in separate
+# short reads, so a decode write waits for at most one page, never the export.
+EXPORT_PAGE_SIZE = 500
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+# JSON batch API. Every conversation in a batch is charged one paid decode credit.
+# Callers authenticate with an API key from POST /api/keys; only its SHA-256 is stored.
+API_KEY_PREFIX = "mil_"
+BATCH_MAX_ITEMS = 50
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_THREADS = int(os.getenv("BATCH_THREADS", "8"))
+
+
+# Hands records to a listener thread so a slow stderr reader cannot stall a
+# request. On a fast sink this is slightly slower than logging inline; see
+# benchmarks/logging_bench.py.
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, maxsize):
+        super().__init__(queue.SimpleQueue())
+        self.maxsize = maxsize
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Records never leave the process, so message formatting is left to the
+        # listener thread instead of being done here on the request thread.
+        return record
+
+    def enqueue(self, record):
+        # SimpleQueue is much cheaper to put to than Queue; bound it by size instead.
+        if self.queue.qsize() >= self.maxsize:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": dt.datetime.fromtimestamp(record.created, dt.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LogSampler(logging.Filter):
+    def filter(self, record):
+        msg = record.msg
+        if not isinstance(msg, str) or not msg.startswith("["):
+            return True
+        rate = LOG_SAMPLE_RATES.get(msg[: msg.find("]") + 1], 1.0)
+        if rate >= 1.0:
+            return True
+        if random.random() >= rate:
+            return False
+        record.fields = {**(getattr(record, "fields", None) or {}), "sample_rate": rate}
+        return True
+
+
+def configure_logging(stream=None):
+    handler = NonBlockingQueueHandler(LOG_QUEUE_SIZE)
+    handler.addFilter(LogSampler())
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [handler]
+
+    def start_listener():
+        # Threads do not survive fork, so each preforked worker starts its own.
+        handler.queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(handler.queue, output)
+        listener.start()
+        atexit.register(listener.stop)
+
+    start_listener()
+    os.register_at_fork(after_in_child=start_listener)
+    return handler
+
+
+def log_event(tag, **fields):
+    logger.info(tag, extra={"fields": fields})
+
+
+trace_state = threading.local()
+recent_traces = deque(maxlen=TRACES_KEPT)
+# Spans are timed with perf_counter; this turns them into wall-clock microseconds.
+TRACE_CLOCK_OFFSET = time.time() - time.perf_counter()
+
+
+def tracing_active():
+    return getattr(trace_state, "events", None) is not None
+
+
+def span_event(name, started, args):
+    return {
+        "name": name,
+        "ph": "X",
+        "ts": round((started + TRACE_CLOCK_OFFSET) * 1_000_000),
+        "dur": round((time.perf_counter() - started) * 1_000_000),
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": args,
+    }
+
+
+def record_span(name, started, **args):
+    events = getattr(trace_state, "events", None)
+    if events is not None and len(events) < TRACE_MAX_SPANS:
+        events.append(span_event(name, started, args))
+
+
+@contextmanager
+def span(name, **args):
+    # Yields the span's args so callers can attach results learned inside the block.
+    started = time.perf_counter()
+    try:
+        yield args
+    finally:
+        record_span(name, started, **args)
+
+
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    # Wall-clock sampler: threads blocked on a socket or a SQLite lock show up in
+    # the frame they are waiting in. Results are collapsed stacks ("a;b;c count"),
+    # the input format of flamegraph.pl and speedscope.
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL_SECONDS):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.thread_id is not None:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    self.stacks[collapse_stack(frame)] += 1
+                continue
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, str(ident))
+                if name != "stack-sampler":
+                    self.stacks[f"{name};{collapse_stack(frame)}"] += 1
+
+
+def format_collapsed(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
 
-logging.basicConfig(level=logging.INFO)
+
+log_handler = configure_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
 
 API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=API_KEY) if API_KEY else None
 
-if STRIPE_SECRET_KEY:
-    stripe.api_key = STRIPE_SECRET_KEY
+# The OpenAI and Stripe SDKs are slow to import, so they are only loaded the
+# first time a request needs them rather than in every booting worker.
+openai_client = None
+stripe_module = None
+lazy_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    global openai_client
+    if openai_client is None:
+        with lazy_client_lock:
+            if openai_client is None:
+                started = time.perf_counter()
+                from openai import OpenAI
+
+                openai_client = OpenAI(api_key=API_KEY)
+                STARTUP_TIMINGS["openai_client_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return openai_client
+
+
+def get_stripe():
+    global stripe_module
+    if stripe_module is None:
+        with lazy_client_lock:
+            if stripe_module is None:
+                started = time.perf_counter()
+                import stripe
+
+                if STRIPE_SECRET_KEY:
+                    stripe.api_key = STRIPE_SECRET_KEY
+                stripe_module = stripe
+                STARTUP_TIMINGS["stripe_import_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return stripe_module
+
 
 HTML_TEMPLATE = """
 <!doctype html>
@@ -395,6 +840,33 @@ HTML_TEMPLATE = """
         line-height: 1.35;
       }
 
+      /* Follow-up questions */
+
+      .followup {
+        margin-top: 18px;
+        padding-top: 14px;
+        border-top: 1px solid #2A2A32;
+      }
+
+      .followup-item {
+        margin-bottom: 12px;
+      }
+
+      .followup-item p {
+        margin: 4px 0;
+        color: #B8B8B8;
+        line-height: 1.35;
+      }
+
+      .followup-item .followup-question {
+        color: #F5F5F5;
+        font-weight: 600;
+      }
+
+      .followup textarea {
+        min-height: 60px;
+      }
+
       /* Loading spinner on button */
 
       .btn-spinner {
@@ -477,6 +949,7 @@ HTML_TEMPLATE = """
             <div class="step-label">Step 2</div>
             <div class="field-title">Add the conversation</div>
             <input type="file" name="images" id="images" accept="image/*" multiple>
+            <input type="hidden" name="upload_ids" id="upload-ids" value="">
             <p class="hint">Best option is 1 to 3 screenshots from your phone, earliest messages first. Assume you are the blue bubble.</p>
           </div>
 
@@ -510,6 +983,25 @@ HTML_TEMPLATE = """
     <div class="result-body">
       {{ result|safe }}
     </div>
+    {% if decode_id %}
+      <div class="followup">
+        <div id="followup-thread"></div>
+        <form id="followup-form" data-decode-id="{{ decode_id }}">
+          <textarea
+            name="question"
+            id="followup-question"
+            maxlength="{{ followup_max_chars }}"
+            placeholder="Ask a follow-up, like: is he pulling back or just busy this week?"></textarea>
+          <div class="button-row">
+            <button type="submit" id="followup-btn">
+              <span class="btn-label">Ask a follow-up</span>
+              <span class="btn-spinner" aria-hidden="true"></span>
+            </button>
+            <div class="button-caption" id="followup-left">{{ followups_left }} follow-up questions left for this decode.</div>
+          </div>
+        </form>
+      </div>
+    {% endif %}
   </div>
 {% endif %}
 
@@ -570,6 +1062,87 @@ HTML_TEMPLATE = """
       });
     }
 
+    var imagesInput = document.getElementById("images");
+    var uploadIdsInput = document.getElementById("upload-ids");
+    if (imagesInput && uploadIdsInput) {
+      var uploadGeneration = 0;
+      imagesInput.addEventListener("change", async function () {
+        var generation = ++uploadGeneration;
+        var previousIds = uploadIdsInput.value;
+        uploadIdsInput.value = "";
+        imagesInput.setAttribute("name", "images");
+
+        var data = new FormData();
+        // Screenshots picked earlier are replaced; the server stops their OCR.
+        if (previousIds) data.append("replaces", previousIds);
+        if (!imagesInput.files.length) {
+          if (previousIds) fetch("/upload", { method: "POST", body: data }).catch(function () {});
+          return;
+        }
+        Array.prototype.forEach.call(imagesInput.files, function (file) {
+          data.append("images", file);
+        });
+        try {
+          const response = await fetch("/upload", { method: "POST", body: data });
+          if (!response.ok) return;
+          const payload = await response.json();
+          if (generation !== uploadGeneration || !payload.upload_ids || !payload.upload_ids.length) return;
+          // The screenshots are already on the server, so the final submit only sends their ids.
+          uploadIdsInput.value = payload.upload_ids.join(",");
+          imagesInput.removeAttribute("name");
+        } catch (e) {
+          console.error("Upload error:", e);
+        }
+      });
+    }
+
+    var followupForm = document.getElementById("followup-form");
+    if (followupForm) {
+      var followupBtn = document.getElementById("followup-btn");
+      var followupQuestion = document.getElementById("followup-question");
+      var followupThread = document.getElementById("followup-thread");
+      var followupLeft = document.getElementById("followup-left");
+
+      followupForm.addEventListener("submit", async function (event) {
+        event.preventDefault();
+        var question = followupQuestion.value.trim();
+        if (!question || followupBtn.classList.contains("loading")) return;
+
+        followupBtn.classList.add("loading");
+        followupBtn.disabled = true;
+        try {
+          const response = await fetch("/followup", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ decode_id: followupForm.dataset.decodeId, question: question })
+          });
+          const data = await response.json();
+          if (!response.ok) {
+            throw new Error(data.error || "Follow-up failed");
+          }
+          var item = document.createElement("div");
+          item.className = "followup-item";
+          var asked = document.createElement("p");
+          asked.className = "followup-question";
+          asked.textContent = question;
+          item.appendChild(asked);
+          item.insertAdjacentHTML("beforeend", data.answer);
+          followupThread.appendChild(item);
+          followupQuestion.value = "";
+          followupLeft.textContent = data.followups_left + " follow-up questions left for this decode.";
+          if (data.followups_left <= 0) {
+            followupQuestion.disabled = true;
+            return;
+          }
+        } catch (e) {
+          console.error("Follow-up error:", e);
+          alert(e.message || "Follow-up could not be answered. Please try again in a moment.");
+        }
+        followupBtn.classList.remove("loading");
+        followupBtn.disabled = false;
+      });
+    }
+
     var packButtons = document.querySelectorAll(".js-pack-btn");
     if (packButtons.length) {
       packButtons.forEach(function (btn) {
@@ -609,6 +1182,11 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# Upstream prompt caching only reuses an exact byte prefix of the request, so every
+# message list is built static-first: system prompts and fixed labels, then
+# per-decode content, then the part that changes between calls. Follow-ups on a
+# decode long enough to be cached extend its analysis request, so that cached
+# prefix is reused for them. tests/test_prompt_prefixes.py checks the builders.
 OCR_SYSTEM_PROMPT = (
     "You are an OCR engine. Extract only the visible text from this screenshot "
     "of a messaging conversation. Do not add explanation, labels, or commentary."
@@ -667,52 +1245,87 @@ Guidelines:
 - Your entire job is to decode what the other person was probably trying to signal.
 """
 
+FOLLOWUP_SYSTEM_PROMPT = """
+You already decoded this conversation above. The user has a short follow-up question about it.
+
+Rules:
+- Answer in at most 80 words, clear, honest and a little blunt.
+- Stay focused on the other person's likely motives and signals.
+- Do not recap the conversation or repeat your earlier verdict.
+- Return only one or two <p> elements, with no other HTML.
+"""
+
+
+class TracedConnection(sqlite3.Connection):
+    # Busy-timeout waits on a locked database happen inside execute() and commit(),
+    # so these spans include SQLite lock waits.
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    def execute(self, sql, parameters=()):
+        if not tracing_active():
+            return super().execute(sql, parameters)
+        with span("sqlite.execute", sql=" ".join(sql.split())[:80]):
+            return super().execute(sql, parameters)
+
+    def commit(self):
+        if not tracing_active():
+            return super().commit()
+        with span("sqlite.commit"):
+            return super().commit()
+
+
+class SqliteShardBackend:
+    # Storage backends hand out DB-API connections whose rows support
+    # row["column"] access and that accept the qmark SQL used in this module.
+    # Per-user tables live on the shard picked by shard_for(user_id); global
+    # tables live on the main connection.
+
+    def __init__(self, main_path, shard_count):
+        self.shard_count = shard_count
+        self.paths = sqlite_shard_paths(main_path, shard_count)
+
+    def shard_for(self, user_id):
+        return shard_index(user_id, self.shard_count)
+
+    def shards(self):
+        return range(self.shard_count)
+
+    def connect(self, shard):
+        with span("sqlite.connect", shard=shard):
+            conn = sqlite3.connect(self.paths[shard], factory=TracedConnection)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def connect_main(self):
+        return self.connect(0)
+
+
+STORAGE_BACKENDS = {"sqlite": SqliteShardBackend}
+
+storage = STORAGE_BACKENDS[STORAGE_BACKEND](DB_PATH, USER_SHARDS)
+
+
+def get_db_connection(user_id=None):
+    if user_id is None:
+        return storage.connect_main()
+    return storage.connect(storage.shard_for(user_id))
 
 
 def init_db():
+    started = time.perf_counter()
+    applied = 0
     try:
-        with get_db_connection() as conn:
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    id TEXT PRIMARY KEY,
-                    created_at TEXT NOT NULL,
-                    free_uses_today INTEGER NOT NULL DEFAULT 0,
-                    free_uses_date TEXT,
-                    total_decodes INTEGER NOT NULL DEFAULT 0,
-                    last_decode_at TEXT,
-                    is_paid INTEGER NOT NULL DEFAULT 0,
-                    followup_credits INTEGER NOT NULL DEFAULT 0,
-                    paid_decode_credits INTEGER NOT NULL DEFAULT 0,
-                    lifetime_paid_decodes INTEGER NOT NULL DEFAULT 0
-                )
-                """
-            )
-            conn.commit()
-            migrate_db(conn)
+        for shard in storage.shards():
+            with storage.connect(shard) as conn:
+                # Only takes effect on a new, empty file; older files need one
+                # manual VACUUM before the sweeper can shrink them.
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                applied += apply_migrations(conn, "user")
+        with storage.connect_main() as conn:
+            applied += apply_migrations(conn, "main")
     except Exception:
         logger.exception("Database init failed")
-
-
-def migrate_db(conn):
-    columns = {row["name"] for row in conn.execute("PRAGMA table_info(users)").fetchall()}
-    additions = []
-    if "paid_decode_credits" not in columns:
-        additions.append("ALTER TABLE users ADD COLUMN paid_decode_credits INTEGER NOT NULL DEFAULT 0")
-    if "lifetime_paid_decodes" not in columns:
-        additions.append("ALTER TABLE users ADD COLUMN lifetime_paid_decodes INTEGER NOT NULL DEFAULT 0")
-    for statement in additions:
-        try:
-            conn.execute(statement)
-        except Exception:
-            logger.exception("Database migration failed")
-    if additions:
-        conn.commit()
+    STARTUP_TIMINGS["init_db_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    STARTUP_TIMINGS["migrations_applied"] = applied
 
 
 def get_or_create_user_id(req):
@@ -722,26 +1335,142 @@ def get_or_create_user_id(req):
     return str(uuid.uuid4()), True
 
 
-def load_or_create_user(user_id):
+class UserCache:
+    # LRU of users rows with a TTL. Rows carry the users.version column, so a
+    # stale read never replaces a newer write-through row, and an invalidation
+    # only drops entries older than the version it names.
+
+    def __init__(self, max_entries, ttl):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._next_sync = 0.0
+        self._seen_seq = None
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, user_id):
+        self._sync()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(user_id, None)
+                self._misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, row):
+        if row is None:
+            return
+        with self._lock:
+            current = self._entries.get(row["id"])
+            if current is not None and current[1]["version"] > row["version"]:
+                return
+            self._entries[row["id"]] = (time.monotonic() + self._ttl, row)
+            self._entries.move_to_end(row["id"])
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def publish(self, row):
+        # Write-through for a row changed outside a user's own requests (Stripe
+        # credits): cache it here and have every other worker drop older copies
+        # on its next sync. The log lives on the main database, so request-path
+        # writes use put() instead and never take that shared write lock; the
+        # charges enforce limits in SQL and the submit path reads the row fresh.
+        self.put(row)
+        if row is None:
+            return
+        try:
+            with get_db_connection() as conn:
+                conn.execute(
+                    "INSERT INTO user_invalidations (user_id, version, created_at) VALUES (?, ?, ?)",
+                    (row["id"], row["version"], dt.datetime.now(dt.timezone.utc).isoformat()),
+                )
+                conn.execute(
+                    "DELETE FROM user_invalidations WHERE seq <= (SELECT MAX(seq) FROM user_invalidations) - ?",
+                    (USER_INVALIDATIONS_KEPT,),
+                )
+                conn.commit()
+        except Exception:
+            logger.exception("Failed to publish user invalidation")
+
+    def invalidate(self, user_id, version=None):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and (version is None or entry[1]["version"] < version):
+                del self._entries[user_id]
+
+    def _sync(self):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_sync:
+                return
+            self._next_sync = now + USER_CACHE_SYNC_SECONDS
+            seen_seq = self._seen_seq
+        try:
+            with get_db_connection() as conn:
+                if seen_seq is None:
+                    rows = []
+                    latest = conn.execute("SELECT COALESCE(MAX(seq), 0) AS seq FROM user_invalidations").fetchone()
+                    seen_seq = latest["seq"]
+                else:
+                    rows = conn.execute(
+                        "SELECT seq, user_id, version FROM user_invalidations WHERE seq > ? ORDER BY seq",
+                        (seen_seq,),
+                    ).fetchall()
+        except Exception:
+            logger.exception("User cache sync failed")
+            return
+        for row in rows:
+            self.invalidate(row["user_id"], row["version"])
+            seen_seq = row["seq"]
+        with self._lock:
+            self._seen_seq = seen_seq
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 3) if lookups else None,
+            }
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+
+
+def load_or_create_user(user_id, fresh=False, create=True):
+    if not fresh:
+        row = user_cache.get(user_id)
+        if row is not None:
+            return row
     try:
-        with get_db_connection() as conn:
+        with get_db_connection(user_id) as conn:
             row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-            if row:
-                return row
-            created_at = dt.datetime.now(dt.timezone.utc).isoformat()
-            conn.execute(
-                """
-                INSERT INTO users (
-                    id, created_at, free_uses_today, free_uses_date,
-                    total_decodes, last_decode_at, is_paid, followup_credits,
-                    paid_decode_credits, lifetime_paid_decodes
-                )
-                VALUES (?, ?, 0, ?, 0, NULL, 0, 0, 0, 0)
-                """,
-                (user_id, created_at, created_at[:10]),
-            )
-            conn.commit()
-            return conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+            if not row and not create:
+                return None
+            if not row:
+                created_at = dt.datetime.now(dt.timezone.utc).isoformat()
+                row = conn.execute(
+                    """
+                    INSERT INTO users (
+                        id, created_at, free_uses_today, free_uses_date,
+                        total_decodes, last_decode_at, is_paid, followup_credits,
+                        paid_decode_credits, lifetime_paid_decodes
+                    )
+                    VALUES (?, ?, 0, ?, 0, NULL, 0, 0, 0, 0)
+                    RETURNING *
+                    """,
+                    (user_id, created_at, created_at[:10]),
+                ).fetchone()
+                conn.commit()
+        user_cache.put(row)
+        return row
     except Exception:
         logger.exception("Database load/create failed")
         return None
@@ -754,12 +1483,18 @@ def reset_daily_counter_if_needed(user_row):
     if user_row["free_uses_date"] == today:
         return False
     try:
-        with get_db_connection() as conn:
-            conn.execute(
-                "UPDATE users SET free_uses_today = 0, free_uses_date = ? WHERE id = ?",
+        with get_db_connection(user_row["id"]) as conn:
+            row = conn.execute(
+                """
+                UPDATE users
+                SET free_uses_today = 0, free_uses_date = ?, version = version + 1
+                WHERE id = ?
+                RETURNING *
+                """,
                 (today, user_row["id"]),
-            )
+            ).fetchone()
             conn.commit()
+        user_cache.put(row)
         return True
     except Exception:
         logger.exception("Failed to reset daily counter")
@@ -767,193 +1502,2710 @@ def reset_daily_counter_if_needed(user_row):
 
 
 def increment_usage(user_row):
+    # The daily limit is enforced here, in the UPDATE itself, not by the cached
+    # row: other workers may have counted uses this one has not seen. Returns the
+    # charge, which refund_usage needs to undo it, or None over the limit.
     if not user_row:
-        return False
+        return None
     now = dt.datetime.now(dt.timezone.utc).isoformat()
     today = now[:10]
     try:
-        with get_db_connection() as conn:
-            conn.execute(
+        with get_db_connection(user_row["id"]) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            previous = conn.execute("SELECT last_decode_at FROM users WHERE id = ?", (user_row["id"],)).fetchone()
+            row = conn.execute(
                 """
                 UPDATE users
-                SET free_uses_today = free_uses_today + ?,
+                SET free_uses_today = CASE WHEN free_uses_date = ? THEN free_uses_today + 1 ELSE 1 END,
                     free_uses_date = ?,
                     total_decodes = total_decodes + 1,
-                    last_decode_at = ?
+                    last_decode_at = ?,
+                    version = version + 1
+                WHERE id = ? AND (free_uses_date IS NOT ? OR free_uses_today < ?)
+                RETURNING *
+                """,
+                (today, today, now, user_row["id"], today, FREE_DECODES_PER_DAY),
+            ).fetchone()
+            conn.commit()
+        if row is None:
+            user_cache.invalidate(user_row["id"])
+            return None
+        user_cache.put(row)
+        return {"charged_at": now, "previous_decode_at": previous["last_decode_at"]}
+    except Exception:
+        logger.exception("Failed to increment usage")
+        return None
+
+
+def refund_usage(user_row, charge):
+    if not user_row or not charge:
+        return False
+    try:
+        with get_db_connection(user_row["id"]) as conn:
+            # The free use only comes back if the day has not rolled over since.
+            row = conn.execute(
+                """
+                UPDATE users
+                SET free_uses_today = CASE
+                        WHEN free_uses_date = ? THEN MAX(free_uses_today - 1, 0) ELSE free_uses_today
+                    END,
+                    total_decodes = total_decodes - 1,
+                    last_decode_at = CASE WHEN last_decode_at = ? THEN ? ELSE last_decode_at END,
+                    version = version + 1
                 WHERE id = ?
+                RETURNING *
                 """,
-                (1, today, now, user_row["id"]),
-            )
+                (charge["charged_at"][:10], charge["charged_at"], charge["previous_decode_at"], user_row["id"]),
+            ).fetchone()
             conn.commit()
+        user_cache.put(row)
         return True
     except Exception:
-        logger.exception("Failed to increment usage")
+        logger.exception("Failed to refund free use")
         return False
 
 
 def increment_usage_paid(user_row):
+    # Returns the charge, which refund_usage_paid needs to undo it, or None.
     if not user_row:
-        return False
+        return None
     now = dt.datetime.now(dt.timezone.utc).isoformat()
     today = now[:10]
     try:
-        with get_db_connection() as conn:
-            conn.execute(
+        with get_db_connection(user_row["id"]) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            previous = conn.execute("SELECT last_decode_at FROM users WHERE id = ?", (user_row["id"],)).fetchone()
+            row = conn.execute(
                 """
                 UPDATE users
                 SET paid_decode_credits = paid_decode_credits - 1,
                     lifetime_paid_decodes = lifetime_paid_decodes + 1,
                     free_uses_date = ?,
                     total_decodes = total_decodes + 1,
-                    last_decode_at = ?
+                    last_decode_at = ?,
+                    version = version + 1
                 WHERE id = ? AND paid_decode_credits > 0
+                RETURNING *
                 """,
                 (today, now, user_row["id"]),
-            )
+            ).fetchone()
             conn.commit()
-        return True
+        if row is None:
+            user_cache.invalidate(user_row["id"])
+            return None
+        user_cache.put(row)
+        return {"charged_at": now, "previous_decode_at": previous["last_decode_at"]}
     except Exception:
         logger.exception("Failed to decrement paid credits")
-        return False
-
-
-def stripe_enabled():
-    return bool(
-        STRIPE_SECRET_KEY
-        and STRIPE_WEBHOOK_SECRET
-        and STRIPE_PRICE_DECODE_10
-        and STRIPE_PRICE_DECODE_25
-        and STRIPE_PRICE_DECODE_50
-    )
+        return None
 
 
-def strip_disallowed_html(raw_html):
-    if not raw_html:
-        return raw_html
+def refund_usage_paid(user_row, charge):
+    if not user_row or not charge:
+        return False
+    try:
+        with get_db_connection(user_row["id"]) as conn:
+            # last_decode_at goes back only if no later decode has stamped it since.
+            row = conn.execute(
+                """
+                UPDATE users
+                SET paid_decode_credits = paid_decode_credits + 1,
+                    lifetime_paid_decodes = lifetime_paid_decodes - 1,
+                    total_decodes = total_decodes - 1,
+                    last_decode_at = CASE WHEN last_decode_at = ? THEN ? ELSE last_decode_at END,
+                    version = version + 1
+                WHERE id = ?
+                RETURNING *
+                """,
+                (charge["charged_at"], charge["previous_decode_at"], user_row["id"]),
+            ).fetchone()
+            conn.commit()
+        user_cache.put(row)
+        return True
+    except Exception:
+        logger.exception("Failed to refund paid credit")
+        return False
 
-    sanitized = re.sub(r"<script[^>]*>.*?</script>", "", raw_html, flags=re.DOTALL | re.IGNORECASE)
-    sanitized = re.sub(r"<style[^>]*>.*?</style>", "", sanitized, flags=re.DOTALL | re.IGNORECASE)
-    sanitized = re.sub(r"<link[^>]*?>", "", sanitized, flags=re.DOTALL | re.IGNORECASE)
-    return sanitized.strip()
 
+def save_decode(user_row, context, transcript, verdict):
+    if not user_row:
+        return None
+    decode_id = str(uuid.uuid4())
+    now = dt.datetime.now(dt.timezone.utc)
+    cutoff = (now - dt.timedelta(hours=FOLLOWUP_RETENTION_HOURS)).isoformat()
+    try:
+        with get_db_connection(user_row["id"]) as conn:
+            conn.execute(
+                """
+                INSERT INTO decodes (id, user_id, created_at, context, transcript, verdict, followups_left)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (decode_id, user_row["id"], now.isoformat(), context, transcript, verdict, FOLLOWUPS_PER_DECODE),
+            )
+            conn.execute("DELETE FROM decodes WHERE created_at < ?", (cutoff,))
+            conn.execute(
+                """
+                DELETE FROM decodes
+                WHERE user_id = ? AND id NOT IN (
+                    SELECT id FROM decodes WHERE user_id = ? ORDER BY created_at DESC LIMIT ?
+                )
+                """,
+                (user_row["id"], user_row["id"], FOLLOWUP_DECODES_PER_USER),
+            )
+            conn.commit()
+        return decode_id
+    except Exception:
+        logger.exception("Failed to save decode for follow-ups")
+        return None
 
-def extract_text_from_images(files):
-    if not files:
-        return ""
 
-    all_text = []
+def load_decode(user_id, decode_id):
+    cutoff = (dt.datetime.now(dt.timezone.utc) - dt.timedelta(hours=FOLLOWUP_RETENTION_HOURS)).isoformat()
+    try:
+        with get_db_connection(user_id) as conn:
+            return conn.execute(
+                "SELECT * FROM decodes WHERE id = ? AND user_id = ? AND created_at >= ?",
+                (decode_id, user_id, cutoff),
+            ).fetchone()
+    except Exception:
+        logger.exception("Failed to load decode")
+        return None
 
-    for img in files:
-        if not img or img.filename == "":
-            continue
 
-        try:
-            img_bytes = img.read()
-            if not img_bytes:
-                continue
+def reserve_followup_credit(user_id, decode_id):
+    # Taken before the upstream call, so concurrent questions cannot all be
+    # answered (and paid for upstream) against the last credit.
+    try:
+        with get_db_connection(user_id) as conn:
+            row = conn.execute(
+                """
+                UPDATE decodes
+                SET followups_left = followups_left - 1
+                WHERE id = ? AND user_id = ? AND followups_left > 0
+                RETURNING followups_left
+                """,
+                (decode_id, user_id),
+            ).fetchone()
+            conn.commit()
+        return row["followups_left"] if row else None
+    except Exception:
+        logger.exception("Failed to reserve follow-up credit")
+        return None
 
-            b64 = base64.b64encode(img_bytes).decode("utf-8")
 
-            resp = client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[
-                    {"role": "system", "content": OCR_SYSTEM_PROMPT},
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": OCR_USER_PROMPT},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{b64}"
-                                },
-                            },
-                        ],
-                    },
-                ],
-                temperature=0.0,
+def refund_followup_credit(user_id, decode_id):
+    try:
+        with get_db_connection(user_id) as conn:
+            conn.execute(
+                "UPDATE decodes SET followups_left = followups_left + 1 WHERE id = ? AND user_id = ?",
+                (decode_id, user_id),
             )
+            conn.commit()
+    except Exception:
+        logger.exception("Failed to refund follow-up credit")
 
-            text_chunk = resp.choices[0].message.content.strip()
-            if text_chunk:
-                all_text.append(text_chunk)
-
-        except Exception:
-            logger.exception("OCR failed for an uploaded image")
 
-    return "\n\n".join(all_text).strip()
+def stripe_config_problems():
+    problems = []
+    if not STRIPE_SECRET_KEY:
+        problems.append("STRIPE_SECRET_KEY is not set")
+    if not STRIPE_WEBHOOK_SECRET:
+        problems.append("STRIPE_WEBHOOK_SECRET is not set")
+    for pack, price_id in STRIPE_PRICES.items():
+        if not price_id:
+            problems.append(f"STRIPE_PRICE_DECODE_{pack} is not set")
+    return problems
 
 
-def build_analysis_input(context, conversation_text):
-    return (
-        f"Context: {context or 'none provided'}\n\n"
-        "Text conversation (from screenshots and/or pasted text):\n"
-        f"{conversation_text}"
-    )
+# Checked once at import; configuration only changes with a redeploy.
+STRIPE_CONFIG_PROBLEMS = stripe_config_problems()
+STRIPE_ENABLED = not STRIPE_CONFIG_PROBLEMS
+checkout_locks = [threading.Lock() for _ in range(64)]
 
 
-@app.route("/_admin/usage")
-def admin_usage():
-    if not ADMIN_TOKEN:
-        return ("Not Found", 404)
+def checkout_lock(user_id, pack):
+    # Double clicks from one user wait for the first Stripe call instead of
+    # creating a second session.
+    return checkout_locks[hash((user_id, pack)) % len(checkout_locks)]
 
-    token = request.args.get("token", "")
-    if token != ADMIN_TOKEN:
-        return ("Forbidden", 403)
 
+def load_checkout_session(user_id, pack, base_url):
     try:
-        with get_db_connection() as conn:
-            totals = conn.execute(
-                """
-                SELECT
-                    COUNT(*) AS users,
-                    COALESCE(SUM(total_decodes), 0) AS total_decodes,
-                    COALESCE(SUM(free_uses_today), 0) AS free_uses_today
-                FROM users
-                """
+        with get_db_connection(user_id) as conn:
+            row = conn.execute(
+                "SELECT url, base_url, expires_at FROM checkout_sessions WHERE user_id = ? AND pack = ?",
+                (user_id, pack),
             ).fetchone()
-
-        return jsonify(
-            users=totals["users"],
-            total_decodes=totals["total_decodes"],
-            free_uses_today=totals["free_uses_today"],
-        )
     except Exception:
-        logger.exception("Admin usage lookup failed")
-        return ("Server error", 500)
-
+        logger.exception("Failed to load checkout session")
+        return None
+    if not row or row["base_url"] != base_url:
+        return None
+    if row["expires_at"] - CHECKOUT_REUSE_MARGIN_SECONDS <= time.time():
+        return None
+    return row["url"]
 
-@app.route("/create-checkout-session/decode-pack", methods=["POST"])
-def create_checkout_session():
-    if not stripe_enabled():
-        return jsonify(error="Stripe is not configured"), 400
 
-    user_id, needs_cookie = get_or_create_user_id(request)
+def save_checkout_session(user_id, pack, base_url, session):
+    expires_at = getattr(session, "expires_at", None)
+    if not expires_at:
+        return
+    try:
+        with get_db_connection(user_id) as conn:
+            conn.execute(
+                """
+                INSERT INTO checkout_sessions (id, user_id, pack, url, base_url, created_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, pack) DO UPDATE SET
+                    id = excluded.id,
+                    url = excluded.url,
+                    base_url = excluded.base_url,
+                    created_at = excluded.created_at,
+                    expires_at = excluded.expires_at
+                """,
+                (
+                    session.id,
+                    user_id,
+                    pack,
+                    session.url,
+                    base_url,
+                    dt.datetime.now(dt.timezone.utc).isoformat(),
+                    int(expires_at),
+                ),
+            )
+            conn.execute("DELETE FROM checkout_sessions WHERE expires_at < ?", (int(time.time()),))
+            conn.commit()
+    except Exception:
+        logger.exception("Failed to save checkout session")
+
+
+def discard_checkout_sessions(user_id, session_id=None):
+    try:
+        with get_db_connection(user_id) as conn:
+            if session_id is None:
+                conn.execute("DELETE FROM checkout_sessions WHERE user_id = ?", (user_id,))
+            else:
+                conn.execute(
+                    "DELETE FROM checkout_sessions WHERE user_id = ? AND id = ?",
+                    (user_id, session_id),
+                )
+            conn.commit()
+    except Exception:
+        logger.exception("Failed to discard checkout sessions")
+
+
+class HtmlSanitizer:
+    # Allowlist sanitizer driven by a small HTML tokenizer state machine. Input is
+    # consumed exactly once: partial tokens are carried across feed() calls as
+    # state, and only a bounded tail (a split entity, comment or end tag) is ever
+    # re-read. feed() returns the safe HTML produced so far, close() flushes the
+    # rest and closes any tags the model left open.
+
+    def __init__(self):
+        self._pending = ""
+        self._state = "data"
+        self._out = []
+        self._open = []
+        self._drop_depth = 0
+        self._rawtext_end = None
+        self._tag_name = ""
+        self._is_end_tag = False
+        self._self_closing = False
+        self._attr_name = ""
+        self._attr_value = ""
+        self._quote = ""
+        self._classes = []
+
+    def feed(self, chunk):
+        self._pending += chunk
+        self._run(final=False)
+        return self._drain()
+
+    def close(self):
+        self._run(final=True)
+        if self._state == "tag_open":
+            self._text("<")
+        self._pending = ""
+        self._state = "data"
+        while self._open:
+            self._out.append(f"</{self._open.pop()}>")
+        return self._drain()
+
+    def _drain(self):
+        chunk = "".join(self._out)
+        self._out = []
+        return chunk
+
+    def _run(self, final):
+        buf = self._pending
+        n = len(buf)
+        i = 0
+        while i < n:
+            state = self._state
+            if state == "data":
+                j = buf.find("<", i)
+                if j == -1:
+                    end = n if final else self._entity_holdback(buf, i)
+                    self._text(buf[i:end])
+                    i = end
+                    break
+                self._text(buf[i:j])
+                i = j + 1
+                self._state = "tag_open"
+            elif state == "tag_open":
+                c = buf[i]
+                if c == "/":
+                    i += 1
+                    self._state = "end_tag_open"
+                elif c == "!":
+                    i += 1
+                    self._state = "markup_decl"
+                elif c == "?":
+                    self._state = "bogus_comment"
+                elif c.isascii() and c.isalpha():
+                    self._begin_tag(is_end=False)
+                else:
+                    self._text("<")
+                    self._state = "data"
+            elif state == "end_tag_open":
+                c = buf[i]
+                if c.isascii() and c.isalpha():
+                    self._begin_tag(is_end=True)
+                elif c == ">":
+                    i += 1
+                    self._state = "data"
+                else:
+                    self._state = "bogus_comment"
+            elif state == "markup_decl":
+                if n - i < 2 and not final:
+                    break
+                if buf.startswith("--", i):
+                    i += 2
+                    self._state = "comment"
+                else:
+                    self._state = "bogus_comment"
+            elif state == "comment":
+                j = buf.find("-->", i)
+                if j == -1:
+                    i = max(i, n - 2)
+                    break
+                i = j + 3
+                self._state = "data"
+            elif state == "bogus_comment":
+                j = buf.find(">", i)
+                if j == -1:
+                    i = n
+                    break
+                i = j + 1
+                self._state = "data"
+            elif state == "rawtext":
+                match = self._rawtext_end.search(buf, i)
+                if not match:
+                    i = max(i, n - SANITIZER_MAX_NAME_LEN)
+                    break
+                i = match.start() + 1
+                self._state = "tag_open"
+            elif state == "tag_name":
+                match = SANITIZER_TAG_NAME_RE.match(buf, i)
+                self._tag_name = (self._tag_name + match.group())[:SANITIZER_MAX_NAME_LEN]
+                i = match.end()
+                if i < n:
+                    self._state = "before_attr_name"
+            elif state == "before_attr_name":
+                end = SANITIZER_BEFORE_ATTR_RE.match(buf, i).end()
+                if end > i:
+                    # "/" right before ">" makes a self-closing tag, as in <svg/>.
+                    self._self_closing = buf[end - 1] == "/"
+                i = end
+                if i == n:
+                    break
+                if buf[i] == ">":
+                    i += 1
+                    self._finish_tag()
+                else:
+                    self._attr_name = ""
+                    self._self_closing = False
+                    self._state = "attr_name"
+            elif state == "attr_name":
+                match = SANITIZER_ATTR_NAME_RE.match(buf, i)
+                self._attr_name = (self._attr_name + match.group())[:SANITIZER_MAX_NAME_LEN]
+                i = match.end()
+                if i == n:
+                    break
+                if buf[i] == "=":
+                    i += 1
+                    self._state = "before_attr_value"
+                else:
+                    self._state = "after_attr_name"
+            elif state == "after_attr_name":
+                i = SANITIZER_SPACE_RE.match(buf, i).end()
+                if i == n:
+                    break
+                c = buf[i]
+                if c == "=":
+                    i += 1
+                    self._state = "before_attr_value"
+                elif c in "/>":
+                    self._state = "before_attr_name"
+                else:
+                    self._attr_name = ""
+                    self._state = "attr_name"
+            elif state == "before_attr_value":
+                i = SANITIZER_SPACE_RE.match(buf, i).end()
+                if i == n:
+                    break
+                c = buf[i]
+                self._attr_value = ""
+                if c in "\"'":
+                    i += 1
+                    self._quote = c
+                    self._state = "attr_value_quoted"
+                elif c == ">":
+                    self._state = "before_attr_name"
+                else:
+                    self._state = "attr_value_unquoted"
+            elif state == "attr_value_quoted":
+                j = buf.find(self._quote, i)
+                end = n if j == -1 else j
+                self._add_attr_value(buf[i:end])
+                if j == -1:
+                    i = n
+                    break
+                i = j + 1
+                self._commit_attr()
+            elif state == "attr_value_unquoted":
+                match = SANITIZER_UNQUOTED_VALUE_RE.match(buf, i)
+                self._add_attr_value(match.group())
+                i = match.end()
+                if i < n:
+                    self._commit_attr()
+        self._pending = buf[i:]
+
+    def _entity_holdback(self, buf, start):
+        # Keep a trailing "&..." back until the next chunk so a character
+        # reference split across chunks is decoded as a whole.
+        amp = buf.rfind("&", max(start, len(buf) - SANITIZER_ENTITY_HOLDBACK))
+        if amp != -1 and ";" not in buf[amp:]:
+            return amp
+        return len(buf)
+
+    def _text(self, data):
+        if data and not self._drop_depth:
+            self._out.append(html.escape(html.unescape(data), quote=False))
+
+    def _begin_tag(self, is_end):
+        self._is_end_tag = is_end
+        self._self_closing = False
+        self._tag_name = ""
+        self._classes = []
+        self._state = "tag_name"
+
+    def _add_attr_value(self, value):
+        if self._attr_name.lower() == "class" and len(self._attr_value) < SANITIZER_MAX_CLASS_LEN:
+            self._attr_value = (self._attr_value + value)[:SANITIZER_MAX_CLASS_LEN]
+
+    def _commit_attr(self):
+        if self._attr_name.lower() == "class":
+            self._classes.extend(
+                c for c in html.unescape(self._attr_value).split() if c in SANITIZER_ALLOWED_CLASSES
+            )
+        self._attr_value = ""
+        self._state = "before_attr_name"
+
+    def _finish_tag(self):
+        tag = self._tag_name.lower()
+        self._state = "data"
+        if self._is_end_tag:
+            self._end_tag(tag)
+            return
+        self._start_tag(tag)
+        if tag in SANITIZER_RAWTEXT_TAGS:
+            self._rawtext_end = SANITIZER_RAWTEXT_END_RES[tag]
+            self._state = "rawtext"
+
+    def _start_tag(self, tag):
+        if tag in SANITIZER_DROP_CONTENT_TAGS:
+            # A self-closing <svg/> has no content and no end tag to leave drop
+            # mode. Raw text tags ignore the slash, as browsers do.
+            if not self._self_closing or tag in SANITIZER_RAWTEXT_TAGS:
+                self._drop_depth += 1
+            return
+        if self._drop_depth or tag not in SANITIZER_ALLOWED_TAGS:
+            return
+
+        class_attr = f' class="{" ".join(self._classes)}"' if self._classes else ""
+        if tag in SANITIZER_VOID_TAGS:
+            self._out.append(f"<{tag}{class_attr}>")
+            return
+        if len(self._open) >= SANITIZER_MAX_DEPTH:
+            return
+        self._open.append(tag)
+        self._out.append(f"<{tag}{class_attr}>")
+
+    def _end_tag(self, tag):
+        if tag in SANITIZER_DROP_CONTENT_TAGS:
+            if self._drop_depth:
+                self._drop_depth -= 1
+            return
+        if self._drop_depth or tag in SANITIZER_VOID_TAGS or tag not in self._open:
+            return
+        while self._open:
+            open_tag = self._open.pop()
+            self._out.append(f"</{open_tag}>")
+            if open_tag == tag:
+                break
+
+
+def strip_disallowed_html(raw_html):
+    if not raw_html:
+        return raw_html
+
+    sanitizer = HtmlSanitizer()
+    sanitized = sanitizer.feed(raw_html) + sanitizer.close()
+    return sanitized.strip()
+
+
+class ModelStats:
+    # Rolling latency/error window plus call and win counters per (stage, model).
+
+    def __init__(self, window):
+        self._lock = threading.Lock()
+        self._window = window
+        self._samples = {}
+        self._counters = {}
+
+    def record(self, stage, model, latency, ok):
+        with self._lock:
+            samples = self._samples.setdefault((stage, model), deque(maxlen=self._window))
+            samples.append((latency, ok))
+
+    def record_call(self, stage, model, won, hedged):
+        with self._lock:
+            counters = self._counters.setdefault((stage, model), self._new_counters())
+            counters["calls"] += 1
+            counters["wins"] += int(won)
+            counters["hedged"] += int(hedged)
+
+    def record_tokens(self, stage, model, prompt_tokens, cached_tokens):
+        with self._lock:
+            counters = self._counters.setdefault((stage, model), self._new_counters())
+            counters["prompt_tokens"] += prompt_tokens
+            counters["cached_tokens"] += cached_tokens
+
+    @staticmethod
+    def _new_counters():
+        return {"calls": 0, "wins": 0, "hedged": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+    def degraded(self, stage, model, latency_limit):
+        with self._lock:
+            samples = list(self._samples.get((stage, model), ()))
+        if len(samples) < MODEL_MIN_SAMPLES:
+            return False
+        errors = sum(1 for _, ok in samples if not ok)
+        if errors / len(samples) > MODEL_MAX_ERROR_RATE:
+            return True
+        latencies = sorted(latency for latency, ok in samples if ok)
+        return bool(latencies) and percentile(latencies, 0.5) > latency_limit
+
+    def snapshot(self):
+        with self._lock:
+            samples = {key: list(value) for key, value in self._samples.items()}
+            counters = {key: dict(value) for key, value in self._counters.items()}
+
+        stats = {}
+        for key in sorted(set(samples) | set(counters)):
+            stage, model = key
+            window = samples.get(key, [])
+            latencies = sorted(latency for latency, ok in window if ok)
+            counts = counters.get(key) or self._new_counters()
+            stats.setdefault(stage, {})[model] = {
+                "samples": len(window),
+                "error_rate": round(sum(1 for _, ok in window if not ok) / len(window), 3) if window else None,
+                "p50_ms": round(percentile(latencies, 0.5) * 1000) if latencies else None,
+                "p95_ms": round(percentile(latencies, 0.95) * 1000) if latencies else None,
+                "calls": counts["calls"],
+                "wins": counts["wins"],
+                "hedged": counts["hedged"],
+                "win_rate": round(counts["wins"] / counts["calls"], 3) if counts["calls"] else None,
+                "prompt_tokens": counts["prompt_tokens"],
+                "cached_tokens": counts["cached_tokens"],
+                "uncached_tokens": counts["prompt_tokens"] - counts["cached_tokens"],
+                "cached_ratio": (
+                    round(counts["cached_tokens"] / counts["prompt_tokens"], 3) if counts["prompt_tokens"] else None
+                ),
+            }
+        return stats
+
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, partial=""):
+        super().__init__("decode deadline exceeded")
+        # Text finished before the deadline, e.g. OCR of the first screenshots.
+        self.partial = partial
+
+
+def time_left(deadline):
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def check_deadline(deadline):
+    left = time_left(deadline)
+    if left is not None and left < DEADLINE_MIN_CALL_SECONDS:
+        raise DeadlineExceeded()
+    return left
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class RouterPool:
+    # The router's thread pool. submit() also returns an event set when the call
+    # starts running, so hedge timers do not count time queued behind other calls,
+    # and has_idle_worker() lets the router skip a hedge that could only queue.
+
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model-router")
+        self._max_workers = max_workers
+        self._lock = threading.Lock()
+        self._inflight = 0
+
+    def submit(self, fn, *args):
+        started = threading.Event()
+
+        def run():
+            started.set()
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self._inflight -= 1
+
+        with self._lock:
+            self._inflight += 1
+        return self._executor.submit(run), started
+
+    def has_idle_worker(self):
+        with self._lock:
+            return self._inflight < self._max_workers
+
+
+model_stats = ModelStats(MODEL_STATS_WINDOW)
+router_pool = RouterPool(MODEL_ROUTER_THREADS)
+
+
+def select_route(stage, input_size):
+    routes = MODEL_ROUTES[stage]
+    for route in routes:
+        if route["max_input"] is None or input_size <= route["max_input"]:
+            return route
+    return routes[-1]
+
+
+def select_models(stage, route):
+    models = route["models"]
+    healthy = [m for m in models if not model_stats.degraded(stage, m, route["hedge_after"])]
+    primary = healthy[0] if healthy else models[0]
+    fallback = next((m for m in models if m != primary), None)
+    return primary, fallback
+
+
+def timed_completion(stage, model, request_kwargs):
+    started = time.monotonic()
+    try:
+        completion = get_openai_client().chat.completions.create(model=model, **request_kwargs)
+    except Exception:
+        model_stats.record(stage, model, time.monotonic() - started, ok=False)
+        raise
+    model_stats.record(stage, model, time.monotonic() - started, ok=True)
+    if completion.usage:
+        # Hedged calls that lose the race are billed too, so tokens are counted
+        # here rather than only for the winning completion.
+        model_stats.record_tokens(stage, model, *prompt_token_counts(completion.usage))
+    return completion
+
+
+def routed_completion(stage, input_size, deadline=None, usage=None, **request_kwargs):
+    # The caller records the returned completion under `stage`; calls whose result
+    # is not used are recorded here, under "<stage>.<role>".
+    with span("model.completion", stage=stage, input_size=input_size) as span_args:
+        return hedged_completion(stage, input_size, request_kwargs, span_args, deadline, usage)
+
+
+def record_unused_completion(usage, stage, role, model, submitted, future):
+    # Done callback for calls that lost the hedge race or outlived the deadline:
+    # upstream bills them all the same.
+    if usage is None or future.cancelled() or future.exception() is not None:
+        return
+    stage = f"{stage}.{role}"
+    latency_ms = elapsed_ms(submitted)
+    if isinstance(usage, RequestUsage):
+        with usage.lock:
+            ledger_key = usage.ledger_key
+            if ledger_key is None:
+                record_usage(usage, stage, future.result(), latency_ms, model)
+                return
+        # The request was already written to the ledger; add a separate entry.
+        user_id, decode_id, decode_class, ok = ledger_key
+        late = {}
+        record_usage(late, stage, future.result(), latency_ms, model)
+        decode_ledger.record(user_id, decode_id, decode_class, late, ok)
+        return
+    record_usage(usage, stage, future.result(), latency_ms, model)
+
+
+def hedged_completion(stage, input_size, request_kwargs, span_args, deadline, usage=None):
+    left = check_deadline(deadline)
+    if left is not None:
+        # Also cap the HTTP call, so the router thread does not outlive the request.
+        request_kwargs = {**request_kwargs, "timeout": left}
+    route = select_route(stage, input_size)
+    primary, fallback = select_models(stage, route)
+    submitted = {}
+    future, started = router_pool.submit(timed_completion, stage, primary, request_kwargs)
+    futures = {future: primary}
+    submitted[future] = time.perf_counter()
+
+    # The hedge timer starts when the primary call does, not when it was queued.
+    started.wait(time_left(deadline))
+    left = time_left(deadline)
+    hedge_after = route["hedge_after"] if left is None else max(0.0, min(route["hedge_after"], left))
+    done, _ = wait(futures, timeout=hedge_after)
+    primary_failed = bool(done) and next(iter(done)).exception() is not None
+    left = time_left(deadline)
+    hedge = fallback and (not done or primary_failed) and (left is None or left >= DEADLINE_MIN_CALL_SECONDS)
+    if hedge and not primary_failed and not router_pool.has_idle_worker():
+        # Every router thread is busy: a hedge would only queue and add load.
+        span_args["hedge_skipped"] = True
+        hedge = False
+    if hedge:
+        if left is not None:
+            request_kwargs = {**request_kwargs, "timeout": left}
+        log_event(
+            "[ROUTER]",
+            stage=stage,
+            primary=primary,
+            fallback=fallback,
+            reason="error" if primary_failed else "slow",
+        )
+        future = router_pool.submit(timed_completion, stage, fallback, request_kwargs)[0]
+        futures[future] = fallback
+        submitted[future] = time.perf_counter()
+    hedged = len(futures) > 1
+
+    def record_unused(role, used=None):
+        for future, model in futures.items():
+            if future is not used:
+                future.add_done_callback(
+                    lambda done, model=model: record_unused_completion(
+                        usage, stage, role, model, submitted[done], done
+                    )
+                )
+
+    pending = set(futures)
+    last_error = None
+    while pending:
+        done, pending = wait(pending, timeout=time_left(deadline), return_when=FIRST_COMPLETED)
+        if not done:
+            last_error = DeadlineExceeded()
+            span_args["deadline_exceeded"] = True
+            break
+        for future in done:
+            if future.exception() is not None:
+                last_error = future.exception()
+                continue
+            winner = futures[future]
+            for model in futures.values():
+                model_stats.record_call(stage, model, won=model == winner, hedged=hedged)
+            span_args.update(model=winner, hedged=hedged)
+            record_unused("hedge_loser", used=future)
+            return future.result()
+
+    for model in futures.values():
+        model_stats.record_call(stage, model, won=False, hedged=hedged)
+    record_unused("abandoned")
+    raise last_error
+
+
+def model_cost_micros(model, prompt_tokens, cached_tokens, completion_tokens):
+    key = max((key for key in MODEL_PRICES if model and model.startswith(key)), key=len, default=None)
+    if key is None:
+        return 0
+    input_price, cached_price, output_price = MODEL_PRICES[key]
+    # Prices are per million tokens, so they are already micro-dollars per token.
+    return round(
+        (prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price + completion_tokens * output_price
+    )
+
+
+def prompt_token_counts(completion_usage):
+    details = getattr(completion_usage, "prompt_tokens_details", None)
+    return completion_usage.prompt_tokens or 0, getattr(details, "cached_tokens", 0) or 0
+
+
+class RequestUsage(dict):
+    # Stage name -> record_usage totals for one request. Unused hedged calls can
+    # finish after the request has been written to the decode ledger; ledger_key
+    # then routes them to their own entry for the same user, decode and class.
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.ledger_key = None
+
+
+def record_usage(usage, stage, completion=None, latency_ms=0.0, model=None, cache_hit=False):
+    # Stages answered without a model call (local OCR, perceptual-hash reuse) pass
+    # no completion and name their engine in `model`.
+    if usage is None:
+        return
+    totals = usage.setdefault(
+        stage,
+        {
+            "calls": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+            "cache_hits": 0,
+            "latency_ms": 0.0,
+            "cost_micros": 0,
+            "model": None,
+        },
+    )
+    totals["calls"] += 1
+    totals["latency_ms"] = round(totals["latency_ms"] + latency_ms, 1)
+    totals["cache_hits"] += int(cache_hit)
+    if completion is not None:
+        model = completion.model or model
+        if completion.usage:
+            prompt_tokens, cached_tokens = prompt_token_counts(completion.usage)
+            completion_tokens = completion.usage.completion_tokens or 0
+            totals["prompt_tokens"] += prompt_tokens
+            totals["completion_tokens"] += completion_tokens
+            totals["cached_tokens"] += cached_tokens
+            totals["cost_micros"] += model_cost_micros(model, prompt_tokens, cached_tokens, completion_tokens)
+    if model:
+        totals["model"] = model
+
+
+def histogram_bucket(value):
+    return int(math.log(max(value, 0) + 1, LEDGER_BUCKET_GROWTH))
+
+
+def histogram_value(bucket):
+    # Upper edge of the bucket, so reported percentiles are within one growth step.
+    return round(LEDGER_BUCKET_GROWTH ** (bucket + 1) - 1, 1)
+
+
+def write_ledger_entries(conn, entries):
+    rows = []
+    daily = {}
+    histograms = Counter()
+    users = {}
+    for entry in entries:
+        day = entry["created_at"][:10]
+        decode_totals = {"cost_micros": 0, "latency_ms": entry["total_ms"] or 0.0}
+        for stage, totals in entry["usage"].items():
+            rows.append(
+                (
+                    entry["created_at"],
+                    entry["user_id"],
+                    entry["decode_id"],
+                    entry["decode_class"],
+                    stage,
+                    totals["model"],
+                    int(entry["ok"]),
+                    totals["calls"],
+                    totals["prompt_tokens"],
+                    totals["completion_tokens"],
+                    totals["cached_tokens"],
+                    totals["cache_hits"],
+                    totals["latency_ms"],
+                    totals["cost_micros"],
+                )
+            )
+            decode_totals["cost_micros"] += totals["cost_micros"]
+            for metric in LEDGER_HISTOGRAM_METRICS:
+                histograms[(day, stage, metric, histogram_bucket(totals[metric]))] += 1
+            key = (day, stage, entry["decode_class"])
+            current = daily.setdefault(key, Counter())
+            for column in ("calls", "prompt_tokens", "completion_tokens", "cached_tokens", "cache_hits", "cost_micros"):
+                current[column] += totals[column]
+
+            user = users.setdefault(entry["user_id"], Counter())
+            user["prompt_tokens"] += totals["prompt_tokens"]
+            user["completion_tokens"] += totals["completion_tokens"]
+            user["cost_micros"] += totals["cost_micros"]
+
+        user = users.setdefault(entry["user_id"], Counter())
+        user["last_seen_at"] = entry["created_at"]
+        if entry["total_ms"] is None:
+            continue
+        # The "decode" pseudo-stage holds one sample per decode: end-to-end
+        # latency and total cost, counted per decode class.
+        for metric in ("latency_ms", "cost_micros"):
+            histograms[(day, "decode", metric, histogram_bucket(decode_totals[metric]))] += 1
+        current = daily.setdefault((day, "decode", entry["decode_class"]), Counter())
+        current["calls"] += 1
+        current["cost_micros"] += decode_totals["cost_micros"]
+        user["decodes"] += 1
+        user["paid_decodes"] += int(entry["decode_class"] in ("paid", "batch"))
+
+    conn.executemany(
+        """
+        INSERT INTO decode_ledger (
+            created_at, user_id, decode_id, decode_class, stage, model, ok, calls,
+            prompt_tokens, completion_tokens, cached_tokens, cache_hits, latency_ms, cost_micros
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows,
+    )
+    conn.executemany(
+        """
+        INSERT INTO ledger_daily (
+            day, stage, decode_class, calls, prompt_tokens, completion_tokens,
+            cached_tokens, cache_hits, cost_micros
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (day, stage, decode_class) DO UPDATE SET
+            calls = calls + excluded.calls,
+            prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+            completion_tokens = completion_tokens + excluded.completion_tokens,
+            cached_tokens = cached_tokens + excluded.cached_tokens,
+            cache_hits = cache_hits + excluded.cache_hits,
+            cost_micros = cost_micros + excluded.cost_micros
+        """,
+        [
+            (
+                day,
+                stage,
+                decode_class,
+                totals["calls"],
+                totals["prompt_tokens"],
+                totals["completion_tokens"],
+                totals["cached_tokens"],
+                totals["cache_hits"],
+                totals["cost_micros"],
+            )
+            for (day, stage, decode_class), totals in daily.items()
+        ],
+    )
+    conn.executemany(
+        """
+        INSERT INTO ledger_histograms (day, stage, metric, bucket, count)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (day, stage, metric, bucket) DO UPDATE SET count = count + excluded.count
+        """,
+        [key + (count,) for key, count in histograms.items()],
+    )
+    conn.executemany(
+        """
+        INSERT INTO ledger_user_totals (
+            user_id, decodes, paid_decodes, prompt_tokens, completion_tokens, cost_micros, last_seen_at
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            decodes = decodes + excluded.decodes,
+            paid_decodes = paid_decodes + excluded.paid_decodes,
+            prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+            completion_tokens = completion_tokens + excluded.completion_tokens,
+            cost_micros = cost_micros + excluded.cost_micros,
+            last_seen_at = MAX(last_seen_at, excluded.last_seen_at)
+        """,
+        [
+            (
+                user_id,
+                totals["decodes"],
+                totals["paid_decodes"],
+                totals["prompt_tokens"],
+                totals["completion_tokens"],
+                totals["cost_micros"],
+                totals["last_seen_at"],
+            )
+            for user_id, totals in users.items()
+        ],
+    )
+
+
+class DecodeLedger:
+    # Request threads only append to an in-memory buffer. A writer thread, started
+    # lazily in each worker process, flushes every LEDGER_FLUSH_SECONDS or as soon
+    # as LEDGER_BATCH_SIZE entries are waiting; entries beyond LEDGER_MAX_BUFFER
+    # are dropped and counted rather than held up behind a slow database.
+
+    def __init__(self, batch_size, max_buffer):
+        self._lock = threading.Lock()
+        self._entries = []
+        self._wakeup = threading.Event()
+        self._batch_size = batch_size
+        self._max_buffer = max_buffer
+        self._thread = None
+        self._pid = None
+        self._written = 0
+        self._dropped = 0
+
+    def record(self, user_id, decode_id, decode_class, usage, ok, total_ms=None):
+        # total_ms is the end-to-end time of a decode. Background upload OCR and
+        # follow-ups leave it None: their cost is recorded, but they are not decodes.
+        if isinstance(usage, RequestUsage):
+            with usage.lock:
+                usage.ledger_key = (user_id, decode_id, decode_class, ok)
+                usage = dict(usage)
+        if not usage:
+            return
+        entry = {
+            "created_at": dt.datetime.now(dt.timezone.utc).isoformat(),
+            "user_id": user_id,
+            "decode_id": decode_id,
+            "decode_class": decode_class,
+            "usage": usage,
+            "ok": ok,
+            "total_ms": total_ms,
+        }
+        with self._lock:
+            if len(self._entries) >= self._max_buffer:
+                self._dropped += 1
+                return
+            self._entries.append(entry)
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="ledger-writer", daemon=True)
+                self._thread.start()
+            if len(self._entries) >= self._batch_size:
+                self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(LEDGER_FLUSH_SECONDS)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            entries, self._entries = self._entries, []
+        if not entries:
+            return
+        try:
+            with get_db_connection() as conn:
+                write_ledger_entries(conn, entries)
+                conn.commit()
+        except Exception:
+            logger.exception("Failed to write %s decode ledger entries", len(entries))
+            with self._lock:
+                self._dropped += len(entries)
+            return
+        with self._lock:
+            self._written += len(entries)
+
+    def stats(self):
+        with self._lock:
+            return {"pending": len(self._entries), "written": self._written, "dropped": self._dropped}
+
+
+decode_ledger = DecodeLedger(LEDGER_BATCH_SIZE, LEDGER_MAX_BUFFER)
+atexit.register(decode_ledger.flush)
+
+
+def histogram_percentiles(buckets):
+    # buckets: (bucket, count) pairs in ascending bucket order.
+    total = sum(count for _, count in buckets)
+    result = {}
+    for name, fraction in LEDGER_PERCENTILES.items():
+        cumulative = 0
+        for bucket, count in buckets:
+            cumulative += count
+            if cumulative >= fraction * total:
+                result[name] = histogram_value(bucket)
+                break
+    return result
+
+
+class DecodeTicket:
+    def __init__(self, decode_class):
+        self.decode_class = decode_class
+        self.enqueued_at = time.monotonic()
+        self.admitted = False
+
+
+class DecodeScheduler:
+    def __init__(self, slots, reserved_paid, weights):
+        self._cond = threading.Condition()
+        self._slots = slots
+        self._reserved_paid = reserved_paid
+        self._weights = weights
+        self._queues = {name: deque() for name in weights}
+        self._running = {name: 0 for name in weights}
+        self._current = {name: 0 for name in weights}
+        self._stats = {
+            name: {"admitted": 0, "timed_out": 0, "wait_total": 0.0, "wait_max": 0.0} for name in weights
+        }
+
+    def _capacity(self, decode_class):
+        if sum(self._running.values()) >= self._slots:
+            return False
+        return decode_class == "paid" or self._running[decode_class] < self._slots - self._reserved_paid
+
+    def _dispatch(self):
+        # Smooth weighted round robin over the classes that have waiters and room.
+        while True:
+            eligible = [name for name, queue in self._queues.items() if queue and self._capacity(name)]
+            if not eligible:
+                return
+            total = sum(self._weights[name] for name in eligible)
+            for name in eligible:
+                self._current[name] += self._weights[name]
+            chosen = max(eligible, key=lambda name: self._current[name])
+            self._current[chosen] -= total
+
+            ticket = self._queues[chosen].popleft()
+            ticket.admitted = True
+            self._running[chosen] += 1
+            waited = time.monotonic() - ticket.enqueued_at
+            stats = self._stats[chosen]
+            stats["admitted"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+
+    def acquire(self, decode_class, timeout):
+        ticket = DecodeTicket(decode_class)
+        deadline = ticket.enqueued_at + timeout
+        with self._cond:
+            self._queues[decode_class].append(ticket)
+            self._dispatch()
+            while not ticket.admitted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._queues[decode_class].remove(ticket)
+                    self._stats[decode_class]["timed_out"] += 1
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def release(self, decode_class):
+        with self._cond:
+            self._running[decode_class] -= 1
+            self._dispatch()
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, decode_class, timeout=None):
+        queue_timeout = DECODE_QUEUE_TIMEOUTS[decode_class]
+        if timeout is not None:
+            queue_timeout = max(0.0, min(queue_timeout, timeout))
+        admitted = self.acquire(decode_class, queue_timeout)
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self.release(decode_class)
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                name: {
+                    "queued": len(self._queues[name]),
+                    "running": self._running[name],
+                    "admitted": stats["admitted"],
+                    "timed_out": stats["timed_out"],
+                    "avg_wait_ms": round(stats["wait_total"] / stats["admitted"] * 1000) if stats["admitted"] else 0,
+                    "max_wait_ms": round(stats["wait_max"] * 1000),
+                }
+                for name, stats in self._stats.items()
+            }
+
+
+decode_scheduler = DecodeScheduler(DECODE_SLOTS, PAID_RESERVED_SLOTS, DECODE_CLASS_WEIGHTS)
+
+
+class RemoteOcrEngine:
+    # OCR engines return (text, confidence), with confidence on a 0-100 scale or
+    # None when the engine does not report one.
+
+    name = "remote"
+
+    def available(self):
+        return bool(API_KEY)
+
+    def recognize(self, img_bytes, usage=None, deadline=None):
+        started = time.perf_counter()
+        with span("ocr.encode", bytes=len(img_bytes)):
+            b64 = base64.b64encode(img_bytes).decode("utf-8")
+
+        resp = routed_completion(
+            "ocr",
+            len(img_bytes),
+            messages=build_ocr_messages(b64),
+            temperature=0.0,
+            deadline=deadline,
+            usage=usage,
+        )
+        record_usage(usage, "ocr", resp, elapsed_ms(started))
+        return resp.choices[0].message.content.strip(), None
+
+
+class LocalOcrBusy(Exception):
+    pass
+
+
+class TesseractOcrEngine:
+    # Tesseract is CPU-bound, so it runs in a process pool rather than on the
+    # request threads. The pool is built on first use, after gunicorn has forked,
+    # and its workers start from a clean forkserver instead of a copy of this
+    # threaded process.
+
+    name = "tesseract"
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pool = None
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.queue_ms = deque(maxlen=MODEL_STATS_WINDOW)
+        self.run_ms = deque(maxlen=MODEL_STATS_WINDOW)
+        self.installed = importlib.util.find_spec("pytesseract") is not None and shutil.which("tesseract") is not None
+
+    def available(self):
+        return self.installed
+
+    def get_pool(self):
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    import local_ocr
+
+                    context = multiprocessing.get_context("forkserver")
+                    context.set_forkserver_preload(["local_ocr"])
+                    self.pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=context,
+                        initializer=local_ocr.init_worker,
+                    )
+        return self.pool
+
+    def release(self, _future):
+        with self.lock:
+            self.pending -= 1
+
+    def recognize(self, img_bytes, usage=None, deadline=None):
+        import local_ocr
+
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise LocalOcrBusy()
+            self.pending += 1
+        submitted = time.perf_counter()
+        try:
+            future = self.get_pool().submit(local_ocr.recognize, img_bytes)
+        except Exception:
+            self.release(None)
+            raise
+        # The pending count drops when the job ends, not when this caller stops
+        # waiting, so abandoned jobs still count against the bound.
+        future.add_done_callback(self.release)
+        try:
+            queue_until = submitted + OCR_LOCAL_QUEUE_SECONDS
+            left = time_left(deadline)
+            if left is not None:
+                queue_until = min(queue_until, submitted + left)
+            # running() turns true once the job is handed to a worker process.
+            while not future.running() and not future.done():
+                if time.perf_counter() >= queue_until:
+                    raise LocalOcrBusy()
+                time.sleep(OCR_LOCAL_POLL_SECONDS)
+            started = time.perf_counter()
+            record_span("ocr.local.queue", submitted)
+            timeout = OCR_LOCAL_TIMEOUT_SECONDS
+            left = time_left(deadline)
+            if left is not None:
+                timeout = max(0.0, min(timeout, left))
+            result = future.result(timeout=timeout)
+        except BaseException:
+            # Drops the job if it has not reached a worker yet; a running job
+            # cannot be stopped and finishes in the background.
+            future.cancel()
+            raise
+        with self.lock:
+            self.queue_ms.append((started - submitted) * 1000)
+            self.run_ms.append(elapsed_ms(started))
+        return result
+
+    def snapshot(self):
+        with self.lock:
+            queue_ms = sorted(self.queue_ms)
+            run_ms = sorted(self.run_ms)
+            pending = self.pending
+        timings = {}
+        for name, values in (("queue_ms", queue_ms), ("run_ms", run_ms)):
+            if values:
+                timings[name] = {"p50": round(percentile(values, 0.5), 1), "p90": round(percentile(values, 0.9), 1)}
+        return {"pending": pending, "max_pending": self.max_pending, **timings}
+
+
+OCR_ENGINES = {"remote": RemoteOcrEngine, "tesseract": TesseractOcrEngine}
+
+
+class OcrRouter:
+    def __init__(self, mode):
+        self.mode = mode
+        self.remote = OCR_ENGINES["remote"]() if mode != "tesseract" else None
+        local = OCR_ENGINES["tesseract"](OCR_LOCAL_WORKERS, OCR_LOCAL_MAX_PENDING) if mode != "remote" else None
+        self.local = local if local is not None and local.available() else None
+        if self.local is None and self.remote is None:
+            # Tesseract-only with no tesseract would OCR every screenshot to "".
+            logger.error("OCR_ENGINE=tesseract but tesseract is not installed; using the remote engine")
+            self.remote = OCR_ENGINES["remote"]()
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def count(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def accept_local(self, text, confidence):
+        if self.remote is None:
+            return True
+        return confidence >= OCR_LOCAL_MIN_CONFIDENCE and len(text.split()) >= OCR_LOCAL_MIN_WORDS
+
+    def recognize(self, img_bytes, usage=None, deadline=None):
+        text = ""
+        if self.local is not None:
+            try:
+                started = time.perf_counter()
+                with span("ocr.local", bytes=len(img_bytes)) as span_args:
+                    text, confidence = self.local.recognize(img_bytes, deadline=deadline)
+                    span_args["confidence"] = round(confidence, 1)
+                if self.accept_local(text, confidence):
+                    self.count("local")
+                    record_usage(usage, "ocr", latency_ms=elapsed_ms(started), model=self.local.name)
+                    return text.strip()
+                self.count("escalated")
+            except LocalOcrBusy:
+                self.count("local_busy")
+            except Exception:
+                logger.exception("Local OCR failed; escalating to the remote engine")
+                self.count("local_failed")
+        if self.remote is None:
+            return text.strip()
+        text, _ = self.remote.recognize(img_bytes, usage=usage, deadline=deadline)
+        self.count("remote")
+        return text
+
+    def snapshot(self):
+        with self.lock:
+            counts = dict(self.counts)
+        return {
+            "mode": self.mode,
+            "local": self.local.snapshot() if self.local is not None else None,
+            "min_confidence": OCR_LOCAL_MIN_CONFIDENCE,
+            "counts": counts,
+        }
+
+
+ocr_router = OcrRouter(OCR_ENGINE)
+
+
+def perceptual_hash(img_bytes):
+    # Difference hash: one bit per horizontally adjacent pixel pair of a
+    # (PHASH_GRID + 1) x PHASH_GRID grayscale thumbnail. Re-encoding and small
+    # rescales flip only a few bits. The fine grid keeps one mean brightness per
+    # cell, fine enough that a changed message line moves some cell's value.
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(img_bytes))
+    aspect = image.width / image.height
+    # Decoded at full size: JPEG draft decoding shifts the fine grid by more than
+    # a one-letter edit does, and this still costs far less than an OCR call.
+    gray = image.convert("L")
+    pixels = gray.resize((PHASH_GRID + 1, PHASH_GRID), Image.BOX).tobytes()
+    bits = 0
+    for row in range(PHASH_GRID):
+        offset = row * (PHASH_GRID + 1)
+        for col in range(PHASH_GRID):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    fine = gray.resize(PHASH_FINE_SIZE, Image.BOX).tobytes()
+    return bits, aspect, fine
+
+
+def fine_hashes_match(first, second):
+    if not first or not second or len(first) != len(second):
+        return False
+    return max(abs(left - right) for left, right in zip(first, second)) <= PHASH_FINE_MAX_DELTA
+
+
+class ImageHashIndex:
+    # Multi-index hashing: each hash is split into PHASH_CHUNK_BITS-bit chunks with
+    # one exact-match table per chunk position. Two hashes within
+    # PHASH_MAX_DISTANCE bits, fewer than the number of chunks, must agree on at
+    # least one whole chunk, so a lookup only measures distance to entries that
+    # share a chunk. Memory holds ids, owners and hashes in LRU order; fine hashes
+    # and transcripts stay in the image_hashes table in the main database and rows
+    # added by other workers are picked up every PHASH_SYNC_SECONDS.
+
+    def __init__(self, max_entries):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._tables = [{} for _ in range(PHASH_GRID * PHASH_GRID // PHASH_CHUNK_BITS)]
+        self._max_entries = max_entries
+        self._next_sync = 0.0
+        self._seen_id = None
+        self._hits = 0
+        self._near_hits = 0
+        self._rejected = 0
+        self._misses = 0
+
+    def _chunks(self, bits):
+        mask = (1 << PHASH_CHUNK_BITS) - 1
+        return [(bits >> (index * PHASH_CHUNK_BITS)) & mask for index in range(len(self._tables))]
+
+    def _add(self, entry_id, user_id, bits, aspect):
+        if entry_id in self._entries:
+            return
+        self._entries[entry_id] = (user_id, bits, aspect)
+        for table, chunk in zip(self._tables, self._chunks(bits)):
+            table.setdefault(chunk, set()).add(entry_id)
+        while len(self._entries) > self._max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_id):
+        _, bits, _ = self._entries.pop(entry_id)
+        for table, chunk in zip(self._tables, self._chunks(bits)):
+            bucket = table[chunk]
+            bucket.discard(entry_id)
+            if not bucket:
+                del table[chunk]
+
+    def _count(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def nearest(self, user_id, bits, aspect):
+        # The user's closest entries by coarse distance, best first.
+        self._sync()
+        with self._lock:
+            candidates = set()
+            for table, chunk in zip(self._tables, self._chunks(bits)):
+                candidates.update(table.get(chunk, ()))
+            matches = []
+            for entry_id in candidates:
+                entry_user, entry_bits, entry_aspect = self._entries[entry_id]
+                if entry_user != user_id or abs(entry_aspect - aspect) > PHASH_MAX_ASPECT_DELTA * aspect:
+                    continue
+                distance = bin(entry_bits ^ bits).count("1")
+                if distance <= PHASH_MAX_DISTANCE:
+                    matches.append((distance, entry_id))
+            return [entry_id for _, entry_id in sorted(matches)[:PHASH_VERIFY_CANDIDATES]]
+
+    def lookup(self, user_id, sha256, bits, aspect, fine):
+        try:
+            with get_db_connection() as conn:
+                row = conn.execute(
+                    "SELECT transcript FROM image_hashes WHERE user_id = ? AND sha256 = ? ORDER BY id DESC LIMIT 1",
+                    (user_id, sha256),
+                ).fetchone()
+                if row is not None:
+                    self._count("_hits")
+                    return row["transcript"]
+                candidates = self.nearest(user_id, bits, aspect)
+                for entry_id in candidates:
+                    row = conn.execute(
+                        "SELECT fine, transcript FROM image_hashes WHERE id = ? AND user_id = ?",
+                        (entry_id, user_id),
+                    ).fetchone()
+                    if row is None:
+                        # Trimmed from disk by another worker.
+                        with self._lock:
+                            if entry_id in self._entries:
+                                self._remove(entry_id)
+                        continue
+                    if fine_hashes_match(row["fine"], fine):
+                        with self._lock:
+                            if entry_id in self._entries:
+                                self._entries.move_to_end(entry_id)
+                        self._count("_near_hits")
+                        return row["transcript"]
+        except Exception:
+            logger.exception("Image hash transcript lookup failed")
+            return None
+        self._count("_rejected" if candidates else "_misses")
+        return None
+
+    def store(self, user_id, sha256, bits, aspect, fine, transcript):
+        try:
+            with get_db_connection() as conn:
+                entry_id = conn.execute(
+                    """
+                    INSERT INTO image_hashes (user_id, sha256, phash, aspect, fine, transcript, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    RETURNING id
+                    """,
+                    (
+                        user_id,
+                        sha256,
+                        bits.to_bytes(PHASH_GRID * PHASH_GRID // 8, "big"),
+                        aspect,
+                        fine,
+                        transcript,
+                        dt.datetime.now(dt.timezone.utc).isoformat(),
+                    ),
+                ).fetchone()["id"]
+                conn.execute(
+                    "DELETE FROM image_hashes WHERE id <= ? - ?",
+                    (entry_id, self._max_entries),
+                )
+                conn.commit()
+        except Exception:
+            logger.exception("Failed to store image hash")
+            return
+        with self._lock:
+            self._add(entry_id, user_id, bits, aspect)
+
+    def _sync(self):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_sync:
+                return
+            self._next_sync = now + PHASH_SYNC_SECONDS
+            seen_id = self._seen_id
+        try:
+            with get_db_connection() as conn:
+                if seen_id is None:
+                    # First use in this worker: load the newest rows, oldest first.
+                    rows = conn.execute(
+                        "SELECT id, user_id, phash, aspect FROM image_hashes ORDER BY id DESC LIMIT ?",
+                        (self._max_entries,),
+                    ).fetchall()[::-1]
+                else:
+                    rows = conn.execute(
+                        "SELECT id, user_id, phash, aspect FROM image_hashes WHERE id > ? ORDER BY id",
+                        (seen_id,),
+                    ).fetchall()
+        except Exception:
+            logger.exception("Image hash index sync failed")
+            return
+        with self._lock:
+            for row in rows:
+                self._add(row["id"], row["user_id"], int.from_bytes(row["phash"], "big"), row["aspect"])
+            if rows:
+                seen_id = max(seen_id or 0, rows[-1]["id"])
+            self._seen_id = seen_id or 0
+
+    def stats(self):
+        with self._lock:
+            hits = self._hits + self._near_hits
+            lookups = hits + self._rejected + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "near_hits": self._near_hits,
+                "rejected": self._rejected,
+                "misses": self._misses,
+                "hit_rate": round(hits / lookups, 3) if lookups else None,
+            }
+
+
+image_hash_index = ImageHashIndex(PHASH_INDEX_SIZE) if importlib.util.find_spec("PIL") else None
+
+
+def ocr_image(img_bytes, usage=None, deadline=None, user_id=None):
+    # Only screenshots with a known uploader use the hash index, and only against
+    # that uploader's own earlier screenshots.
+    fingerprint = None
+    if image_hash_index is not None and user_id is not None:
+        try:
+            started = time.perf_counter()
+            with span("ocr.phash", bytes=len(img_bytes)) as span_args:
+                fingerprint = (hashlib.sha256(img_bytes).hexdigest(), *perceptual_hash(img_bytes))
+                transcript = image_hash_index.lookup(user_id, *fingerprint)
+                span_args["hit"] = transcript is not None
+            if transcript is not None:
+                record_usage(usage, "ocr", latency_ms=elapsed_ms(started), model="phash", cache_hit=True)
+                return transcript
+        except Exception:
+            logger.exception("Perceptual hash lookup failed")
+    try:
+        text = ocr_router.recognize(img_bytes, usage=usage, deadline=deadline)
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        logger.exception("OCR failed for an uploaded image")
+        return ""
+    if text and fingerprint is not None:
+        image_hash_index.store(user_id, *fingerprint, text)
+    return text
+
+
+def extract_text_from_images(files, deadline=None, usage=None, user_id=None):
+    if not files:
+        return ""
+
+    all_text = []
+
+    for img in files:
+        if not img or img.filename == "":
+            continue
+
+        with span("upload.read", filename=img.filename):
+            img_bytes = img.read()
+        if not img_bytes:
+            continue
+
+        try:
+            with span("ocr.image", bytes=len(img_bytes)):
+                text_chunk = ocr_image(img_bytes, usage=usage, deadline=deadline, user_id=user_id)
+        except DeadlineExceeded:
+            raise DeadlineExceeded("\n\n".join(all_text).strip())
+        if text_chunk:
+            all_text.append(text_chunk)
+
+    return "\n\n".join(all_text).strip()
+
+
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_OCR_THREADS, thread_name_prefix="upload-ocr")
+upload_futures = {}
+
+
+def upload_allowance(user_row):
+    free_left = max(0, FREE_DECODES_PER_DAY - user_row["free_uses_today"])
+    decodes_left = min(user_row["paid_decode_credits"] + free_left, UPLOAD_DECODES_AHEAD)
+    return MAX_UPLOADS_PER_DECODE * decodes_left
+
+
+def save_uploads(user_row, images):
+    # All or nothing: a partial set would silently drop screenshots from the
+    # decode. Returns None when the user is over their upload allowance.
+    user_id = user_row["id"]
+    now = dt.datetime.now(dt.timezone.utc)
+    cutoff = (now - dt.timedelta(minutes=UPLOAD_RETENTION_MINUTES)).isoformat()
+    upload_ids = [str(uuid.uuid4()) for _ in images]
+    with get_db_connection(user_id) as conn:
+        # Count and insert in one write transaction, so parallel uploads from one
+        # user cannot each see the same free allowance.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM uploads WHERE created_at < ?", (cutoff,))
+            counts = conn.execute(
+                """
+                SELECT COUNT(*) AS recent, COALESCE(SUM(status != 'used'), 0) AS unused
+                FROM uploads WHERE user_id = ? AND created_at >= ?
+                """,
+                (user_id, cutoff),
+            ).fetchone()
+            if (
+                counts["unused"] + len(images) > upload_allowance(user_row)
+                or counts["recent"] + len(images) > UPLOADS_PER_WINDOW
+            ):
+                conn.rollback()
+                return None
+            conn.executemany(
+                "INSERT INTO uploads (id, user_id, created_at, status, image) VALUES (?, ?, ?, 'pending', ?)",
+                [(upload_id, user_id, now.isoformat(), img_bytes) for upload_id, img_bytes in zip(upload_ids, images)],
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return upload_ids
+
+
+def finish_upload_ocr(user_id, upload_id, img_bytes, decode_class):
+    usage = RequestUsage()
+    with decode_scheduler.slot(decode_class) as admitted:
+        row = load_upload(user_id, upload_id) if admitted else None
+        if admitted and (row is None or row["status"] != "pending"):
+            # Replaced or used while it waited for a slot; skip the upstream call.
+            return ""
+        text = ocr_image(img_bytes, usage=usage, user_id=user_id) if admitted else ""
+    decode_ledger.record(user_id, None, decode_class, usage, ok=bool(text))
+    try:
+        with get_db_connection(user_id) as conn:
+            # Only a still-pending row takes the result: an upload discarded or
+            # replaced while OCR ran stays 'used' without its text.
+            if admitted:
+                conn.execute(
+                    """
+                    UPDATE uploads SET status = 'done', transcript = ?, image = NULL
+                    WHERE id = ? AND status = 'pending' AND user_id = ?
+                    """,
+                    (text, upload_id, user_id),
+                )
+            else:
+                # The queue was saturated; the final submit runs OCR from the stored image.
+                conn.execute(
+                    "UPDATE uploads SET status = 'deferred' WHERE id = ? AND status = 'pending' AND user_id = ?",
+                    (upload_id, user_id),
+                )
+            conn.commit()
+    except Exception:
+        logger.exception("Failed to store upload OCR result")
+    return text
+
+
+def start_upload_ocr(user_id, upload_id, img_bytes, decode_class):
+    future = upload_executor.submit(finish_upload_ocr, user_id, upload_id, img_bytes, decode_class)
+    upload_futures[upload_id] = future
+    future.add_done_callback(lambda _: upload_futures.pop(upload_id, None))
+
+
+def load_upload(user_id, upload_id):
+    try:
+        with get_db_connection(user_id) as conn:
+            return conn.execute(
+                "SELECT * FROM uploads WHERE id = ? AND user_id = ?", (upload_id, user_id)
+            ).fetchone()
+    except Exception:
+        logger.exception("Failed to load upload")
+        return None
+
+
+def upload_wait_until(deadline=None):
+    # One time.monotonic() instant for every upload of a decode, so N screenshots
+    # wait at most UPLOAD_WAIT_SECONDS between them, not each.
+    wait_until = time.monotonic() + UPLOAD_WAIT_SECONDS
+    return wait_until if deadline is None else min(wait_until, deadline)
+
+
+def wait_for_upload_text(user_id, upload_id, deadline=None, usage=None, wait_until=None):
+    if wait_until is None:
+        wait_until = upload_wait_until(deadline)
+    future = upload_futures.get(upload_id)
+    if future is not None:
+        try:
+            future.result(timeout=max(0.0, wait_until - time.monotonic()))
+        except Exception:
+            logger.exception("Background OCR did not finish for upload %s", upload_id)
+
+    # The upload may have landed on another worker; give its OCR whatever is left
+    # of the wait, then fall back to running it here from the stored image.
+    while True:
+        row = load_upload(user_id, upload_id)
+        if not row:
+            return ""
+        if row["status"] == "done":
+            return row["transcript"] or ""
+        left = wait_until - time.monotonic()
+        if row["status"] != "pending" or left <= 0 or row["image"] is None:
+            break
+        time.sleep(min(UPLOAD_POLL_SECONDS, left))
+    return ocr_image(row["image"], usage=usage, deadline=deadline, user_id=user_id) if row["image"] else ""
+
+
+def collect_upload_text(user_id, upload_ids, deadline=None, usage=None):
+    wait_until = upload_wait_until(deadline)
+    all_text = []
+    for upload_id in upload_ids:
+        try:
+            all_text.append(wait_for_upload_text(user_id, upload_id, deadline, usage, wait_until))
+        except DeadlineExceeded:
+            raise DeadlineExceeded("\n\n".join(text for text in all_text if text).strip())
+    return "\n\n".join(text for text in all_text if text).strip()
+
+
+def discard_uploads(user_id, upload_ids):
+    # Rows are kept, without their image or text, until the retention window ends
+    # so they still count against UPLOADS_PER_WINDOW.
+    if not upload_ids:
+        return
+    for upload_id in upload_ids:
+        future = upload_futures.get(upload_id)
+        if future is not None:
+            future.cancel()
+    try:
+        with get_db_connection(user_id) as conn:
+            conn.executemany(
+                "UPDATE uploads SET status = 'used', image = NULL, transcript = NULL WHERE id = ? AND user_id = ?",
+                [(upload_id, user_id) for upload_id in upload_ids],
+            )
+            conn.commit()
+    except Exception:
+        logger.exception("Failed to discard uploads")
+
+
+def decode_allowed(user_row):
+    return user_row["paid_decode_credits"] > 0 or user_row["free_uses_today"] < FREE_DECODES_PER_DAY
+
+
+def build_ocr_messages(b64):
+    return [
+        {"role": "system", "content": OCR_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": OCR_USER_PROMPT},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{b64}"
+                    },
+                },
+            ],
+        },
+    ]
+
+
+def build_analysis_input(context, conversation_text):
+    return (
+        f"Context: {context or 'none provided'}\n\n"
+        "Text conversation (from screenshots and/or pasted text):\n"
+        f"{conversation_text}"
+    )
+
+
+def build_analysis_messages(context, conversation_text):
+    return [
+        {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+        {"role": "user", "content": build_analysis_input(context, conversation_text)},
+    ]
+
+
+def estimated_tokens(messages):
+    return sum(len(message["content"]) for message in messages) // PROMPT_CHARS_PER_TOKEN
+
+
+def build_followup_input(decode_row, question):
+    return (
+        f"Context: {decode_row['context'] or 'none provided'}\n\n"
+        "Text conversation:\n"
+        f"{decode_row['transcript']}\n\n"
+        "Your earlier verdict:\n"
+        f"{decode_row['verdict']}\n\n"
+        f"Follow-up question: {question}"
+    )
+
+
+def build_followup_messages(decode_row, question):
+    analysis = build_analysis_messages(decode_row["context"], decode_row["transcript"])
+    if estimated_tokens(analysis) >= PROMPT_CACHE_MIN_TOKENS:
+        # Starts with the exact messages of the analysis call that produced the
+        # decode, so the upstream prompt cache can serve that prefix.
+        return analysis + [
+            {"role": "assistant", "content": decode_row["verdict"]},
+            {"role": "system", "content": FOLLOWUP_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Follow-up question: {question}"},
+        ]
+    # Too short to be cached, the analysis prompt would be billed in full on
+    # every follow-up; the compact input leaves it out.
+    return [
+        {"role": "system", "content": FOLLOWUP_SYSTEM_PROMPT},
+        {"role": "user", "content": build_followup_input(decode_row, question)},
+    ]
+
+
+def analyze_conversation(context, conversation_text, usage=None, deadline=None):
+    messages = build_analysis_messages(context, conversation_text)
+    started = time.perf_counter()
+    completion = routed_completion(
+        "analysis",
+        len(messages[-1]["content"]),
+        messages=messages,
+        temperature=0.4,
+        deadline=deadline,
+        usage=usage,
+    )
+    record_usage(usage, "analysis", completion, elapsed_ms(started))
+    raw_html = completion.choices[0].message.content
+    with span("sanitize", chars=len(raw_html or "")):
+        return strip_disallowed_html(raw_html)
+
+
+def api_key_hash(key):
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def issue_api_key(user_id):
+    # One live key per user: issuing a new one revokes the old.
+    key = API_KEY_PREFIX + secrets.token_urlsafe(32)
+    with get_db_connection() as conn:
+        conn.execute("DELETE FROM api_keys WHERE user_id = ?", (user_id,))
+        conn.execute(
+            "INSERT INTO api_keys (key_hash, user_id, created_at) VALUES (?, ?, ?)",
+            (api_key_hash(key), user_id, dt.datetime.now(dt.timezone.utc).isoformat()),
+        )
+        conn.commit()
+    return key
+
+
+def api_key_user(key):
+    if not key.startswith(API_KEY_PREFIX):
+        return None
+    try:
+        with get_db_connection() as conn:
+            row = conn.execute("SELECT user_id FROM api_keys WHERE key_hash = ?", (api_key_hash(key),)).fetchone()
+    except Exception:
+        logger.exception("API key lookup failed")
+        return None
+    return row["user_id"] if row else None
+
+
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_THREADS, thread_name_prefix="batch-decode")
+
+
+def decode_batch_item(user_row, index, item):
+    started = time.monotonic()
+    result = {"index": index, "id": item.get("id"), "ok": False}
+    context = str(item.get("context") or "").strip()
+    thread = str(item.get("thread") or "").strip()
+    try:
+        images = [base64.b64decode(data, validate=True) for data in item.get("images") or []]
+    except Exception:
+        result["error"] = "invalid_image"
+        return result
+    if not images and not thread:
+        result["error"] = "empty_conversation"
+        return result
+
+    charge = increment_usage_paid(user_row)
+    if not charge:
+        result["error"] = "no_credits"
+        return result
+
+    with decode_scheduler.slot("batch") as admitted:
+        if not admitted:
+            refund_usage_paid(user_row, charge)
+            result["error"] = "busy"
+            result["elapsed_ms"] = round((time.monotonic() - started) * 1000)
+            return result
+        return run_batch_item(user_row, charge, context, thread, images, result, started)
+
+
+def run_batch_item(user_row, charge, context, thread, images, result, started):
+    usage = RequestUsage()
+    try:
+        ocr_text = "\n\n".join(text for text in (ocr_image(img, usage=usage, user_id=user_row["id"]) for img in images) if text)
+        conversation_text = ocr_text or thread
+        if not conversation_text:
+            refund_usage_paid(user_row, charge)
+            result["error"] = "unreadable_images"
+            return result
+        result["result"] = analyze_conversation(context, conversation_text, usage=usage)
+        result["ok"] = True
+    except Exception:
+        logger.exception("Batch decode failed")
+        refund_usage_paid(user_row, charge)
+        result["error"] = "analysis_failed"
+    finally:
+        result["elapsed_ms"] = round((time.monotonic() - started) * 1000)
+        decode_ledger.record(user_row["id"], None, "batch", usage, result["ok"], result["elapsed_ms"])
+    return result
+
+
+def stream_batch_results(user_row, items):
+    pending = set()
+    next_index = 0
+    succeeded = 0
+    try:
+        while next_index < len(items) or pending:
+            while next_index < len(items) and len(pending) < BATCH_CONCURRENCY:
+                pending.add(batch_executor.submit(decode_batch_item, user_row, next_index, items[next_index]))
+                next_index += 1
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                succeeded += int(result["ok"])
+                yield json.dumps(result) + "\n"
+        log_event("[BATCH]", user_id=user_row["id"], items=len(items), succeeded=succeeded)
+        yield json.dumps({"done": True, "items": len(items), "succeeded": succeeded}) + "\n"
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def export_user_pages(shard, paid_only, active_since):
+    # The first filter drives the index. After the first page its bound is
+    # implied by the cursor, and it is dropped so SQLite seeks on the cursor.
+    first = []
+    conditions = []
+    sort_column = None
+    if active_since:
+        sort_column = "last_decode_at"
+        first = [("last_decode_at >= ?", active_since)]
+    if paid_only:
+        if sort_column:
+            conditions.append("paid_decode_credits > 0")
+        else:
+            sort_column = "paid_decode_credits"
+            first = [("paid_decode_credits > ?", 0)]
+    order = f"{sort_column}, id" if sort_column else "id"
+
+    cursor = None
+    while True:
+        where = list(conditions)
+        args = []
+        if cursor is None:
+            where.extend(condition for condition, _ in first)
+            args.extend(value for _, value in first)
+        else:
+            where.append(f"({order}) > ({', '.join('?' for _ in cursor)})")
+            args.extend(cursor)
+        sql = "SELECT * FROM users"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {order} LIMIT ?"
+        with storage.connect(shard) as conn:
+            rows = conn.execute(sql, (*args, EXPORT_PAGE_SIZE)).fetchall()
+        if rows:
+            yield rows
+        if len(rows) < EXPORT_PAGE_SIZE:
+            return
+        last = rows[-1]
+        cursor = (last[sort_column], last["id"]) if sort_column else (last["id"],)
+
+
+def stream_users_export(export_format, paid_only, active_since):
+    columns = None
+    exported = 0
+    try:
+        for shard in storage.shards():
+            for rows in export_user_pages(shard, paid_only, active_since):
+                exported += len(rows)
+                if export_format == "ndjson":
+                    yield "".join(json.dumps(dict(row)) + "\n" for row in rows)
+                    continue
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                if columns is None:
+                    columns = rows[0].keys()
+                    writer.writerow(columns)
+                writer.writerows([row[column] for column in columns] for row in rows)
+                yield buffer.getvalue()
+    except Exception:
+        logger.exception("Users export failed after %s rows", exported)
+        # A partial file must not pass for a complete one: end it with a marker
+        # line, then re-raise so the server aborts the chunked response rather
+        # than finishing it cleanly.
+        if export_format == "ndjson":
+            yield json.dumps({"error": "export_failed", "rows_exported": exported}) + "\n"
+        else:
+            yield f"#ERROR export failed after {exported} rows\n"
+        raise
+    log_event("[EXPORT]", rows=exported, format=export_format, paid_only=paid_only, active_since=active_since)
+
+
+def database_pages(conn):
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return page_size, page_count, free_pages
+
+
+def sweep_abandoned_users(shard, cutoff):
+    # An unexpired checkout session keeps its user; the Stripe webhook also
+    # recreates a missing row, so a payment for a swept user is never lost.
+    deleted = 0
+    with storage.connect(shard) as conn:
+        # The delete names its index, which fails if the migration that creates
+        # it has not run on this shard; creating it here is a no-op once it has.
+        create_users_sweep_index(conn)
+        conn.commit()
+        page_size, pages_before, _ = database_pages(conn)
+        while True:
+            count = conn.execute(
+                f"""
+                DELETE FROM users WHERE id IN (
+                    SELECT id FROM users INDEXED BY idx_users_abandoned
+                    WHERE {ABANDONED_USER_FILTER} AND free_uses_date < ?
+                        AND NOT EXISTS (
+                            SELECT 1 FROM checkout_sessions
+                            WHERE checkout_sessions.user_id = users.id AND checkout_sessions.expires_at > ?
+                        )
+                    LIMIT ?
+                )
+                """,
+                (cutoff, int(time.time()), SWEEP_BATCH_SIZE),
+            ).rowcount
+            conn.commit()
+            deleted += count
+            if count < SWEEP_BATCH_SIZE:
+                break
+            time.sleep(SWEEP_BATCH_PAUSE_SECONDS)
+
+        # Uploads are otherwise only pruned when the same shard takes a new upload,
+        # so screenshots left behind on a quiet shard would keep their blobs.
+        upload_cutoff = dt.datetime.now(dt.timezone.utc) - dt.timedelta(minutes=UPLOAD_RETENTION_MINUTES)
+        uploads_deleted = conn.execute("DELETE FROM uploads WHERE created_at < ?", (upload_cutoff.isoformat(),)).rowcount
+        conn.commit()
+
+        incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        free_pages = database_pages(conn)[2]
+        while incremental and free_pages:
+            # execute() steps a statement with no result columns only once, which
+            # frees a single page; executescript() runs it to completion.
+            conn.executescript(f"PRAGMA incremental_vacuum({SWEEP_VACUUM_PAGES});")
+            remaining = database_pages(conn)[2]
+            if remaining >= free_pages:
+                break
+            free_pages = remaining
+            time.sleep(SWEEP_BATCH_PAUSE_SECONDS)
+        _, pages_after, free_pages = database_pages(conn)
+
+    if not incremental and free_pages:
+        logger.warning(
+            "Shard %s has auto_vacuum off: %s free pages are reused but the file will not shrink until a VACUUM",
+            shard,
+            free_pages,
+        )
+    return {
+        "shard": shard,
+        "users_deleted": deleted,
+        "uploads_deleted": uploads_deleted,
+        "bytes_reclaimed": (pages_before - pages_after) * page_size,
+        "free_bytes": free_pages * page_size,
+        "incremental_vacuum": incremental,
+    }
+
+
+def claim_sweep_run(cutoff, force):
+    now = dt.datetime.now(dt.timezone.utc)
+    with get_db_connection() as conn:
+        # Serialize against other workers; the first one past the interval sweeps.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            last = conn.execute("SELECT MAX(started_at) AS started_at FROM sweep_runs").fetchone()["started_at"]
+            interval = dt.timedelta(seconds=SWEEP_INTERVAL_SECONDS)
+            if not force and last and now - dt.datetime.fromisoformat(last) < interval:
+                conn.rollback()
+                return None
+            run_id = conn.execute(
+                "INSERT INTO sweep_runs (started_at, cutoff) VALUES (?, ?)",
+                (now.isoformat(), cutoff),
+            ).lastrowid
+            conn.execute("DELETE FROM sweep_runs WHERE id <= ?", (run_id - SWEEP_RUNS_KEPT,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return run_id
+
+
+class UserSweeper:
+    # A thread per worker process, started lazily by the first request. Every
+    # worker wakes up each SWEEP_INTERVAL_SECONDS, but only the one that claims
+    # the run in sweep_runs sweeps, so shards see one sweep at a time.
+
+    def __init__(self, interval):
+        self._lock = threading.Lock()
+        self._interval = interval
+        self._thread = None
+        self._pid = None
+
+    def ensure_started(self):
+        if self._interval <= 0:
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="user-sweeper", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            # Jittered, so workers forked together do not all race for the claim.
+            time.sleep(self._interval * random.uniform(0.5, 1.0))
+            try:
+                self.run()
+            except Exception:
+                logger.exception("User sweep failed")
+
+    def run(self, force=False):
+        cutoff = (dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=USER_RETENTION_DAYS)).date().isoformat()
+        run_id = claim_sweep_run(cutoff, force)
+        if run_id is None:
+            return None
+        started = time.perf_counter()
+        shards = []
+        error = None
+        try:
+            for shard in storage.shards():
+                shards.append(sweep_abandoned_users(shard, cutoff))
+        except Exception as exc:
+            logger.exception("User sweep failed on shard %s", len(shards))
+            error = repr(exc)
+        result = {
+            "id": run_id,
+            "cutoff": cutoff,
+            "users_deleted": sum(entry["users_deleted"] for entry in shards),
+            "bytes_reclaimed": sum(entry["bytes_reclaimed"] for entry in shards),
+            "shards": shards,
+            "error": error,
+        }
+        with get_db_connection() as conn:
+            conn.execute(
+                """
+                UPDATE sweep_runs
+                SET finished_at = ?, users_deleted = ?, bytes_reclaimed = ?, shards = ?, error = ?
+                WHERE id = ?
+                """,
+                (
+                    dt.datetime.now(dt.timezone.utc).isoformat(),
+                    result["users_deleted"],
+                    result["bytes_reclaimed"],
+                    json.dumps(shards),
+                    error,
+                    run_id,
+                ),
+            )
+            conn.commit()
+        log_event(
+            "[SWEEP]",
+            cutoff=cutoff,
+            users_deleted=result["users_deleted"],
+            bytes_reclaimed=result["bytes_reclaimed"],
+            free_bytes=sum(entry["free_bytes"] for entry in shards),
+            total_ms=elapsed_ms(started),
+            error=error,
+        )
+        return result
+
+
+user_sweeper = UserSweeper(SWEEP_INTERVAL_SECONDS)
+
+
+def check_admin_token():
+    if not ADMIN_TOKEN:
+        return ("Not Found", 404)
+
+    token = request.args.get("token", "")
+    if token != ADMIN_TOKEN:
+        return ("Forbidden", 403)
+    return None
+
+
+def compress_body(body, encoding, kind):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITIES[kind])
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVELS[kind], mtime=0)
+    return body
+
+
+def negotiate_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return "identity"
+
+
+class EncodedPage:
+    # A rendered page plus its compressed variants, built on first request for
+    # each encoding. Strong ETags differ per encoding, as the bytes do.
+
+    def __init__(self, body, kind):
+        self.kind = kind
+        self.digest = hashlib.sha256(body).hexdigest()[:32]
+        self.bodies = {"identity": body}
+
+    def body(self, encoding):
+        if encoding not in self.bodies:
+            self.bodies[encoding] = compress_body(self.bodies["identity"], encoding, self.kind)
+        return self.bodies[encoding]
+
+    def etag(self, encoding):
+        return f"{self.digest}-{encoding}"
+
+
+static_pages = {}
+
+
+def static_page(key, render):
+    page = static_pages.get(key)
+    if page is None:
+        page = static_pages[key] = EncodedPage(render().encode("utf-8"), "static")
+    return page
+
+
+def page_response(page):
+    encoding = negotiate_encoding()
+    etag = page.etag(encoding)
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(page.body(encoding))
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+@app.before_request
+def start_trace():
+    trace_state.events = []
+    trace_state.started = time.perf_counter()
+    trace_state.status = None
+    trace_state.sampler = None
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        trace_state.sampler = StackSampler(threading.get_ident()).start()
+
+
+@app.before_request
+def start_user_sweeper():
+    user_sweeper.ensure_started()
+
+
+@app.after_request
+def note_trace_status(response):
+    trace_state.status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_trace(exc):
+    events = getattr(trace_state, "events", None)
+    if events is None:
+        return
+    sampler = trace_state.sampler
+    trace_state.events = trace_state.sampler = None
+    root = span_event(f"{request.method} {request.path}", trace_state.started, {"status": trace_state.status})
+    events.append(root)
+    profile = sampler.stop() if sampler else None
+    if profile is not None or root["dur"] >= TRACE_SLOW_MS * 1000 or random.random() < TRACE_SAMPLE_RATE:
+        recent_traces.append({"events": events, "profile": profile})
+
+
+@app.after_request
+def compress_response(response):
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = negotiate_encoding()
+    if encoding == "identity":
+        return response
+    with span("compress", encoding=encoding, bytes=len(body)):
+        response.set_data(compress_body(body, encoding, "dynamic"))
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+@app.route("/_admin/usage")
+def admin_usage():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    try:
+        totals = {"users": 0, "total_decodes": 0, "free_uses_today": 0}
+        for shard in storage.shards():
+            with storage.connect(shard) as conn:
+                row = conn.execute(
+                    """
+                    SELECT
+                        COUNT(*) AS users,
+                        COALESCE(SUM(total_decodes), 0) AS total_decodes,
+                        COALESCE(SUM(free_uses_today), 0) AS free_uses_today
+                    FROM users
+                    """
+                ).fetchone()
+            for key in totals:
+                totals[key] += row[key]
+
+        return jsonify(
+            users=totals["users"],
+            total_decodes=totals["total_decodes"],
+            free_uses_today=totals["free_uses_today"],
+            user_cache=user_cache.stats(),
+        )
+    except Exception:
+        logger.exception("Admin usage lookup failed")
+        return ("Server error", 500)
+
+
+@app.route("/_admin/users/export")
+def admin_users_export():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    export_format = request.args.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        return jsonify(error="format must be csv or ndjson"), 400
+    paid_only = request.args.get("paid", "").lower() in ("1", "true", "yes")
+    active_since = request.args.get("active_since", "").strip() or None
+    if active_since:
+        try:
+            active_since = dt.date.fromisoformat(active_since).isoformat()
+        except ValueError:
+            return jsonify(error="active_since must be a YYYY-MM-DD date"), 400
+
+    response = Response(
+        stream_users_export(export_format, paid_only, active_since),
+        mimetype=EXPORT_FORMATS[export_format],
+    )
+    response.headers["Content-Disposition"] = f"attachment; filename=users.{export_format}"
+    return response
+
+
+@app.route("/_admin/ledger")
+def admin_ledger():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    days = max(1, min(request.args.get("days", default=7, type=int), 366))
+    since = (dt.datetime.now(dt.timezone.utc).date() - dt.timedelta(days=days - 1)).isoformat()
+    try:
+        with get_db_connection() as conn:
+            daily = conn.execute(
+                """
+                SELECT stage, decode_class,
+                    SUM(calls) AS calls,
+                    SUM(prompt_tokens) AS prompt_tokens,
+                    SUM(completion_tokens) AS completion_tokens,
+                    SUM(cached_tokens) AS cached_tokens,
+                    SUM(cache_hits) AS cache_hits,
+                    SUM(cost_micros) AS cost_micros
+                FROM ledger_daily
+                WHERE day >= ?
+                GROUP BY stage, decode_class
+                """,
+                (since,),
+            ).fetchall()
+            histogram = conn.execute(
+                """
+                SELECT stage, metric, bucket, SUM(count) AS count
+                FROM ledger_histograms
+                WHERE day >= ?
+                GROUP BY stage, metric, bucket
+                ORDER BY stage, metric, bucket
+                """,
+                (since,),
+            ).fetchall()
+    except Exception:
+        logger.exception("Admin ledger lookup failed")
+        return ("Server error", 500)
+
+    stages = {}
+    classes = {}
+    for row in daily:
+        stage = stages.setdefault(row["stage"], Counter())
+        for column in ("calls", "prompt_tokens", "completion_tokens", "cached_tokens", "cache_hits", "cost_micros"):
+            stage[column] += row[column]
+        decode_class = classes.setdefault(row["decode_class"], Counter())
+        if row["stage"] == "decode":
+            decode_class["decodes"] += row["calls"]
+        else:
+            decode_class["cost_micros"] += row["cost_micros"]
+
+    buckets = {}
+    for row in histogram:
+        buckets.setdefault(row["stage"], {}).setdefault(row["metric"], []).append((row["bucket"], row["count"]))
+
+    return jsonify(
+        since=since,
+        stages={
+            name: {
+                **totals,
+                "cost_usd": round(totals["cost_micros"] / 1_000_000, 4),
+                "percentiles": {
+                    metric: histogram_percentiles(metric_buckets)
+                    for metric, metric_buckets in buckets.get(name, {}).items()
+                },
+            }
+            for name, totals in stages.items()
+        },
+        classes={
+            name: {
+                "decodes": totals["decodes"],
+                "cost_usd": round(totals["cost_micros"] / 1_000_000, 4),
+                "cost_per_decode_usd": (
+                    round(totals["cost_micros"] / totals["decodes"] / 1_000_000, 6) if totals["decodes"] else None
+                ),
+            }
+            for name, totals in classes.items()
+        },
+        writer=decode_ledger.stats(),
+    )
+
+
+@app.route("/_admin/ledger/users")
+def admin_ledger_users():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    limit = max(1, min(request.args.get("limit", default=20, type=int), LEDGER_TOP_USERS_MAX))
+    try:
+        with get_db_connection() as conn:
+            rows = conn.execute(
+                "SELECT * FROM ledger_user_totals ORDER BY cost_micros DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        users = []
+        for row in rows:
+            with get_db_connection(row["user_id"]) as conn:
+                account = conn.execute(
+                    "SELECT paid_decode_credits, lifetime_paid_decodes FROM users WHERE id = ?",
+                    (row["user_id"],),
+                ).fetchone()
+            users.append(
+                {
+                    **dict(row),
+                    "cost_usd": round(row["cost_micros"] / 1_000_000, 4),
+                    "paid_decode_credits": account["paid_decode_credits"] if account else None,
+                    "lifetime_paid_decodes": account["lifetime_paid_decodes"] if account else None,
+                }
+            )
+    except Exception:
+        logger.exception("Admin ledger users lookup failed")
+        return ("Server error", 500)
+
+    return jsonify(users=users)
+
+
+@app.route("/_admin/traces")
+def admin_traces():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    traces = list(recent_traces)
+    events = [event for trace in traces for event in trace["events"]]
+    response = jsonify(
+        traceEvents=events,
+        displayTimeUnit="ms",
+        otherData={"pid": os.getpid(), "traces": len(traces)},
+    )
+    response.headers["Content-Disposition"] = f"attachment; filename=mil-trace-{os.getpid()}.json"
+    return response
+
+
+@app.route("/_admin/profile")
+def admin_profile():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    # With ?seconds=N every thread in this worker is sampled for N seconds; without
+    # it, the profiles of sampled requests still held in recent_traces are merged.
+    seconds = request.args.get("seconds", type=float)
+    if seconds is None:
+        stacks = Counter()
+        for trace in list(recent_traces):
+            if trace["profile"]:
+                stacks.update(trace["profile"])
+    else:
+        sampler = StackSampler().start()
+        time.sleep(min(max(seconds, 0.0), PROFILE_MAX_SECONDS))
+        stacks = sampler.stop()
+    return Response(format_collapsed(stacks), mimetype="text/plain")
+
+
+@app.route("/_admin/models")
+def admin_models():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    return jsonify(
+        routes=MODEL_ROUTES,
+        models=model_stats.snapshot(),
+        ocr=ocr_router.snapshot(),
+        image_hashes=image_hash_index.stats() if image_hash_index is not None else None,
+    )
+
+
+@app.route("/_admin/startup")
+def admin_startup():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    return jsonify(
+        pid=os.getpid(),
+        log_queue={"depth": log_handler.queue.qsize(), "dropped": log_handler.dropped},
+        **STARTUP_TIMINGS,
+    )
+
+
+@app.route("/_admin/sweep")
+def admin_sweep():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    try:
+        # ?run=1 sweeps now, in this request, whatever the interval says.
+        if request.args.get("run", "").lower() in ("1", "true", "yes"):
+            return jsonify(user_sweeper.run(force=True))
+        limit = max(1, min(request.args.get("limit", default=20, type=int), SWEEP_RUNS_KEPT))
+        with get_db_connection() as conn:
+            rows = conn.execute("SELECT * FROM sweep_runs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return jsonify(
+            retention_days=USER_RETENTION_DAYS,
+            interval_seconds=SWEEP_INTERVAL_SECONDS,
+            runs=[dict(row, shards=json.loads(row["shards"]) if row["shards"] else None) for row in rows],
+        )
+    except Exception:
+        logger.exception("Admin sweep failed")
+        return ("Server error", 500)
+
+
+@app.route("/_admin/scheduler")
+def admin_scheduler():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    return jsonify(
+        slots=DECODE_SLOTS,
+        paid_reserved_slots=PAID_RESERVED_SLOTS,
+        weights=DECODE_CLASS_WEIGHTS,
+        classes=decode_scheduler.snapshot(),
+    )
+
+
+@app.route("/create-checkout-session/decode-pack", methods=["POST"])
+def create_checkout_session():
+    if not STRIPE_ENABLED:
+        return jsonify(error="Stripe is not configured"), 400
+
+    user_id, needs_cookie = get_or_create_user_id(request)
     user_row = load_or_create_user(user_id)
     if not user_row:
         return jsonify(error="User unavailable"), 500
     payload = request.get_json(silent=True) or {}
     pack = str(payload.get("pack", "")).strip()
-    price_map = {
-        "10": STRIPE_PRICE_DECODE_10,
-        "25": STRIPE_PRICE_DECODE_25,
-        "50": STRIPE_PRICE_DECODE_50,
-    }
-    price_id = price_map.get(pack)
+    price_id = STRIPE_PRICES.get(pack)
     if not price_id:
         return jsonify(error="Invalid pack"), 400
 
     base_url = request.url_root.rstrip("/")
     try:
-        session = stripe.checkout.Session.create(
-            mode="payment",
-            line_items=[{"price": price_id, "quantity": 1}],
-            client_reference_id=user_id,
-            metadata={"mil_uid": user_id, "pack_size": pack},
-            success_url=f"{base_url}/?checkout=success",
-            cancel_url=f"{base_url}/?checkout=cancel",
-        )
-        response = make_response(jsonify(url=session.url))
+        with checkout_lock(user_id, pack):
+            url = load_checkout_session(user_id, pack, base_url)
+            reused = url is not None
+            if not reused:
+                session = get_stripe().checkout.Session.create(
+                    mode="payment",
+                    line_items=[{"price": price_id, "quantity": 1}],
+                    client_reference_id=user_id,
+                    metadata={"mil_uid": user_id, "pack_size": pack},
+                    success_url=f"{base_url}/?checkout=success",
+                    cancel_url=f"{base_url}/?checkout=cancel",
+                )
+                url = session.url
+                save_checkout_session(user_id, pack, base_url, session)
+        log_event("[CHECKOUT]", user_id=user_id, pack=pack, reused=reused)
+        response = make_response(jsonify(url=url))
         if needs_cookie:
             response.set_cookie(
                 COOKIE_NAME,
@@ -969,6 +4221,149 @@ def create_checkout_session():
         return jsonify(error="Stripe error"), 500
 
 
+@app.route("/upload", methods=["POST"])
+def upload():
+    user_id = request.cookies.get(COOKIE_NAME)
+    if not API_KEY:
+        return jsonify(error="Server is missing the OpenAI API key."), 500
+    if not user_id:
+        # The page sets the cookie; a client without one submits its screenshots
+        # with the decode instead of getting background OCR.
+        return jsonify(error="Missing user cookie"), 400
+
+    user_row = load_or_create_user(user_id)
+    if not user_row:
+        return jsonify(error="User unavailable"), 500
+    if reset_daily_counter_if_needed(user_row):
+        user_row = load_or_create_user(user_id)
+    if not user_row or not decode_allowed(user_row):
+        return jsonify(error="Decode limit reached"), 403
+
+    replaces = [upload_id.strip() for upload_id in request.form.get("replaces", "").split(",") if upload_id.strip()]
+    discard_uploads(user_id, replaces[:MAX_UPLOADS_PER_DECODE])
+
+    images = []
+    for img in request.files.getlist("images")[:MAX_UPLOADS_PER_DECODE]:
+        img_bytes = img.read() if img and img.filename else b""
+        if img_bytes:
+            images.append(img_bytes)
+    if not images:
+        return jsonify(upload_ids=[])
+    try:
+        upload_ids = save_uploads(user_row, images)
+    except Exception:
+        logger.exception("Failed to save uploads")
+        return jsonify(error="Upload failed"), 500
+    if upload_ids is None:
+        log_event("[UPLOAD_LIMIT]", user_id=user_id, images=len(images))
+        return jsonify(error="Too many uploads. Submit to decode them with the form."), 429
+
+    decode_class = "paid" if user_row["paid_decode_credits"] > 0 else "free"
+    for upload_id, img_bytes in zip(upload_ids, images):
+        start_upload_ocr(user_id, upload_id, img_bytes, decode_class)
+    return jsonify(upload_ids=upload_ids)
+
+
+@app.route("/api/keys", methods=["POST"])
+def create_api_key():
+    user_id = request.cookies.get(COOKIE_NAME)
+    user_row = load_or_create_user(user_id, create=False) if user_id else None
+    if not user_row:
+        return jsonify(error="Unknown user"), 401
+    if user_row["paid_decode_credits"] <= 0 and user_row["lifetime_paid_decodes"] <= 0:
+        return jsonify(error="API keys are for accounts that bought a decode pack"), 402
+    try:
+        key = issue_api_key(user_id)
+    except Exception:
+        logger.exception("Failed to issue API key")
+        return jsonify(error="Server error"), 500
+    log_event("[API_KEY]", user_id=user_id)
+    # Shown once; only its hash is stored.
+    return jsonify(api_key=key)
+
+
+@app.route("/api/decode/batch", methods=["POST"])
+def api_decode_batch():
+    auth_header = request.headers.get("Authorization", "")
+    if auth_header.startswith("Bearer "):
+        user_id = api_key_user(auth_header[7:].strip())
+        if not user_id:
+            return jsonify(error="Unknown API key"), 401
+    else:
+        user_id = request.cookies.get(COOKIE_NAME)
+    if not user_id:
+        return jsonify(error="Missing API key"), 401
+    if not API_KEY:
+        return jsonify(error="Server is missing the OpenAI API key"), 500
+
+    payload = request.get_json(silent=True) or {}
+    items = payload.get("conversations")
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return jsonify(error="Expected a non-empty conversations list"), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify(error=f"At most {BATCH_MAX_ITEMS} conversations per batch"), 400
+
+    # Never create users here: an unknown cookie is not an account.
+    user_row = load_or_create_user(user_id, create=False)
+    if not user_row:
+        return jsonify(error="Unknown user"), 401
+    if user_row["paid_decode_credits"] <= 0:
+        return jsonify(error="No paid decode credits"), 402
+
+    return Response(stream_batch_results(user_row, items), mimetype="application/x-ndjson")
+
+
+@app.route("/followup", methods=["POST"])
+def followup():
+    user_id = request.cookies.get(COOKIE_NAME)
+    payload = request.get_json(silent=True) or {}
+    decode_id = str(payload.get("decode_id", "")).strip()
+    question = str(payload.get("question", "")).strip()[:FOLLOWUP_MAX_QUESTION_CHARS]
+
+    if not question:
+        return jsonify(error="Type a question first."), 400
+    if not API_KEY:
+        return jsonify(error="Server is missing the OpenAI API key."), 500
+
+    decode_row = load_decode(user_id, decode_id) if user_id and decode_id else None
+    if not decode_row:
+        return jsonify(error="That decode has expired. Run a new one to ask more."), 404
+
+    followups_left = reserve_followup_credit(user_id, decode_id)
+    if followups_left is None:
+        return jsonify(error="No follow-ups left. Run a new decode to ask more."), 403
+
+    messages = build_followup_messages(decode_row, question)
+    usage = RequestUsage()
+    started = time.perf_counter()
+    try:
+        completion = routed_completion(
+            "followup",
+            sum(len(message["content"]) for message in messages[1:]),
+            messages=messages,
+            temperature=0.4,
+            max_tokens=FOLLOWUP_MAX_TOKENS,
+            usage=usage,
+        )
+        record_usage(usage, "followup", completion, elapsed_ms(started))
+        answer = strip_disallowed_html(completion.choices[0].message.content)
+        decode_ledger.record(user_id, decode_id, "followup", usage, ok=True)
+    except Exception:
+        logger.exception("OpenAI follow-up failed")
+        decode_ledger.record(user_id, decode_id, "followup", usage, ok=False)
+        refund_followup_credit(user_id, decode_id)
+        return jsonify(error="Something went wrong while answering the follow-up."), 502
+
+    log_event(
+        "[FOLLOWUP]",
+        user_id=user_id,
+        decode_id=decode_id,
+        question_len=len(question),
+        followups_left=followups_left,
+    )
+    return jsonify(answer=answer, followups_left=followups_left)
+
+
 @app.route("/stripe-webhook", methods=["POST"])
 def stripe_webhook():
     if not STRIPE_WEBHOOK_SECRET:
@@ -977,16 +4372,25 @@ def stripe_webhook():
     payload = request.get_data()
     sig_header = request.headers.get("Stripe-Signature", "")
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+        event = get_stripe().Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
     except Exception:
         logger.exception("Stripe webhook signature verification failed")
         return ("Invalid signature", 400)
 
+    if event["type"] == "checkout.session.expired":
+        session = event["data"]["object"]
+        user_id = (session.get("metadata", {}) or {}).get("mil_uid")
+        if user_id:
+            discard_checkout_sessions(user_id, session.get("id"))
+
     if event["type"] == "checkout.session.completed":
         session = event["data"]["object"]
         metadata = session.get("metadata", {}) or {}
         user_id = metadata.get("mil_uid")
         pack_size = metadata.get("pack_size")
+        if user_id:
+            # A paid session cannot be reused; the next click starts a new one.
+            discard_checkout_sessions(user_id, session.get("id"))
         try:
             credits = int(pack_size)
         except (TypeError, ValueError):
@@ -994,24 +4398,32 @@ def stripe_webhook():
 
         if user_id and credits > 0:
             try:
-                with get_db_connection() as conn:
-                    conn.execute(
+                now = dt.datetime.now(dt.timezone.utc).isoformat()
+                with get_db_connection(user_id) as conn:
+                    # Upsert: the retention sweep may have removed a row that had
+                    # nothing on it by the time the payment lands.
+                    row = conn.execute(
                         """
-                        UPDATE users
-                        SET paid_decode_credits = paid_decode_credits + ?
-                        WHERE id = ?
+                        INSERT INTO users (
+                            id, created_at, free_uses_today, free_uses_date,
+                            total_decodes, last_decode_at, is_paid, followup_credits,
+                            paid_decode_credits, lifetime_paid_decodes
+                        )
+                        VALUES (?, ?, 0, ?, 0, NULL, 0, 0, ?, 0)
+                        ON CONFLICT (id) DO UPDATE SET
+                            paid_decode_credits = paid_decode_credits + excluded.paid_decode_credits,
+                            version = version + 1
+                        RETURNING *
                         """,
-                        (credits, user_id),
-                    )
-                    conn.commit()
-                    row = conn.execute(
-                        "SELECT paid_decode_credits FROM users WHERE id = ?", (user_id,)
+                        (user_id, now, now[:10], credits),
                     ).fetchone()
-                logger.info(
-                    "[PAYMENT] user=%s pack=%s credits_now=%s",
-                    user_id,
-                    credits,
-                    row["paid_decode_credits"] if row else "unknown",
+                    conn.commit()
+                user_cache.publish(row)
+                log_event(
+                    "[PAYMENT]",
+                    user_id=user_id,
+                    pack=credits,
+                    credits_now=row["paid_decode_credits"] if row else None,
                 )
             except Exception:
                 logger.exception("Failed to apply Stripe credits")
@@ -1029,13 +4441,20 @@ def index():
     limit_reached = False
     banner = None
     used_paid_credit = False
+    decode_id = None
+    timings = {}
+    deadline_exceeded = False
+    usage = RequestUsage()
+    request_started = time.perf_counter()
+    deadline = time.monotonic() + DECODE_DEADLINE_SECONDS
     user_id, needs_cookie = get_or_create_user_id(request)
 
     if request.method == "GET":
         checkout_state = request.args.get("checkout")
         if checkout_state in {"success", "cancel"}:
-            user_row = load_or_create_user(user_id)
+            user_row = load_or_create_user(user_id, fresh=checkout_state == "success")
             if checkout_state == "success":
+                discard_checkout_sessions(user_id)
                 if user_row:
                     banner = f"Unlocked. You now have {user_row['paid_decode_credits']} decodes."
                 else:
@@ -1047,6 +4466,12 @@ def index():
         context = request.form.get("context", "").strip()
         thread = request.form.get("thread", "").strip()
         images = request.files.getlist("images") if "images" in request.files else []
+        upload_ids = [
+            upload_id.strip()
+            for upload_id in request.form.get("upload_ids", "").split(",")
+            if upload_id.strip()
+        ][:MAX_UPLOADS_PER_DECODE]
+        has_images = bool(images) or bool(upload_ids)
 
         user_row = load_or_create_user(user_id)
         if not user_row:
@@ -1054,7 +4479,9 @@ def index():
             limit_blocked = True
         else:
             reset_daily_counter_if_needed(user_row)
-            user_row = load_or_create_user(user_id)
+            # Read from the user's shard, not the cache: another worker may have
+            # charged or refunded this user since this worker cached the row.
+            user_row = load_or_create_user(user_id, fresh=True)
 
             if not user_row:
                 error = "We hit a server issue. Please try again in a moment."
@@ -1062,70 +4489,142 @@ def index():
             else:
                 if user_row["paid_decode_credits"] > 0:
                     used_paid_credit = True
-                elif user_row["free_uses_today"] >= 2:
+                elif not decode_allowed(user_row):
                     limit_blocked = True
                     limit_reached = True
 
-        timestamp = dt.datetime.now(dt.timezone.utc).isoformat()
-        logger.info(
-            "[SUBMISSION] time=%s user_id=%s has_images=%s has_text=%s context_len=%s blocked=%s paid_path=%s",
-            timestamp,
-            user_id,
-            bool(images),
-            bool(thread),
-            len(context),
-            limit_blocked,
-            used_paid_credit,
+        log_event(
+            "[SUBMISSION]",
+            user_id=user_id,
+            has_images=has_images,
+            has_text=bool(thread),
+            context_len=len(context),
+            blocked=limit_blocked,
+            paid_path=used_paid_credit,
         )
 
-        if not error and not limit_reached and (not API_KEY or client is None):
+        charge = None
+        if not error and not limit_reached and not API_KEY:
             error = "Server is missing the OpenAI API key. This is a setup issue, not your fault."
         elif not error and not limit_reached:
-            ocr_text = extract_text_from_images(images) if images else ""
-
-            if images and not ocr_text and not thread:
-                error = "We could not read text from those screenshots. Try a clearer crop or paste the text instead."
-            else:
-                conversation_text = ocr_text or thread
+            # Charged before any upstream work, atomically against the database
+            # rather than this worker's cached row, and refunded below if the
+            # decode produces no result.
+            charge = increment_usage_paid(user_row) if used_paid_credit else increment_usage(user_row)
+            if not charge:
+                limit_blocked = True
+                limit_reached = True
+        if charge:
+            decode_class = "paid" if used_paid_credit else "free"
+            ocr_text = ""
+            try:
+                # Uploaded screenshots are OCR'd under their own scheduler slots, so wait
+                # for them before taking one here.
+                stage_started = time.perf_counter()
+                upload_text = collect_upload_text(user_id, upload_ids, deadline, usage) if upload_ids else ""
+                timings["upload_wait_ms"] = elapsed_ms(stage_started)
+                record_span("decode.upload_wait", stage_started, uploads=len(upload_ids))
+                stage_started = time.perf_counter()
+                with decode_scheduler.slot(decode_class, time_left(deadline)) as admitted:
+                    timings["queue_ms"] = elapsed_ms(stage_started)
+                    record_span("decode.queue", stage_started, decode_class=decode_class, admitted=admitted)
+                    if not admitted:
+                        error = "We are swamped right now. Please try again in a minute."
+                        if upload_text and not thread:
+                            thread = upload_text
+                    else:
+                        stage_started = time.perf_counter()
+                        if upload_ids:
+                            ocr_text = upload_text
+                        else:
+                            ocr_text = extract_text_from_images(images, deadline, usage, user_id) if images else ""
+                        timings["ocr_ms"] = elapsed_ms(stage_started)
+                        record_span("decode.ocr", stage_started, images=len(images), warm=bool(upload_ids))
 
-                if not conversation_text:
-                    error = "Please upload at least one screenshot or paste the conversation text."
-                else:
-                    user_input = build_analysis_input(context, conversation_text)
-
-                    try:
-                        completion = client.chat.completions.create(
-                            model="gpt-4.1-mini",
-                            messages=[
-                                {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
-                                {"role": "user", "content": user_input},
-                            ],
-                            temperature=0.4,
-                        )
-                        raw_html = completion.choices[0].message.content
-                        result = strip_disallowed_html(raw_html)
-                        if used_paid_credit:
-                            increment_usage_paid(user_row)
+                        if has_images and not ocr_text and not thread:
+                            error = "We could not read text from those screenshots. Try a clearer crop or paste the text instead."
                         else:
-                            increment_usage(user_row)
-                    except Exception:
-                        logger.exception("OpenAI analysis failed")
-                        error = "Something went wrong while analyzing the conversation."
-
-    response = make_response(
-        render_template_string(
-        HTML_TEMPLATE,
-        app_name=APP_NAME,
-        tagline=TAGLINE,
-        result=result,
-        error=error,
-        limit_reached=limit_reached,
-        stripe_enabled=stripe_enabled(),
-        banner=banner,
-        context=context,
-        thread=thread,
+                            conversation_text = ocr_text or thread
+
+                            if not conversation_text:
+                                error = "Please upload at least one screenshot or paste the conversation text."
+                            else:
+                                try:
+                                    stage_started = time.perf_counter()
+                                    result = analyze_conversation(context, conversation_text, usage=usage, deadline=deadline)
+                                    timings["analysis_ms"] = elapsed_ms(stage_started)
+                                    record_span("decode.analysis", stage_started)
+                                    decode_id = save_decode(user_row, context, conversation_text, result)
+                                    discard_uploads(user_id, upload_ids)
+                                except DeadlineExceeded:
+                                    raise
+                                except Exception:
+                                    logger.exception("OpenAI analysis failed")
+                                    error = "Something went wrong while analyzing the conversation."
+            except DeadlineExceeded as exc:
+                # Nothing is charged; hand back whatever was read so the user can
+                # check it and resubmit as pasted text.
+                deadline_exceeded = True
+                partial = ocr_text or exc.partial
+                if partial and not thread:
+                    thread = partial
+                    error = "That took longer than usual, so we stopped early. We filled in the text we read so far; check it and hit Decode again. You were not charged."
+                else:
+                    error = "That took longer than usual, so we stopped early. Please try again in a moment. You were not charged."
+            if result is None:
+                if used_paid_credit:
+                    refund_usage_paid(user_row, charge)
+                else:
+                    refund_usage(user_row, charge)
+
+        log_event(
+            "[DECODE]",
+            user_id=user_id,
+            paid_path=used_paid_credit,
+            ok=result is not None,
+            limit_reached=limit_reached,
+            deadline_exceeded=deadline_exceeded,
+            ocr_warm=bool(upload_ids),
+            total_ms=elapsed_ms(request_started),
+            **timings,
         )
-    )
+        decode_ledger.record(
+            user_id,
+            decode_id,
+            "paid" if used_paid_credit else "free",
+            usage,
+            ok=result is not None,
+            total_ms=elapsed_ms(request_started),
+        )
+
+    def render_page():
+        with span("render"):
+            return render_template_string(
+                HTML_TEMPLATE,
+                app_name=APP_NAME,
+                tagline=TAGLINE,
+                result=result,
+                error=error,
+                limit_reached=limit_reached,
+                stripe_enabled=STRIPE_ENABLED,
+                banner=banner,
+                context=context,
+                thread=thread,
+                decode_id=decode_id,
+                followups_left=FOLLOWUPS_PER_DECODE,
+                followup_max_chars=FOLLOWUP_MAX_QUESTION_CHARS,
+            )
+
+    if request.method == "GET":
+        # Only the post-checkout banner carries per-user data; every other GET
+        # renders the same bytes and is served from the precompressed cache.
+        if request.args.get("checkout") == "success":
+            page = EncodedPage(render_page().encode("utf-8"), "dynamic")
+        else:
+            page = static_page(("index", banner, STRIPE_ENABLED), render_page)
+        response = page_response(page)
+    else:
+        response = make_response(render_page())
     if needs_cookie:
         response.set_cookie(
             COOKIE_NAME,
@@ -1142,10 +4641,14 @@ def index():
 # Limit panel is rendered in the main template when limit_reached is True,
 # which is set in the index route when the daily free limit is hit.
 
+# Runs once per deploy when gunicorn preloads the app in its master process;
+# after the first boot it is a single schema_version lookup per database file.
+init_db()
+STARTUP_TIMINGS["module_ms"] = round((time.perf_counter() - STARTUP_STARTED) * 1000, 1)
+log_event("[STARTUP]", pid=os.getpid(), **STARTUP_TIMINGS)
+if STRIPE_CONFIG_PROBLEMS:
+    logger.warning("Stripe checkout disabled: %s", "; ".join(STRIPE_CONFIG_PROBLEMS))
+
 if __name__ == "__main__":
-    init_db()
     port = int(os.getenv("PORT", "8000"))
     app.run(host="0.0.0.0", port=port)
-
-
-init_db()
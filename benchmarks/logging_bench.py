@@ -0,0 +1,94 @@
+import logging
+import logging.handlers
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import JsonFormatter, NonBlockingQueueHandler  # noqa: E402
+
+CALLS = 20000
+SINK_DELAY_SECONDS = 0.00005
+
+
+class SlowSink:
+    # Stands in for a stderr pipe whose reader (the platform log drain) lags.
+
+    def __init__(self, handle, delay):
+        self._handle = handle
+        self._delay = delay
+
+    def write(self, data):
+        if self._delay:
+            time.sleep(self._delay)
+        return self._handle.write(data)
+
+    def flush(self):
+        self._handle.flush()
+
+
+def sync_logger(stream):
+    logger = logging.getLogger(f"bench.sync.{id(stream)}")
+    logger.propagate = False
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    logger.handlers[:] = [handler]
+    logger.setLevel(logging.INFO)
+    return logger, None
+
+
+def queued_logger(stream):
+    logger = logging.getLogger(f"bench.queue.{id(stream)}")
+    logger.propagate = False
+    handler = NonBlockingQueueHandler(CALLS + 1)
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+    logger.handlers[:] = [handler]
+    logger.setLevel(logging.INFO)
+    return logger, listener
+
+
+def run(logger):
+    samples = []
+    for index in range(CALLS):
+        started = time.perf_counter()
+        if logger.name.startswith("bench.sync"):
+            logger.info(
+                "[SUBMISSION] time=%s user_id=%s has_images=%s has_text=%s context_len=%s blocked=%s paid_path=%s",
+                "2024-01-01T00:00:00+00:00", f"user-{index}", True, False, 42, False, index % 3 == 0,
+            )
+        else:
+            logger.info(
+                "[SUBMISSION]",
+                extra={"fields": {
+                    "user_id": f"user-{index}", "has_images": True, "has_text": False,
+                    "context_len": 42, "blocked": False, "paid_path": index % 3 == 0,
+                }},
+            )
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return sum(samples) / len(samples), samples[int(len(samples) * 0.99)]
+
+
+def main():
+    # The queue handler is not free: against a plain file it costs the request
+    # thread a few microseconds more per call than logging inline (17.5 vs 13.8 us
+    # mean, 26.8 vs 22.3 us in an earlier run). It only pays off when the sink is
+    # slow, as a lagging stderr pipe is (13.5 vs 130 us).
+    print(f"{'sink':<10}{'handler':<10}{'mean us':>10}{'p99 us':>10}")
+    for sink_name, delay in (("file", 0), ("slow pipe", SINK_DELAY_SECONDS)):
+        for handler_name, build in (("sync", sync_logger), ("queue", queued_logger)):
+            with tempfile.TemporaryFile("w") as handle:
+                logger, listener = build(SlowSink(handle, delay))
+                mean, p99 = run(logger)
+                if listener:
+                    listener.stop()
+            print(f"{sink_name:<10}{handler_name:<10}{mean * 1e6:>10.1f}{p99 * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import HtmlSanitizer, strip_disallowed_html  # noqa: E402
+
+SIZES = [1000, 2000, 4000, 8000]
+
+
+def regex_chain(raw_html):
+    sanitized = re.sub(r"<script[^>]*>.*?</script>", "", raw_html, flags=re.DOTALL | re.IGNORECASE)
+    sanitized = re.sub(r"<style[^>]*>.*?</style>", "", sanitized, flags=re.DOTALL | re.IGNORECASE)
+    sanitized = re.sub(r"<link[^>]*?>", "", sanitized, flags=re.DOTALL | re.IGNORECASE)
+    return sanitized.strip()
+
+
+def streamed(raw_html, chunk_size=64):
+    sanitizer = HtmlSanitizer()
+    parts = [sanitizer.feed(raw_html[i:i + chunk_size]) for i in range(0, len(raw_html), chunk_size)]
+    parts.append(sanitizer.close())
+    return "".join(parts)
+
+
+INPUTS = {
+    "unclosed_script": lambda n: "<script>" * n,
+    "unterminated_tags": lambda n: "<style x" * n,
+    "comment_soup": lambda n: "<!-" * n + "<" * n,
+    "nested_divs": lambda n: '<div class="section">' * n + "</p>" * n,
+    "handlers": lambda n: '<span class="badge" onclick="x()">a</span>' * n,
+}
+
+
+def timed(fn, value):
+    start = time.perf_counter()
+    fn(value)
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{'input':<18}{'n':>7}{'regex ms':>12}{'single ms':>12}{'stream ms':>12}")
+    for name, build in INPUTS.items():
+        for n in SIZES:
+            value = build(n)
+            print(
+                f"{name:<18}{n:>7}"
+                f"{timed(regex_chain, value) * 1000:>12.2f}"
+                f"{timed(strip_disallowed_html, value) * 1000:>12.2f}"
+                f"{timed(streamed, value) * 1000:>12.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
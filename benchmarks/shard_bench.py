@@ -0,0 +1,86 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+THREADS = 12
+USERS = 2000
+SECONDS = 3.0
+SHARD_COUNTS = (1, 2, 4)
+
+
+def prepare(root, shard_count, publish):
+    paths = db.sqlite_shard_paths(os.path.join(root, f"bench{shard_count}{'p' if publish else ''}.db"), shard_count)
+    users = [str(uuid.uuid4()) for _ in range(USERS)]
+    for index, path in enumerate(paths):
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        db.apply_migrations(conn, "user")
+        if index == 0:
+            db.apply_migrations(conn, "main")
+        conn.executemany(
+            "INSERT INTO users (id, created_at) VALUES (?, '2026-01-01')",
+            [(user,) for user in users if db.shard_index(user, shard_count) == index],
+        )
+        conn.commit()
+        conn.close()
+    return paths, users
+
+
+def worker(paths, users, offset, stop, counts, publish):
+    # One short write transaction per decode, as increment_usage does: a fresh
+    # connection per request, and the shard's write lock held until commit.
+    # With publish, each write is also logged to user_invalidations on shard 0,
+    # as UserCache.publish does, which every shard layout shares.
+    done = 0
+    index = offset
+    while not stop.is_set():
+        user = users[index % len(users)]
+        index += THREADS
+        conn = sqlite3.connect(paths[db.shard_index(user, len(paths))], timeout=30)
+        conn.execute("UPDATE users SET total_decodes = total_decodes + 1 WHERE id = ?", (user,))
+        conn.commit()
+        conn.close()
+        if publish:
+            conn = sqlite3.connect(paths[0], timeout=30)
+            conn.execute(
+                "INSERT INTO user_invalidations (user_id, version, created_at) VALUES (?, 1, '2026-01-01')", (user,)
+            )
+            conn.commit()
+            conn.close()
+        done += 1
+    counts[offset] = done
+
+
+def run(root, shard_count, publish):
+    paths, users = prepare(root, shard_count, publish)
+    stop = threading.Event()
+    counts = [0] * THREADS
+    threads = [
+        threading.Thread(target=worker, args=(paths, users, offset, stop, counts, publish)) for offset in range(THREADS)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(SECONDS)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / SECONDS
+
+
+def main():
+    print(f"{'shards':<8}{'writes/s':>10}{'+ shard 0 log':>15}")
+    with tempfile.TemporaryDirectory() as root:
+        for shard_count in SHARD_COUNTS:
+            print(f"{shard_count:<8}{run(root, shard_count, False):>10.0f}{run(root, shard_count, True):>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Importing app migrates DB_PATH and routes logging through its JSON handler.
+# The pipeline never reads or writes the database, so unless the caller picked
+# one, point it at a scratch file rather than the live mil.db next to app.py.
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.gettempdir(), "bulk_decode.db"))
+
+import app  # noqa: E402
+
+logger = logging.getLogger("bulk_decode")
+
+
+class RateLimiter:
+    # Spaces calls evenly so the whole pool stays under `rate` items per second.
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate if rate else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def acquire(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def read_items(path):
+    with open(path, encoding="utf-8") as handle:
+        for line_number, line in enumerate(handle, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            item.setdefault("id", str(line_number))
+            yield item
+
+
+class PermanentFailure(Exception):
+    # An item that fails the same way on every attempt: retrying it on resume
+    # only spends time and API calls.
+    pass
+
+
+def load_finished_ids(path):
+    # Successful records and permanent failures count as finished. Transient
+    # failures, for example from an upstream outage, are retried on resume and
+    # appended again, so readers should keep the last record for each id.
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            try:
+                record = json.loads(line)
+                if record["ok"] or record.get("error_kind") == "permanent":
+                    finished.add(str(record["id"]))
+            except (ValueError, KeyError):
+                # A partially written last line from an interrupted run.
+                continue
+    return finished
+
+
+def decode_item(item, base_dir, limiter):
+    limiter.acquire()
+    started = time.monotonic()
+    usage = {}
+    record = {"id": str(item["id"]), "ok": False}
+    try:
+        ocr_started = time.monotonic()
+        transcripts = []
+        images = item.get("images") or []
+        for image_path in images:
+            try:
+                with open(os.path.join(base_dir, image_path), "rb") as handle:
+                    img_bytes = handle.read()
+            except OSError as exc:
+                raise PermanentFailure(f"missing_image: {image_path}") from exc
+            # Unlike app.ocr_image, the router raises on an upstream error, so a
+            # failed screenshot is reported rather than skipped.
+            text = app.ocr_router.recognize(img_bytes, usage=usage)
+            if not text:
+                raise PermanentFailure(f"ocr_empty: {image_path}")
+            transcripts.append(text)
+        record["ocr_ms"] = round((time.monotonic() - ocr_started) * 1000)
+
+        # An item with screenshots is decoded from them alone; its thread is only
+        # used when there are none.
+        conversation_text = "\n\n".join(transcripts) if images else (item.get("thread") or "").strip()
+        if not conversation_text:
+            raise PermanentFailure("empty_conversation")
+
+        analysis_started = time.monotonic()
+        record["result"] = app.analyze_conversation((item.get("context") or "").strip(), conversation_text, usage=usage)
+        record["analysis_ms"] = round((time.monotonic() - analysis_started) * 1000)
+        record["transcript_chars"] = len(conversation_text)
+        record["ok"] = True
+    except PermanentFailure as exc:
+        logger.warning("Skipping item %s: %s", item["id"], exc)
+        record["error"] = str(exc)
+        record["error_kind"] = "permanent"
+    except Exception as exc:
+        logger.exception("Decode failed for item %s", item["id"])
+        record["error"] = f"{type(exc).__name__}: {exc}"
+        record["error_kind"] = "transient"
+    finally:
+        record["total_ms"] = round((time.monotonic() - started) * 1000)
+        record["usage"] = usage
+    return record
+
+
+def run(args):
+    if not app.API_KEY:
+        logger.error("OPENAI_API_KEY is not set")
+        return 1
+    if args.prompt_file:
+        with open(args.prompt_file, encoding="utf-8") as handle:
+            app.ANALYSIS_SYSTEM_PROMPT = handle.read()
+
+    if args.restart and os.path.exists(args.output):
+        os.remove(args.output)
+    finished = load_finished_ids(args.output)
+    base_dir = args.image_root or os.path.dirname(os.path.abspath(args.input))
+    limiter = RateLimiter(args.rate)
+    items = (item for item in read_items(args.input) if str(item["id"]) not in finished)
+    if finished:
+        logger.info("Resuming, %s items already in %s", len(finished), args.output)
+
+    timings = []
+    failures = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool, open(args.output, "a", encoding="utf-8") as out:
+        pending = set()
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < args.workers * 2:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                pending.add(pool.submit(decode_item, item, base_dir, limiter))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = future.result()
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+                timings.append(record["total_ms"])
+                failures += int(not record["ok"])
+
+    if timings:
+        timings.sort()
+        logger.info(
+            "Decoded %s items (%s failed) p50=%sms p95=%sms",
+            len(timings),
+            failures,
+            app.percentile(timings, 0.5),
+            app.percentile(timings, 0.95),
+        )
+    return 0 if not failures else 2
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run saved conversations through the decode pipeline.")
+    parser.add_argument("input", help="JSONL file of {id, context, thread, images} records")
+    parser.add_argument(
+        "output",
+        help="JSONL file for results; also the resume checkpoint (transient failures are retried, the last line per id wins)",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="concurrent decodes (default 4)")
+    parser.add_argument("--rate", type=float, default=0, help="max items started per second (default unlimited)")
+    parser.add_argument("--image-root", help="directory image paths are relative to (default: input file's directory)")
+    parser.add_argument("--prompt-file", help="use this file as ANALYSIS_SYSTEM_PROMPT")
+    parser.add_argument("--restart", action="store_true", help="ignore existing output instead of resuming")
+    args = parser.parse_args(argv)
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+# Schema and shard layout for the SQLite databases: which file a user's rows live
+# in and the migrations each file needs. It lives outside app.py so offline tools
+# such as reshard.py can use it without importing the Flask app, which opens and
+# migrates the configured databases on import.
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Users the retention sweep may delete; also the predicate of idx_users_abandoned.
+ABANDONED_USER_FILTER = (
+    "total_decodes = 0 AND is_paid = 0 AND followup_credits = 0"
+    " AND paid_decode_credits = 0 AND lifetime_paid_decodes = 0"
+)
+
+
+def shard_index(user_id, shard_count):
+    digest = hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shard_count
+
+
+def sqlite_shard_paths(main_path, shard_count):
+    # Shard 0 is the original database file, so a single-shard setup is unchanged.
+    root, ext = os.path.splitext(main_path)
+    return [main_path] + [f"{root}.shard{index}{ext}" for index in range(1, shard_count)]
+
+
+PER_USER_TABLES = {"users": "id", "decodes": "user_id", "uploads": "user_id", "checkout_sessions": "user_id"}
+
+
+def create_user_tables(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            free_uses_today INTEGER NOT NULL DEFAULT 0,
+            free_uses_date TEXT,
+            total_decodes INTEGER NOT NULL DEFAULT 0,
+            last_decode_at TEXT,
+            is_paid INTEGER NOT NULL DEFAULT 0,
+            followup_credits INTEGER NOT NULL DEFAULT 0,
+            paid_decode_credits INTEGER NOT NULL DEFAULT 0,
+            lifetime_paid_decodes INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS decodes (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            context TEXT NOT NULL,
+            transcript TEXT NOT NULL,
+            verdict TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_decodes_user ON decodes (user_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_decodes_created ON decodes (created_at)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            status TEXT NOT NULL,
+            image BLOB,
+            transcript TEXT
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_uploads_created ON uploads (created_at)")
+    migrate_db(conn)
+
+
+def create_checkout_sessions_table(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS checkout_sessions (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            pack TEXT NOT NULL,
+            url TEXT NOT NULL,
+            base_url TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            expires_at INTEGER NOT NULL,
+            UNIQUE (user_id, pack)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_checkout_sessions_expires ON checkout_sessions (expires_at)")
+
+
+def create_image_hashes_table(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS image_hashes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phash BLOB NOT NULL,
+            aspect REAL NOT NULL,
+            transcript TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+
+
+def scope_image_hashes(conn):
+    # Transcripts were reused for any user's near-identical screenshot. Rows now
+    # belong to the uploader and carry an exact content hash plus a finer
+    # thumbnail to verify near matches; older rows have neither and are dropped.
+    conn.execute("DELETE FROM image_hashes")
+    conn.execute("ALTER TABLE image_hashes ADD COLUMN user_id TEXT NOT NULL DEFAULT ''")
+    conn.execute("ALTER TABLE image_hashes ADD COLUMN sha256 TEXT NOT NULL DEFAULT ''")
+    conn.execute("ALTER TABLE image_hashes ADD COLUMN fine BLOB")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_hashes_sha256 ON image_hashes (user_id, sha256)")
+
+
+def create_ledger_tables(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS decode_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            decode_id TEXT,
+            decode_class TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            model TEXT,
+            ok INTEGER NOT NULL,
+            calls INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cached_tokens INTEGER NOT NULL,
+            cache_hits INTEGER NOT NULL,
+            latency_ms REAL NOT NULL,
+            cost_micros INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_decode_ledger_created ON decode_ledger (created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_decode_ledger_user ON decode_ledger (user_id, created_at)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ledger_daily (
+            day TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            decode_class TEXT NOT NULL,
+            calls INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cached_tokens INTEGER NOT NULL,
+            cache_hits INTEGER NOT NULL,
+            cost_micros INTEGER NOT NULL,
+            PRIMARY KEY (day, stage, decode_class)
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ledger_histograms (
+            day TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, stage, metric, bucket)
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ledger_user_totals (
+            user_id TEXT PRIMARY KEY,
+            decodes INTEGER NOT NULL,
+            paid_decodes INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cost_micros INTEGER NOT NULL,
+            last_seen_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user_totals_cost ON ledger_user_totals (cost_micros)")
+
+
+def create_users_export_indexes(conn):
+    # The filter column comes first and id breaks ties, so a filtered export can
+    # seek straight to its keyset cursor instead of sorting the matches per page.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_last_decode ON users (last_decode_at, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_paid_credits ON users (paid_decode_credits, id)")
+
+
+def add_decode_followups(conn):
+    # Follow-up credits used to be one users.followup_credits counter, reset on
+    # every decode and shared by all retained decodes. Each decode now carries its
+    # own; a user's remaining credits move to their newest decode.
+    conn.execute("ALTER TABLE decodes ADD COLUMN followups_left INTEGER NOT NULL DEFAULT 0")
+    conn.execute(
+        """
+        UPDATE decodes
+        SET followups_left = COALESCE((SELECT followup_credits FROM users WHERE users.id = decodes.user_id), 0)
+        WHERE created_at = (SELECT MAX(created_at) FROM decodes AS newest WHERE newest.user_id = decodes.user_id)
+        """
+    )
+
+
+def create_uploads_user_index(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_uploads_user ON uploads (user_id, created_at)")
+
+
+def create_users_sweep_index(conn):
+    # Partial index: only rows the sweeper could ever delete are in it, so it stays
+    # small and each batch is a range read on free_uses_date. Without ANALYZE the
+    # planner prefers idx_users_paid_credits, so the sweep names it explicitly.
+    conn.execute(
+        f"CREATE INDEX IF NOT EXISTS idx_users_abandoned ON users (free_uses_date) WHERE {ABANDONED_USER_FILTER}"
+    )
+
+
+def create_sweep_runs_table(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sweep_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            cutoff TEXT NOT NULL,
+            users_deleted INTEGER NOT NULL DEFAULT 0,
+            bytes_reclaimed INTEGER NOT NULL DEFAULT 0,
+            shards TEXT,
+            error TEXT
+        )
+        """
+    )
+
+
+def create_api_keys_table(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS api_keys (
+            key_hash TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_api_keys_user ON api_keys (user_id)")
+
+
+def create_main_tables(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_invalidations (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+
+
+# Append new migrations to the end of a list; the list index + 1 is the schema
+# version recorded in each database file's schema_version table.
+SCHEMA_MIGRATIONS = {
+    "user": [
+        create_user_tables,
+        create_checkout_sessions_table,
+        create_users_export_indexes,
+        create_users_sweep_index,
+        add_decode_followups,
+        create_uploads_user_index,
+    ],
+    "main": [
+        create_main_tables,
+        create_image_hashes_table,
+        create_ledger_tables,
+        create_sweep_runs_table,
+        create_api_keys_table,
+        scope_image_hashes,
+    ],
+}
+
+
+def apply_migrations(conn, name):
+    migrations = SCHEMA_MIGRATIONS[name]
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+    row = conn.execute("SELECT version FROM schema_version WHERE name = ?", (name,)).fetchone()
+    if row and row["version"] >= len(migrations):
+        return 0
+
+    # Serialize against other processes booting at the same time and re-check.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT version FROM schema_version WHERE name = ?", (name,)).fetchone()
+        current = row["version"] if row else 0
+        for migration in migrations[current:]:
+            migration(conn)
+        conn.execute(
+            """
+            INSERT INTO schema_version (name, version) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET version = excluded.version
+            """,
+            (name, len(migrations)),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return max(0, len(migrations) - current)
+
+
+def migrate_db(conn):
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(users)").fetchall()}
+    additions = []
+    if "paid_decode_credits" not in columns:
+        additions.append("ALTER TABLE users ADD COLUMN paid_decode_credits INTEGER NOT NULL DEFAULT 0")
+    if "lifetime_paid_decodes" not in columns:
+        additions.append("ALTER TABLE users ADD COLUMN lifetime_paid_decodes INTEGER NOT NULL DEFAULT 0")
+    if "version" not in columns:
+        additions.append("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    for statement in additions:
+        try:
+            conn.execute(statement)
+        except Exception:
+            logger.exception("Database migration failed")
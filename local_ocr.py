@@ -0,0 +1,50 @@
+# On-box OCR for chat screenshots, run in worker processes by app.TesseractOcrEngine.
+# Needs the tesseract binary plus the pytesseract and Pillow packages. It lives
+# outside app.py so pool workers import only this module, not the Flask app.
+import io
+import os
+
+import pytesseract
+from PIL import Image, ImageOps, ImageStat
+
+# Screenshots narrower than this are upscaled; Tesseract misreads small UI fonts.
+MIN_WIDTH = 1000
+# --psm 4: a single column of text of variable sizes, which is what a chat is.
+TESSERACT_CONFIG = "--psm 4"
+
+
+def init_worker():
+    # One Tesseract thread per pool process; the pool size sets the parallelism.
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+def prepare_image(img_bytes):
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(img_bytes))).convert("L")
+    if ImageStat.Stat(image).mean[0] < 128:
+        # Dark mode: Tesseract expects dark text on a light background.
+        image = ImageOps.invert(image)
+    image = ImageOps.autocontrast(image)
+    if image.width < MIN_WIDTH:
+        scale = MIN_WIDTH / image.width
+        image = image.resize((MIN_WIDTH, round(image.height * scale)), Image.LANCZOS)
+    return image
+
+
+def recognize(img_bytes):
+    # Returns lines in reading order and the mean word confidence (0-100).
+    data = pytesseract.image_to_data(
+        prepare_image(img_bytes),
+        config=TESSERACT_CONFIG,
+        output_type=pytesseract.Output.DICT,
+    )
+    lines = {}
+    confidences = []
+    for index, word in enumerate(data["text"]):
+        confidence = float(data["conf"][index])
+        if confidence < 0 or not word.strip():
+            continue
+        key = (data["block_num"][index], data["par_num"][index], data["line_num"][index])
+        lines.setdefault(key, []).append(word.strip())
+        confidences.append(confidence)
+    text = "\n".join(" ".join(words) for words in lines.values())
+    return text, sum(confidences) / len(confidences) if confidences else 0.0
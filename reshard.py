@@ -0,0 +1,100 @@
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+
+import db
+
+logger = logging.getLogger("reshard")
+
+# Same default as app.DB_PATH; importing app would open and migrate the live databases.
+DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.dirname(__file__), "mil.db"))
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def move_table(table, shard_key, source_index, source, targets, to_shards, batch_size):
+    moved = 0
+    last_id = ""
+    while True:
+        rows = source.execute(
+            f"SELECT * FROM {table} WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            return moved
+        last_id = rows[-1]["id"]
+
+        by_target = {}
+        for row in rows:
+            target = db.shard_index(row[shard_key], to_shards)
+            if target != source_index:
+                by_target.setdefault(target, []).append(row)
+
+        for target, batch in by_target.items():
+            columns = batch[0].keys()
+            placeholders = ", ".join("?" for _ in columns)
+            # Copy first, then delete, so an interrupted run can simply be rerun.
+            targets[target].executemany(
+                f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+                [tuple(row) for row in batch],
+            )
+            targets[target].commit()
+            source.executemany(f"DELETE FROM {table} WHERE id = ?", [(row["id"],) for row in batch])
+            source.commit()
+            moved += len(batch)
+
+
+def reshard(db_path, from_shards, to_shards, batch_size):
+    source_paths = db.sqlite_shard_paths(db_path, from_shards)
+    target_paths = db.sqlite_shard_paths(db_path, to_shards)
+    targets = {}
+    for index, path in enumerate(target_paths):
+        targets[index] = connect(path)
+        # New shard files start out ready for the retention sweep's incremental vacuum.
+        targets[index].execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.apply_migrations(targets[index], "user")
+
+    totals = {table: 0 for table in db.PER_USER_TABLES}
+    for source_index, path in enumerate(source_paths):
+        if not os.path.exists(path):
+            continue
+        source = targets[source_index] if source_index in targets else connect(path)
+        db.apply_migrations(source, "user")
+        for table, shard_key in db.PER_USER_TABLES.items():
+            moved = move_table(table, shard_key, source_index, source, targets, to_shards, batch_size)
+            totals[table] += moved
+            logger.info("shard %s: moved %s %s rows", source_index, moved, table)
+
+    for path in source_paths[len(target_paths):]:
+        logger.info("%s is now empty and can be removed", path)
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=(
+            "Move per-user rows between SQLite shards. Stop the app first, run this, "
+            "then deploy with USER_SHARDS set to the new count."
+        )
+    )
+    parser.add_argument("--from-shards", type=int, required=True, help="shard count the data is laid out for now")
+    parser.add_argument("--to-shards", type=int, required=True, help="shard count to move the data to")
+    parser.add_argument("--db-path", default=DB_PATH, help="main database file (shard 0)")
+    parser.add_argument("--batch-size", type=int, default=500, help="rows copied per transaction")
+    args = parser.parse_args(argv)
+
+    if args.from_shards < 1 or args.to_shards < 1:
+        parser.error("shard counts must be at least 1")
+
+    totals = reshard(args.db_path, args.from_shards, args.to_shards, args.batch_size)
+    logger.info("Done: %s", ", ".join(f"{table}={count}" for table, count in totals.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Set before app is imported: it opens DB_PATH and migrates it at import time.
+TEST_ROOT = tempfile.mkdtemp(prefix="mil-tests-")
+os.environ["DB_PATH"] = os.path.join(TEST_ROOT, "mil.db")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("ADMIN_TOKEN", "test-admin")
+
+import app as app_module  # noqa: E402
+
+
+def offline_completion(model, **kwargs):
+    raise RuntimeError("tests must not call the OpenAI API")
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # Every test gets its own empty database files, a cold user cache and an
+    # OpenAI client that refuses to make network calls.
+    monkeypatch.setattr(app_module, "storage", app_module.SqliteShardBackend(str(tmp_path / "mil.db"), 2))
+    monkeypatch.setattr(app_module, "user_cache", app_module.UserCache(100, 60))
+    completions = types.SimpleNamespace(create=offline_completion)
+    monkeypatch.setattr(app_module, "openai_client", types.SimpleNamespace(chat=types.SimpleNamespace(completions=completions)))
+    app_module.init_db()
+    yield app_module
+    # Background upload OCR must not outlive the patches it was started under.
+    for future in list(app_module.upload_futures.values()):
+        future.cancel()
+        try:
+            future.result(5)
+        except BaseException:
+            pass
+
+
+@pytest.fixture
+def client(app):
+    return app.app.test_client()
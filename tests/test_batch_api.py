@@ -0,0 +1,115 @@
+import json
+import types
+
+import pytest
+
+
+@pytest.fixture
+def upstream(app, monkeypatch):
+    state = types.SimpleNamespace(fail=False)
+
+    def create(model, **kwargs):
+        if state.fail:
+            raise RuntimeError("upstream down")
+        message = types.SimpleNamespace(content="<p>verdict</p>")
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None, model=model)
+
+    client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+    monkeypatch.setattr(app, "openai_client", client)
+    return state
+
+
+def paid_user(app, user_id, credits=3, last_decode_at=None):
+    app.load_or_create_user(user_id)
+    with app.get_db_connection(user_id) as conn:
+        conn.execute(
+            "UPDATE users SET paid_decode_credits = ?, last_decode_at = ?, version = version + 1 WHERE id = ?",
+            (credits, last_decode_at, user_id),
+        )
+        conn.commit()
+    app.user_cache.invalidate(user_id)
+    return app.load_or_create_user(user_id)
+
+
+def user_count(app):
+    total = 0
+    for shard in app.storage.shards():
+        with app.storage.connect(shard) as conn:
+            total += conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    return total
+
+
+def batch(client, headers=None):
+    return client.post("/api/decode/batch", json={"conversations": [{"thread": "Sam: hi"}]}, headers=headers or {})
+
+
+def test_unknown_tokens_are_rejected_without_creating_users(app, client, upstream):
+    paid_user(app, "user-a")
+    assert batch(client, {"Authorization": "Bearer mil_not-a-key"}).status_code == 401
+    # A raw user id is not an API key.
+    assert batch(client, {"Authorization": "Bearer user-a"}).status_code == 401
+    client.set_cookie("mil_uid", "never-seen")
+    assert batch(client).status_code == 401
+    assert user_count(app) == 1
+
+
+def test_issued_key_authenticates_and_rotates(app, client, upstream):
+    paid_user(app, "user-a", credits=2)
+    client.set_cookie("mil_uid", "user-a")
+    first = client.post("/api/keys").get_json()["api_key"]
+    second = client.post("/api/keys").get_json()["api_key"]
+    assert first != second
+
+    other = app.app.test_client()
+    assert batch(other, {"Authorization": f"Bearer {first}"}).status_code == 401
+    response = batch(other, {"Authorization": f"Bearer {second}"})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert lines[0]["ok"] is True
+    assert app.load_or_create_user("user-a", fresh=True)["paid_decode_credits"] == 1
+
+
+def test_batch_items_use_their_own_scheduler_class(app, client, upstream, monkeypatch):
+    scheduler = app.DecodeScheduler(app.DECODE_SLOTS, app.PAID_RESERVED_SLOTS, app.DECODE_CLASS_WEIGHTS)
+    monkeypatch.setattr(app, "decode_scheduler", scheduler)
+    paid_user(app, "user-a")
+    client.set_cookie("mil_uid", "user-a")
+    assert batch(client).status_code == 200
+    snapshot = scheduler.snapshot()
+    assert snapshot["batch"]["admitted"] == 1
+    assert snapshot["paid"]["admitted"] == 0
+
+
+def test_keys_need_a_purchase(app, client):
+    app.load_or_create_user("user-free")
+    client.set_cookie("mil_uid", "user-free")
+    assert client.post("/api/keys").status_code == 402
+    client.set_cookie("mil_uid", "nobody")
+    assert client.post("/api/keys").status_code == 401
+
+
+def test_failed_item_refunds_credit_and_last_decode(app, client, upstream):
+    user_row = paid_user(app, "user-a", credits=2, last_decode_at="2026-01-01T00:00:00+00:00")
+    client.set_cookie("mil_uid", "user-a")
+    upstream.fail = True
+    lines = [json.loads(line) for line in batch(client).data.decode().splitlines()]
+    assert lines[0]["error"] == "analysis_failed"
+    after = app.load_or_create_user(user_row["id"], fresh=True)
+    assert after["paid_decode_credits"] == 2
+    assert after["total_decodes"] == 0
+    assert after["last_decode_at"] == "2026-01-01T00:00:00+00:00"
+
+
+def test_refund_keeps_a_later_decode_stamp(app):
+    user_row = paid_user(app, "user-a", credits=2, last_decode_at="2026-01-01T00:00:00+00:00")
+    first = app.increment_usage_paid(user_row)
+    second = app.increment_usage_paid(user_row)
+    app.refund_usage_paid(user_row, first)
+    after = app.load_or_create_user("user-a", fresh=True)
+    assert after["last_decode_at"] == second["charged_at"]
+    assert after["paid_decode_credits"] == 1
+
+
+def test_no_charge_without_credits(app):
+    user_row = paid_user(app, "user-a", credits=0)
+    assert app.increment_usage_paid(user_row) is None
@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+import bulk_decode
+
+
+@pytest.fixture
+def flaky_analysis(app, monkeypatch):
+    calls = []
+
+    def analyze(context, conversation_text, usage=None, deadline=None):
+        calls.append(conversation_text)
+        if conversation_text == "flaky" and calls.count("flaky") == 1:
+            raise RuntimeError("upstream outage")
+        return "<p>ok</p>"
+
+    monkeypatch.setattr(app, "analyze_conversation", analyze)
+    return calls
+
+
+def write_jsonl(path, records):
+    path.write_text("".join(json.dumps(record) + "\n" for record in records), encoding="utf-8")
+
+
+def read_jsonl(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_successful_and_permanently_failed_records_are_finished(tmp_path):
+    output = tmp_path / "out.jsonl"
+    write_jsonl(
+        output,
+        [
+            {"id": "1", "ok": True},
+            {"id": "2", "ok": False, "error_kind": "transient"},
+            {"id": "3", "ok": False, "error_kind": "permanent"},
+            {"id": "4", "ok": False},
+        ],
+    )
+    with open(output, "a", encoding="utf-8") as handle:
+        handle.write('{"id": "5", "o')
+    assert bulk_decode.load_finished_ids(str(output)) == {"1", "3"}
+
+
+def test_resume_retries_failed_items(tmp_path, flaky_analysis):
+    source = tmp_path / "in.jsonl"
+    output = tmp_path / "out.jsonl"
+    write_jsonl(source, [{"id": "a", "thread": "steady"}, {"id": "b", "thread": "flaky"}])
+
+    assert bulk_decode.main([str(source), str(output), "--workers", "1"]) == 2
+    assert bulk_decode.main([str(source), str(output), "--workers", "1"]) == 0
+
+    latest = {record["id"]: record for record in read_jsonl(output)}
+    assert latest["a"]["ok"] and latest["b"]["ok"]
+    assert flaky_analysis.count("steady") == 1
+    assert flaky_analysis.count("flaky") == 2
+
+
+def test_resume_skips_permanent_failures(tmp_path, flaky_analysis):
+    source = tmp_path / "in.jsonl"
+    output = tmp_path / "out.jsonl"
+    write_jsonl(source, [{"id": "empty", "thread": "  "}, {"id": "missing", "images": ["gone.png"]}])
+
+    assert bulk_decode.main([str(source), str(output), "--workers", "1"]) == 2
+    assert bulk_decode.main([str(source), str(output), "--workers", "1"]) == 0
+
+    records = read_jsonl(output)
+    assert {record["id"]: record["error"] for record in records} == {
+        "empty": "empty_conversation",
+        "missing": "missing_image: gone.png",
+    }
+    assert {record["error_kind"] for record in records} == {"permanent"}
+    assert flaky_analysis == []
+
+
+def test_ocr_failure_is_reported_not_replaced_by_the_thread(app, tmp_path, flaky_analysis, monkeypatch):
+    def recognize(img_bytes, usage=None, deadline=None):
+        raise RuntimeError("ocr outage")
+
+    monkeypatch.setattr(app.ocr_router, "recognize", recognize)
+    (tmp_path / "shot.png").write_bytes(b"png")
+    item = {"id": "a", "thread": "steady", "images": ["shot.png"]}
+
+    record = bulk_decode.decode_item(item, str(tmp_path), bulk_decode.RateLimiter(0))
+    assert not record["ok"]
+    assert record["error"] == "RuntimeError: ocr outage"
+    assert record["error_kind"] == "transient"
+    assert flaky_analysis == []
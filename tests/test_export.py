@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+
+def export(app, export_format):
+    chunks = []
+    with pytest.raises(RuntimeError):
+        for chunk in app.stream_users_export(export_format, False, None):
+            chunks.append(chunk)
+    return chunks
+
+
+@pytest.fixture
+def failing_pages(app, monkeypatch):
+    for user_id in ("user-a", "user-b"):
+        app.load_or_create_user(user_id)
+
+    real_pages = app.export_user_pages
+
+    def pages(shard, paid_only, active_since):
+        if shard > 0:
+            raise RuntimeError("shard unavailable")
+        yield from real_pages(shard, paid_only, active_since)
+
+    monkeypatch.setattr(app, "export_user_pages", pages)
+
+
+def test_failed_csv_export_ends_with_error_marker(app, failing_pages):
+    chunks = export(app, "csv")
+    assert chunks[-1].startswith("#ERROR export failed after ")
+
+
+def test_failed_ndjson_export_ends_with_error_marker(app, failing_pages):
+    chunks = export(app, "ndjson")
+    marker = json.loads(chunks[-1])
+    assert marker["error"] == "export_failed"
+    assert marker["rows_exported"] == sum(chunk.count("\n") for chunk in chunks[:-1])
+
+
+def test_complete_export_has_no_marker(app):
+    app.load_or_create_user("user-a")
+    body = "".join(app.stream_users_export("csv", False, None))
+    assert "#ERROR" not in body
+    assert body.count("\n") == 2
@@ -0,0 +1,105 @@
+import sqlite3
+import threading
+import types
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def upstream(app, monkeypatch):
+    state = types.SimpleNamespace(calls=0, fail=False, gate=None)
+
+    def create(model, **kwargs):
+        state.calls += 1
+        if state.gate is not None:
+            state.gate.wait(5)
+        if state.fail:
+            raise RuntimeError("upstream down")
+        message = types.SimpleNamespace(content="<p>answer</p>")
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None, model=model)
+
+    client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+    monkeypatch.setattr(app, "openai_client", client)
+    return state
+
+
+def new_decode(app, user_id):
+    user_row = app.load_or_create_user(user_id)
+    return app.save_decode(user_row, "ctx", "Sam: hi", "<p>verdict</p>")
+
+
+def ask(client, user_id, decode_id):
+    client.set_cookie("mil_uid", user_id)
+    return client.post("/followup", json={"decode_id": decode_id, "question": "why?"})
+
+
+def test_credits_belong_to_each_decode(app, client, upstream):
+    first = new_decode(app, "user-a")
+    second = new_decode(app, "user-a")
+    for left in range(app.FOLLOWUPS_PER_DECODE - 1, -1, -1):
+        response = ask(client, "user-a", first)
+        assert response.status_code == 200
+        assert response.get_json()["followups_left"] == left
+    assert ask(client, "user-a", first).status_code == 403
+    # Using up the first decode's questions leaves the second decode's alone.
+    assert ask(client, "user-a", second).get_json()["followups_left"] == app.FOLLOWUPS_PER_DECODE - 1
+
+
+def test_new_decode_does_not_refill_old_one(app, client, upstream):
+    first = new_decode(app, "user-a")
+    for _ in range(app.FOLLOWUPS_PER_DECODE):
+        ask(client, "user-a", first)
+    new_decode(app, "user-a")
+    assert ask(client, "user-a", first).status_code == 403
+
+
+def test_credit_refunded_when_upstream_fails(app, client, upstream):
+    decode_id = new_decode(app, "user-a")
+    upstream.fail = True
+    assert ask(client, "user-a", decode_id).status_code == 502
+    upstream.fail = False
+    assert ask(client, "user-a", decode_id).get_json()["followups_left"] == app.FOLLOWUPS_PER_DECODE - 1
+
+
+def test_concurrent_questions_never_exceed_credits(app, upstream):
+    decode_id = new_decode(app, "user-a")
+    upstream.gate = threading.Event()
+    statuses = []
+
+    def worker():
+        client = app.app.test_client()
+        statuses.append(ask(client, "user-a", decode_id).status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(app.FOLLOWUPS_PER_DECODE + 3)]
+    for thread in threads:
+        thread.start()
+    upstream.gate.set()
+    for thread in threads:
+        thread.join()
+    assert statuses.count(200) == app.FOLLOWUPS_PER_DECODE
+    assert statuses.count(403) == 3
+    # Rejected requests were turned away before reaching upstream.
+    assert upstream.calls == app.FOLLOWUPS_PER_DECODE
+
+
+def test_other_users_cannot_spend_a_decode(app, client, upstream):
+    decode_id = new_decode(app, "user-a")
+    assert ask(client, "user-b", decode_id).status_code == 404
+
+
+def test_migration_moves_user_credits_to_newest_decode(app, tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    db.create_user_tables(conn)
+    conn.execute("INSERT INTO users (id, created_at, followup_credits) VALUES ('u', '2026-01-01', 2)")
+    conn.execute("INSERT INTO decodes VALUES ('old', 'u', '2026-01-01T00:00', '', '', '')")
+    conn.execute("INSERT INTO decodes VALUES ('new', 'u', '2026-01-02T00:00', '', '', '')")
+    conn.execute("CREATE TABLE schema_version (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+    conn.execute("INSERT INTO schema_version VALUES ('user', 1)")
+    conn.commit()
+    db.apply_migrations(conn, "user")
+    rows = dict(conn.execute("SELECT id, followups_left FROM decodes").fetchall())
+    assert rows == {"old": 0, "new": 2}
@@ -0,0 +1,59 @@
+import io
+
+import pytest
+
+PIL = pytest.importorskip("PIL")
+from PIL import Image, ImageDraw, ImageFont  # noqa: E402
+
+LINES = ["Sam: are we still on for friday", "Me: yes! 7pm?", "Sam: perfect see you there", "Me: cant wait"]
+
+
+def screenshot(lines, fmt="PNG"):
+    image = Image.new("RGB", (720, 1280), "white")
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=40)
+    for index, line in enumerate(lines):
+        top = 100 + index * 200
+        draw.rounded_rectangle((40, top, 680, top + 120), radius=30, fill=(225, 235, 250))
+        draw.text((70, top + 35), line, fill="black", font=font)
+    output = io.BytesIO()
+    image.save(output, format=fmt, quality=90)
+    return output.getvalue()
+
+
+@pytest.fixture
+def ocr_calls(app, monkeypatch):
+    calls = []
+
+    def recognize(img_bytes, usage=None, deadline=None):
+        calls.append(img_bytes)
+        return f"transcript {len(calls)}"
+
+    monkeypatch.setattr(app, "image_hash_index", app.ImageHashIndex(100))
+    monkeypatch.setattr(app.ocr_router, "recognize", recognize)
+    return calls
+
+
+def test_identical_and_reencoded_screenshots_reuse_the_users_transcript(app, ocr_calls):
+    assert app.ocr_image(screenshot(LINES), user_id="user-a") == "transcript 1"
+    assert app.ocr_image(screenshot(LINES), user_id="user-a") == "transcript 1"
+    assert app.ocr_image(screenshot(LINES, "JPEG"), user_id="user-a") == "transcript 1"
+    stats = app.image_hash_index.stats()
+    assert (stats["hits"], stats["near_hits"], len(ocr_calls)) == (1, 1, 1)
+
+
+def test_transcripts_are_not_shared_between_users(app, ocr_calls):
+    app.ocr_image(screenshot(LINES), user_id="user-a")
+    assert app.ocr_image(screenshot(LINES), user_id="user-b") == "transcript 2"
+    assert app.ocr_image(screenshot(LINES), user_id=None) == "transcript 3"
+
+
+def test_near_match_with_different_text_is_ocrd_again(app, ocr_calls):
+    app.ocr_image(screenshot(LINES), user_id="user-a")
+    edited = LINES[:-1] + ["Me: cant walt"]
+    first, second = (app.perceptual_hash(screenshot(lines)) for lines in (LINES, edited))
+    # The coarse hash alone would have reused the first transcript.
+    assert bin(first[0] ^ second[0]).count("1") <= app.PHASH_MAX_DISTANCE
+
+    assert app.ocr_image(screenshot(edited), user_id="user-a") == "transcript 2"
+    assert app.image_hash_index.stats()["rejected"] == 1
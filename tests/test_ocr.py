@@ -0,0 +1,77 @@
+import sys
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import pytest
+
+
+@pytest.fixture
+def local_engine(app, monkeypatch):
+    gate = threading.Event()
+    calls = []
+
+    def recognize(img_bytes):
+        calls.append(img_bytes)
+        gate.wait(5)
+        return "Sam: hi there you", 95.0
+
+    monkeypatch.setitem(sys.modules, "local_ocr", types.SimpleNamespace(recognize=recognize))
+    monkeypatch.setattr(app, "OCR_LOCAL_QUEUE_SECONDS", 0.1)
+    monkeypatch.setattr(app, "OCR_LOCAL_TIMEOUT_SECONDS", 0.1)
+    pool = ThreadPoolExecutor(max_workers=1)
+    engine = app.TesseractOcrEngine(1, 2)
+    engine.pool = pool
+    yield types.SimpleNamespace(engine=engine, gate=gate, calls=calls)
+    gate.set()
+    pool.shutdown(wait=True)
+
+
+def test_local_ocr_is_opt_in(app):
+    assert app.OCR_ENGINE == "remote"
+    assert app.OcrRouter("remote").local is None
+
+
+def test_tesseract_mode_without_tesseract_falls_back_to_remote(app, monkeypatch, caplog):
+    monkeypatch.setattr(app.TesseractOcrEngine, "available", lambda self: False)
+    router = app.OcrRouter("tesseract")
+    assert router.local is None
+    assert router.remote is not None
+    assert "tesseract is not installed" in caplog.text
+
+
+def test_queue_wait_has_its_own_budget_and_abandoned_jobs_are_cancelled(app, local_engine):
+    engine = local_engine.engine
+    # The running job overruns the run timeout; the caller stops waiting but the
+    # job still holds its worker and its pending slot.
+    with pytest.raises(FutureTimeout):
+        engine.recognize(b"first")
+    assert engine.pending == 1
+
+    # The next job cannot reach the busy worker within the queue budget, so it is
+    # cancelled before it ever runs.
+    with pytest.raises(app.LocalOcrBusy):
+        engine.recognize(b"second")
+    assert engine.pending == 1
+    assert local_engine.calls == [b"first"]
+
+    local_engine.gate.set()
+    assert engine.recognize(b"third") == ("Sam: hi there you", 95.0)
+    assert engine.pending == 0
+    assert engine.snapshot()["queue_ms"]["p50"] < 100
+
+
+def test_full_queue_escalates_without_submitting(app, local_engine, monkeypatch):
+    engine = local_engine.engine
+    engine.max_pending = 1
+    with pytest.raises(FutureTimeout):
+        engine.recognize(b"first")
+
+    router = app.OcrRouter("remote")
+    router.local = engine
+    router.remote = types.SimpleNamespace(recognize=lambda img_bytes, usage=None, deadline=None: ("remote text", None))
+    router.mode = "auto"
+    assert router.recognize(b"second") == "remote text"
+    assert router.counts["local_busy"] == 1
+    assert local_engine.calls == [b"first"]
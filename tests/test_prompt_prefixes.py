@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+# Static text allowed after the first per-request byte: JSON framing and short
+# labels such as "Text conversation: ". Moving instructions behind user content,
+# or putting a per-request value into a system prompt, pushes a stage past this.
+MAX_TRAILING_STATIC_CHARS = 120
+
+SAMPLES = (
+    {
+        "b64": "QUFBQUFB",
+        "context": "Second date was last Friday",
+        "transcript": "Sam: had fun!!\nMe: same, let's do it again\nSam: for sure, this week is crazy though",
+        "verdict": '<div class="quick-take">Interested but busy.</div>',
+        "question": "Should I read into the double exclamation?",
+    },
+    {
+        "b64": "Wlpa",
+        "context": "coworker",
+        "transcript": "Alex: k\nMe: ok?",
+        "verdict": '<div class="quick-take">Cold.</div>',
+        "question": "Why so short?",
+    },
+)
+EMPTY = {"b64": "", "context": "", "transcript": "", "verdict": "", "question": ""}
+LONG_TRANSCRIPT = "\n".join(f"Sam: message number {index} about the weekend plans" for index in range(120))
+
+
+def decode_row(sample):
+    return {"context": sample["context"], "transcript": sample["transcript"], "verdict": sample["verdict"]}
+
+
+def serialize(messages):
+    return json.dumps(messages, ensure_ascii=False)
+
+
+def common_prefix_len(first, second):
+    length = 0
+    for left, right in zip(first, second):
+        if left != right:
+            break
+        length += 1
+    return length
+
+
+def stages(app):
+    return {
+        "ocr": lambda sample: app.build_ocr_messages(sample["b64"]),
+        "analysis": lambda sample: app.build_analysis_messages(sample["context"], sample["transcript"]),
+        # Repeat follow-ups on one decode should share everything but the question.
+        "followup": lambda sample: app.build_followup_messages(decode_row(SAMPLES[0]), sample["question"]),
+        "followup_long": lambda sample: app.build_followup_messages(
+            {**decode_row(SAMPLES[0]), "transcript": LONG_TRANSCRIPT}, sample["question"]
+        ),
+    }
+
+
+@pytest.mark.parametrize("name", ["ocr", "analysis", "followup", "followup_long"])
+def test_static_prompt_content_comes_first(app, name):
+    build = stages(app)[name]
+    first, second = (serialize(build(sample)) for sample in SAMPLES)
+    static = serialize(build(EMPTY))
+    assert serialize(build(SAMPLES[0])) == first
+
+    prefix = min(common_prefix_len(first, second), common_prefix_len(first, static), common_prefix_len(second, static))
+    assert len(static) - prefix <= MAX_TRAILING_STATIC_CHARS
+
+
+def test_long_decode_followup_extends_the_analysis_request(app):
+    for sample in SAMPLES:
+        row = {**decode_row(sample), "transcript": LONG_TRANSCRIPT}
+        analysis = app.build_analysis_messages(row["context"], row["transcript"])
+        assert app.estimated_tokens(analysis) >= app.PROMPT_CACHE_MIN_TOKENS
+        followup = app.build_followup_messages(row, sample["question"])
+        assert followup[: len(analysis)] == analysis
+
+
+def test_short_decode_followup_leaves_out_the_uncacheable_analysis_prompt(app):
+    for sample in SAMPLES:
+        analysis = app.build_analysis_messages(sample["context"], sample["transcript"])
+        assert app.estimated_tokens(analysis) < app.PROMPT_CACHE_MIN_TOKENS
+        followup = app.build_followup_messages(decode_row(sample), sample["question"])
+        assert all(message["content"] != app.ANALYSIS_SYSTEM_PROMPT for message in followup)
+        assert sample["transcript"] in followup[-1]["content"]
+        assert sample["verdict"] in followup[-1]["content"]
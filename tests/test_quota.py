@@ -0,0 +1,116 @@
+import types
+
+import pytest
+
+
+@pytest.fixture
+def upstream(app, monkeypatch):
+    state = types.SimpleNamespace(calls=0, fail=False)
+
+    def create(model, **kwargs):
+        state.calls += 1
+        if state.fail:
+            raise RuntimeError("upstream down")
+        message = types.SimpleNamespace(content="<p>verdict</p>")
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None, model=model)
+
+    client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+    monkeypatch.setattr(app, "openai_client", client)
+    return state
+
+
+def set_user(app, user_id, **columns):
+    assignments = ", ".join(f"{column} = ?" for column in columns)
+    with app.get_db_connection(user_id) as conn:
+        conn.execute(f"UPDATE users SET {assignments}, version = version + 1 WHERE id = ?", (*columns.values(), user_id))
+        conn.commit()
+
+
+def today(app):
+    return app.dt.datetime.now(app.dt.timezone.utc).date().isoformat()
+
+
+def test_limit_enforced_against_database_not_cached_row(app):
+    stale = app.load_or_create_user("user-a")
+    # Another worker used up the day's free decodes; this worker still caches 0.
+    set_user(app, "user-a", free_uses_today=app.FREE_DECODES_PER_DAY, free_uses_date=today(app))
+    assert app.increment_usage(stale) is None
+    row = app.load_or_create_user("user-a", fresh=True)
+    assert row["free_uses_today"] == app.FREE_DECODES_PER_DAY
+    assert row["total_decodes"] == 0
+
+
+def test_new_day_resets_inside_the_charge(app):
+    user_row = app.load_or_create_user("user-a")
+    set_user(app, "user-a", free_uses_today=app.FREE_DECODES_PER_DAY, free_uses_date="2000-01-01")
+    assert app.increment_usage(user_row)
+    row = app.load_or_create_user("user-a", fresh=True)
+    assert row["free_uses_today"] == 1 and row["free_uses_date"] == today(app)
+
+
+def invalidations(app):
+    with app.get_db_connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM user_invalidations").fetchone()[0]
+
+
+def test_charges_and_refunds_do_not_write_to_the_main_database(app):
+    user_row = app.load_or_create_user("user-a")
+    before = invalidations(app)
+    charge = app.increment_usage(user_row)
+    app.refund_usage(user_row, charge)
+    assert invalidations(app) == before
+
+
+def test_published_writes_invalidate_other_workers(app):
+    other_worker = app.UserCache(100, 60)
+    assert other_worker.get("user-a") is None  # first sync records the starting point
+    user_row = app.load_or_create_user("user-a")
+    other_worker.put(user_row)
+
+    set_user(app, "user-a", paid_decode_credits=10)
+    app.user_cache.publish(app.load_or_create_user("user-a", fresh=True))
+    other_worker._next_sync = 0.0
+    assert other_worker.get("user-a") is None
+
+
+def test_submit_decides_on_the_stored_row_not_a_stale_cache(app, client, upstream):
+    app.load_or_create_user("user-a")
+    set_user(app, "user-a", paid_decode_credits=1)
+    app.load_or_create_user("user-a", fresh=True)
+    # Another worker spent the credit; this worker's cache still shows it.
+    set_user(app, "user-a", paid_decode_credits=0)
+    client.set_cookie("mil_uid", "user-a")
+    assert b"verdict" in client.post("/", data={"thread": "Sam: hi"}).data
+    row = app.load_or_create_user("user-a", fresh=True)
+    assert row["free_uses_today"] == 1 and row["paid_decode_credits"] == 0
+
+
+def test_decode_past_the_limit_never_reaches_upstream(app, client, upstream):
+    client.set_cookie("mil_uid", "user-a")
+    for _ in range(app.FREE_DECODES_PER_DAY):
+        assert b"verdict" in client.post("/", data={"thread": "Sam: hi"}).data
+    calls = upstream.calls
+    client.post("/", data={"thread": "Sam: hi"})
+    assert upstream.calls == calls
+    assert app.load_or_create_user("user-a", fresh=True)["free_uses_today"] == app.FREE_DECODES_PER_DAY
+
+
+def test_failed_decode_is_refunded(app, client, upstream):
+    client.set_cookie("mil_uid", "user-a")
+    upstream.fail = True
+    client.post("/", data={"thread": "Sam: hi"})
+    row = app.load_or_create_user("user-a", fresh=True)
+    assert row["free_uses_today"] == 0
+    assert row["total_decodes"] == 0
+    assert row["last_decode_at"] is None
+
+
+def test_paid_decode_is_refunded_on_failure(app, client, upstream):
+    app.load_or_create_user("user-a")
+    set_user(app, "user-a", paid_decode_credits=1)
+    client.set_cookie("mil_uid", "user-a")
+    upstream.fail = True
+    client.post("/", data={"thread": "Sam: hi"})
+    row = app.load_or_create_user("user-a", fresh=True)
+    assert row["paid_decode_credits"] == 1
+    assert row["lifetime_paid_decodes"] == 0
@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import db
+import reshard
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def seed(path, users):
+    conn = connect(path)
+    db.apply_migrations(conn, "user")
+    for user in users:
+        conn.execute("INSERT INTO users (id, created_at) VALUES (?, '2026-01-01')", (user,))
+        conn.execute("INSERT INTO decodes VALUES (?, ?, '', '', '', '', 0)", (f"d-{user}", user))
+    conn.commit()
+    conn.close()
+
+
+def layout(db_path, shard_count):
+    found = {}
+    for index, path in enumerate(db.sqlite_shard_paths(db_path, shard_count)):
+        if not os.path.exists(path):
+            continue
+        conn = connect(path)
+        for row in conn.execute("SELECT id FROM users"):
+            found[row["id"]] = index
+        for row in conn.execute("SELECT user_id FROM decodes"):
+            assert found[row["user_id"]] == index
+        conn.close()
+    return found
+
+
+def test_apply_migrations_is_versioned(tmp_path):
+    conn = connect(str(tmp_path / "fresh.db"))
+    assert db.apply_migrations(conn, "user") == len(db.SCHEMA_MIGRATIONS["user"])
+    assert db.apply_migrations(conn, "user") == 0
+    version = conn.execute("SELECT version FROM schema_version WHERE name = 'user'").fetchone()[0]
+    assert version == len(db.SCHEMA_MIGRATIONS["user"])
+
+
+def test_reshard_moves_rows_to_their_shard_and_back(tmp_path):
+    db_path = str(tmp_path / "mil.db")
+    users = [f"user-{index}" for index in range(40)]
+    seed(db_path, users)
+
+    totals = reshard.reshard(db_path, 1, 3, batch_size=7)
+    found = layout(db_path, 3)
+    assert found == {user: db.shard_index(user, 3) for user in users}
+    assert totals["users"] == totals["decodes"] == sum(1 for index in found.values() if index)
+
+    # Rerunning an interrupted or finished move changes nothing.
+    assert reshard.reshard(db_path, 3, 3, batch_size=7)["users"] == 0
+
+    reshard.reshard(db_path, 3, 1, batch_size=7)
+    assert layout(db_path, 1) == {user: 0 for user in users}
+
+
+def test_reshard_does_not_import_app():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, "-c", "import sys, reshard; sys.exit('app' in sys.modules)"],
+        cwd=root,
+        capture_output=True,
+    )
+    assert result.returncode == 0, result.stderr
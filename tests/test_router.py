@@ -0,0 +1,120 @@
+import threading
+import time
+import types
+
+import pytest
+
+
+class FakeCompletions:
+    def __init__(self, delays):
+        self.delays = delays
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def create(self, model, **kwargs):
+        with self._lock:
+            self.calls.append(model)
+        time.sleep(self.delays[model])
+        message = types.SimpleNamespace(content=model)
+        usage = types.SimpleNamespace(prompt_tokens=100, completion_tokens=10, prompt_tokens_details=None)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=usage, model=model)
+
+
+@pytest.fixture
+def router(app, monkeypatch):
+    def configure(delays, workers, hedge_after=0.1):
+        completions = FakeCompletions(delays)
+        client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=completions))
+        monkeypatch.setattr(app, "openai_client", client)
+        monkeypatch.setattr(app, "model_stats", app.ModelStats(app.MODEL_STATS_WINDOW))
+        monkeypatch.setattr(app, "router_pool", app.RouterPool(workers))
+        monkeypatch.setitem(
+            app.MODEL_ROUTES,
+            "followup",
+            [{"max_input": None, "models": ["primary", "fallback"], "hedge_after": hedge_after}],
+        )
+        return completions
+
+    return configure
+
+
+def content(completion):
+    return completion.choices[0].message.content
+
+
+def test_slow_primary_is_hedged(app, router):
+    completions = router({"primary": 0.5, "fallback": 0.01}, workers=4)
+    assert content(app.routed_completion("followup", 10)) == "fallback"
+    assert completions.calls == ["primary", "fallback"]
+
+
+def test_hedge_timer_excludes_queue_time(app, router):
+    completions = router({"primary": 0.02, "fallback": 0.01}, workers=2)
+    release = threading.Event()
+    blockers = [app.router_pool.submit(release.wait, 0.3)[0] for _ in range(2)]
+    assert content(app.routed_completion("followup", 10)) == "primary"
+    assert completions.calls == ["primary"]
+    release.set()
+    for blocker in blockers:
+        blocker.result()
+
+
+def test_no_hedge_when_pool_is_saturated(app, router):
+    completions = router({"primary": 0.3, "fallback": 0.01}, workers=1)
+    with app.span("test") as span_args:
+        assert content(app.hedged_completion("followup", 10, {}, span_args, None)) == "primary"
+    assert completions.calls == ["primary"]
+    assert span_args["hedge_skipped"] is True
+
+
+def test_failed_primary_falls_back_even_when_saturated(app, router):
+    completions = router({"primary": 0.0, "fallback": 0.01}, workers=1)
+    original = completions.create
+
+    def create(model, **kwargs):
+        if model == "primary":
+            completions.calls.append(model)
+            raise RuntimeError("upstream down")
+        return original(model, **kwargs)
+
+    completions.create = create
+    assert content(app.routed_completion("followup", 10)) == "fallback"
+
+
+def wait_for_calls(app):
+    # Lets the losing call finish on its router thread.
+    app.router_pool._executor.shutdown(wait=True)
+
+
+def test_hedge_loser_usage_is_recorded_with_its_role(app, router):
+    router({"primary": 0.3, "fallback": 0.01}, workers=4, hedge_after=0.05)
+    usage = app.RequestUsage()
+    assert content(app.routed_completion("followup", 10, usage=usage)) == "fallback"
+    wait_for_calls(app)
+    assert usage["followup.hedge_loser"]["model"] == "primary"
+    assert usage["followup.hedge_loser"]["prompt_tokens"] == 100
+
+
+def test_loser_finishing_after_the_ledger_write_gets_its_own_entry(app, router, monkeypatch):
+    router({"primary": 0.3, "fallback": 0.01}, workers=4, hedge_after=0.05)
+    monkeypatch.setattr(app, "decode_ledger", app.DecodeLedger(100, 1000))
+    usage = app.RequestUsage()
+    completion = app.routed_completion("followup", 10, usage=usage)
+    app.record_usage(usage, "followup", completion)
+    app.decode_ledger.record("user-a", "decode-1", "followup", usage, ok=True)
+    wait_for_calls(app)
+    app.decode_ledger.flush()
+
+    with app.get_db_connection() as conn:
+        rows = conn.execute("SELECT user_id, decode_id, stage, model, prompt_tokens FROM decode_ledger").fetchall()
+    assert sorted(tuple(row) for row in rows) == [
+        ("user-a", "decode-1", "followup", "fallback", 100),
+        ("user-a", "decode-1", "followup.hedge_loser", "primary", 100),
+    ]
+
+
+def test_short_inputs_start_on_the_cheaper_model(app):
+    assert app.select_models("analysis", app.select_route("analysis", 500))[0] == "gpt-4.1-nano"
+    assert app.select_models("analysis", app.select_route("analysis", 50_000))[0] == "gpt-4.1-mini"
+    assert app.select_models("followup", app.select_route("followup", 500))[0] == "gpt-4.1-nano"
+    assert app.select_models("ocr", app.select_route("ocr", 500))[0] == "gpt-4.1-mini"
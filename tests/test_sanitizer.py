@@ -0,0 +1,54 @@
+import pytest
+
+from app import HtmlSanitizer, strip_disallowed_html
+
+
+def streamed(raw_html, chunk_size):
+    sanitizer = HtmlSanitizer()
+    parts = [sanitizer.feed(raw_html[i:i + chunk_size]) for i in range(0, len(raw_html), chunk_size)]
+    parts.append(sanitizer.close())
+    return "".join(parts).strip()
+
+
+@pytest.mark.parametrize(
+    "raw_html, expected",
+    [
+        ('<div class="quick-take evil">Hi</div>', '<div class="quick-take">Hi</div>'),
+        ("<p>a<script>alert(1)</script>b</p>", "<p>ab</p>"),
+        ('<p onclick="x()">a</p>', "<p>a</p>"),
+        ("<p>a<svg><p>hidden</p></svg>b</p>", "<p>ab</p>"),
+        ("<p>open", "<p>open</p>"),
+        ("a &lt;b&gt; &amp; c", "a &lt;b&gt; &amp; c"),
+        ("<!-- note -->kept", "kept"),
+        ("<a href='javascript:x'>link</a>", "link"),
+    ],
+)
+def test_allowlist(raw_html, expected):
+    assert strip_disallowed_html(raw_html) == expected
+
+
+@pytest.mark.parametrize(
+    "raw_html, expected",
+    [
+        ("<svg/>visible text after", "visible text after"),
+        ("<svg />x", "x"),
+        ("<svg a/>y", "y"),
+        ("<p>a<math/>b</p>", "<p>ab</p>"),
+        ("<svg><svg/>in</svg>out", "out"),
+        # The slash is part of the unquoted value, so this <svg> is still open.
+        ("<svg a=b/>z</svg>w", "w"),
+        # Raw text elements ignore the slash; their content runs to the end tag.
+        ("<script/>bad</script>ok", "ok"),
+    ],
+)
+def test_self_closing_drop_tags(raw_html, expected):
+    assert strip_disallowed_html(raw_html) == expected
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64])
+def test_chunked_matches_whole(chunk_size):
+    raw_html = (
+        '<div class="section"><h3>Read</h3><svg/><p>x &amp; y</p>'
+        "<script>bad()</script><!-- c --><ul><li>one<li>two</ul></div>tail"
+    )
+    assert streamed(raw_html, chunk_size) == strip_disallowed_html(raw_html)
@@ -0,0 +1,70 @@
+import threading
+import time
+
+
+def wait_until(predicate, timeout=2.0):
+    stop = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < stop, "condition not reached"
+        time.sleep(0.005)
+
+
+def test_free_decodes_leave_reserved_slots_for_paid(app):
+    scheduler = app.DecodeScheduler(3, 1, app.DECODE_CLASS_WEIGHTS)
+    assert scheduler.acquire("free", 0.05)
+    assert scheduler.acquire("free", 0.05)
+    assert not scheduler.acquire("free", 0.05)
+    assert scheduler.acquire("paid", 0.05)
+    assert not scheduler.acquire("paid", 0.05)
+
+    snapshot = scheduler.snapshot()
+    assert snapshot["free"]["timed_out"] == snapshot["paid"]["timed_out"] == 1
+    assert snapshot["free"]["running"] == 2 and snapshot["paid"]["running"] == 1
+
+    scheduler.release("free")
+    assert scheduler.acquire("free", 0.05)
+
+
+def test_batch_decodes_cannot_take_reserved_slots(app):
+    scheduler = app.DecodeScheduler(3, 1, app.DECODE_CLASS_WEIGHTS)
+    assert scheduler.acquire("batch", 0.05)
+    assert scheduler.acquire("batch", 0.05)
+    assert not scheduler.acquire("batch", 0.05)
+    assert scheduler.acquire("paid", 0.05)
+
+
+def test_waiters_are_admitted_by_weighted_round_robin(app):
+    scheduler = app.DecodeScheduler(1, 0, {"paid": 3, "free": 1})
+    assert scheduler.acquire("paid", 1)
+    order = []
+
+    def waiter(decode_class):
+        if scheduler.acquire(decode_class, 5):
+            order.append(decode_class)
+            scheduler.release(decode_class)
+
+    def queued():
+        return sum(entry["queued"] for entry in scheduler.snapshot().values())
+
+    threads = []
+    for index, decode_class in enumerate(["paid", "free"] * 3):
+        thread = threading.Thread(target=waiter, args=(decode_class,))
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda: queued() == index + 1)
+
+    scheduler.release("paid")
+    for thread in threads:
+        thread.join(5)
+    assert order == ["paid", "paid", "free", "paid", "free", "free"]
+
+
+def test_slot_timeout_is_capped_by_the_caller(app):
+    scheduler = app.DecodeScheduler(1, 0, app.DECODE_CLASS_WEIGHTS)
+    with scheduler.slot("paid") as admitted:
+        assert admitted
+        started = time.monotonic()
+        with scheduler.slot("paid", timeout=0.05) as second:
+            assert not second
+        assert time.monotonic() - started < 1
+    assert scheduler.snapshot()["paid"]["running"] == 0
@@ -0,0 +1,67 @@
+import time
+
+OLD = "2020-01-01"
+
+
+def add_user(app, user_id, free_uses_date=OLD, **columns):
+    values = {"id": user_id, "created_at": OLD, "free_uses_date": free_uses_date, **columns}
+    with app.get_db_connection(user_id) as conn:
+        conn.execute(
+            f"INSERT INTO users ({', '.join(values)}) VALUES ({', '.join('?' for _ in values)})",
+            tuple(values.values()),
+        )
+        conn.commit()
+
+
+def add_checkout(app, user_id, expires_at):
+    with app.get_db_connection(user_id) as conn:
+        conn.execute(
+            """
+            INSERT INTO checkout_sessions (id, user_id, pack, url, base_url, created_at, expires_at)
+            VALUES (?, ?, '10', 'https://checkout', 'https://app', ?, ?)
+            """,
+            (f"cs-{user_id}", user_id, OLD, expires_at),
+        )
+        conn.commit()
+
+
+def remaining_users(app):
+    found = set()
+    for shard in app.storage.shards():
+        with app.storage.connect(shard) as conn:
+            found.update(row["id"] for row in conn.execute("SELECT id FROM users"))
+    return found
+
+
+def test_sweep_deletes_only_abandoned_users(app):
+    add_user(app, "abandoned")
+    add_user(app, "recent", free_uses_date=time.strftime("%Y-%m-%d"))
+    add_user(app, "decoded", total_decodes=1)
+    add_user(app, "paid", paid_decode_credits=10)
+    add_user(app, "checking-out")
+    add_checkout(app, "checking-out", int(time.time()) + 3600)
+    add_user(app, "checkout-expired")
+    add_checkout(app, "checkout-expired", int(time.time()) - 3600)
+
+    result = app.user_sweeper.run(force=True)
+    assert result["error"] is None
+    assert result["users_deleted"] == 2
+    assert remaining_users(app) == {"recent", "decoded", "paid", "checking-out"}
+
+
+def test_sweep_recreates_a_missing_index(app):
+    for shard in app.storage.shards():
+        with app.storage.connect(shard) as conn:
+            conn.execute("DROP INDEX idx_users_abandoned")
+            conn.commit()
+    add_user(app, "abandoned")
+
+    result = app.user_sweeper.run(force=True)
+    assert result["error"] is None
+    assert remaining_users(app) == set()
+
+
+def test_only_one_sweep_per_interval(app):
+    assert app.user_sweeper.run() is not None
+    assert app.user_sweeper.run() is None
+    assert app.user_sweeper.run(force=True) is not None
@@ -0,0 +1,138 @@
+import io
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+
+@pytest.fixture
+def ocr_calls(app, monkeypatch):
+    calls = []
+    lock = threading.Lock()
+
+    def fake_ocr(img_bytes, usage=None, deadline=None, user_id=None):
+        with lock:
+            calls.append(img_bytes)
+        return "text:" + img_bytes.decode()
+
+    monkeypatch.setattr(app, "ocr_image", fake_ocr)
+    return calls
+
+
+def upload(client, count, replaces=None, prefix="img"):
+    data = {"images": [(io.BytesIO(f"{prefix}{i}".encode()), f"{i}.png") for i in range(count)]}
+    if replaces:
+        data["replaces"] = ",".join(replaces)
+    return client.post("/upload", data=data, content_type="multipart/form-data")
+
+
+def wait_for_ocr(app):
+    for future in list(app.upload_futures.values()):
+        try:
+            future.result(5)
+        except Exception:
+            pass
+
+
+def test_requires_existing_cookie(app, client, ocr_calls):
+    assert upload(client, 1).status_code == 400
+    with app.get_db_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+
+
+def test_uploads_limited_by_remaining_decodes(app, client, ocr_calls):
+    client.set_cookie("mil_uid", "user-a")
+    allowance = app.MAX_UPLOADS_PER_DECODE * app.FREE_DECODES_PER_DAY
+    first = upload(client, app.MAX_UPLOADS_PER_DECODE)
+    second = upload(client, allowance - app.MAX_UPLOADS_PER_DECODE, prefix="more")
+    assert first.status_code == second.status_code == 200
+    assert upload(client, 1, prefix="over").status_code == 429
+
+    # Replacing earlier picks frees their share of the allowance.
+    replaced = upload(client, 2, replaces=first.get_json()["upload_ids"], prefix="again")
+    assert replaced.status_code == 200
+    wait_for_ocr(app)
+    assert len(ocr_calls) <= allowance + 2
+
+
+def test_one_decode_left_allows_one_decode_of_uploads(app, client, ocr_calls):
+    client.set_cookie("mil_uid", "user-a")
+    user_row = app.load_or_create_user("user-a")
+    with app.get_db_connection("user-a") as conn:
+        conn.execute("UPDATE users SET free_uses_today = ? WHERE id = ?", (app.FREE_DECODES_PER_DAY - 1, "user-a"))
+        conn.commit()
+    app.user_cache.invalidate(user_row["id"])
+    assert upload(client, app.MAX_UPLOADS_PER_DECODE).status_code == 200
+    assert upload(client, 1, prefix="over").status_code == 429
+
+
+def test_used_uploads_still_count_toward_window(app, client, ocr_calls, monkeypatch):
+    monkeypatch.setattr(app, "UPLOADS_PER_WINDOW", 4)
+    client.set_cookie("mil_uid", "user-a")
+    ids = upload(client, 3).get_json()["upload_ids"]
+    wait_for_ocr(app)
+    app.discard_uploads("user-a", ids)
+    assert upload(client, 2, prefix="next").status_code == 429
+    assert upload(client, 1, prefix="next").status_code == 200
+
+
+def test_discarded_upload_is_not_ocrd_and_drops_its_image(app, ocr_calls):
+    user_row = app.load_or_create_user("user-a")
+    (upload_id,) = app.save_uploads(user_row, [b"img"])
+    app.discard_uploads("user-a", [upload_id])
+    assert app.finish_upload_ocr("user-a", upload_id, b"img", "free") == ""
+    assert ocr_calls == []
+    row = app.load_upload("user-a", upload_id)
+    assert row["status"] == "used" and row["image"] is None
+
+
+def test_upload_discarded_during_ocr_keeps_no_text(app, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    def gated_ocr(img_bytes, usage=None, deadline=None, user_id=None):
+        started.set()
+        release.wait(5)
+        return "text:" + img_bytes.decode()
+
+    monkeypatch.setattr(app, "ocr_image", gated_ocr)
+    user_row = app.load_or_create_user("user-a")
+    (upload_id,) = app.save_uploads(user_row, [b"img"])
+    worker = threading.Thread(target=app.finish_upload_ocr, args=("user-a", upload_id, b"img", "free"))
+    worker.start()
+    assert started.wait(5)
+    app.discard_uploads("user-a", [upload_id])
+    release.set()
+    worker.join(5)
+
+    row = app.load_upload("user-a", upload_id)
+    assert row["status"] == "used" and row["transcript"] is None and row["image"] is None
+
+
+def test_finished_upload_keeps_text_not_image(app, ocr_calls):
+    user_row = app.load_or_create_user("user-a")
+    (upload_id,) = app.save_uploads(user_row, [b"img"])
+    assert app.finish_upload_ocr("user-a", upload_id, b"img", "free") == "text:img"
+    row = app.load_upload("user-a", upload_id)
+    assert row["status"] == "done" and row["image"] is None
+    assert app.wait_for_upload_text("user-a", upload_id) == "text:img"
+
+
+def test_uploads_share_one_wait_budget(app, ocr_calls, monkeypatch):
+    monkeypatch.setattr(app, "UPLOAD_WAIT_SECONDS", 0.3)
+    monkeypatch.setattr(app, "UPLOAD_POLL_SECONDS", 0.05)
+    user_row = app.load_or_create_user("user-a")
+    upload_ids = app.save_uploads(user_row, [b"a", b"b", b"c"])
+    # A stuck background OCR on this worker, and two uploads whose OCR runs on a
+    # worker that never finishes: each used to get its own full wait.
+    stuck = Future()
+    monkeypatch.setitem(app.upload_futures, upload_ids[0], stuck)
+
+    started = time.monotonic()
+    text = app.collect_upload_text("user-a", upload_ids)
+    elapsed = time.monotonic() - started
+    stuck.cancel()
+
+    assert text == "text:a\n\ntext:b\n\ntext:c"
+    assert elapsed < 0.3 * 2